@@ -1,22 +1,56 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from flask import Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from models import db, User, Student, SchoolClass, Event, Participation, PortfolioEntry, ClassPoints, PaperCollection  # добавили PaperCollection
-from models import generate_student_login, generate_password, create_students_from_list
+from models import generate_student_login, generate_password, create_students_from_list, recompute_all
+from models import recompute_class_ratings, register_participations, import_students, read_roster
+from models import iter_new_credentials, save_password_hashes, load_principal, find_principal_for_login
+from models import leaderboard_generation, student_leaderboard, class_leaderboard, refresh_rankings
+from models import rebuild_paper_rollups, rating_scheduler, on_rankings_stale, StudentRanking, ClassRanking
+from models import on_ratings_deferred, RATING_RECOMPUTE_MAX_WAIT
+from models import save_paper_collections, paper_overview_cache
+from migrations import migrate, pending_migrations, stamp_migrations
+from database import configure_database, read_only
+from cache import app_cache
+from conditional import conditional
+from fragment_cache import install_fragment_cache, fragment_cache_metrics
+from instrumentation import instrumentation
+from pagination import ListFilters, page_limit
+from jobs import Job, job, enqueue, enqueue_once, find_job, purge_finished, start_worker_pool, start_worker_thread
+from jobs import JOB_RETENTION_DAYS
+import queries
+import click
 import os
-from datetime import datetime
+import signal
+from datetime import datetime, timedelta
 import csv
 import io
+import json
+import time
+import uuid
+import zipfile
+import zlib
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'  # этот ключ также используется для сессий
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///school_rating.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///school_rating.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Инициализация расширений
-db.init_app(app)
+# Инициализация расширений (профиль БД: PRAGMA, пул, подключение только для чтения)
+configure_database(app, db)
+app.config.setdefault('CACHE_URL', os.environ.get('CACHE_URL', 'memory://'))
+app_cache.configure(app.config['CACHE_URL'])
+install_fragment_cache(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+queries.install_query_counter(app)
+# Счетчики запросов по маршрутам: /metrics и flask slow-routes
+instrumentation.install(app, db)
+# Пересчет рейтингов: пометки сливаются, каждый рейтинг считается один раз за коммит
+rating_scheduler.configure(app)
+instrumentation.add_collector(rating_scheduler.metrics)
+instrumentation.add_collector(fragment_cache_metrics)
 
 
 @app.template_filter('has_attr')
@@ -28,16 +62,19 @@ def has_attr_filter(obj, attr_name):
 def utility_processor():
     def has_attr(obj, attr_name):
         return hasattr(obj, attr_name)
-    return dict(has_attr=has_attr)
+
+    def new_idempotency_key():
+        # Скрытое поле формы: повторная отправка не ставит задачу второй раз
+        return uuid.uuid4().hex
+    return dict(has_attr=has_attr, new_idempotency_key=new_idempotency_key)
 
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    user = User.query.get(int(user_id))
-    if not user:
-        user = Student.query.get(int(user_id))
-    return user
+    # Идентификатор в сессии содержит тип: 'u:5' - пользователь, 's:5' - ученик.
+    # Старые сессии с числовым id не принимаются - потребуется повторный вход.
+    return load_principal(user_id)
 
 
 # ===== МАРШРУТЫ АУТЕНТИФИКАЦИИ =====
@@ -77,11 +114,9 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        user = User.query.filter_by(username=username).first()
-        if not user:
-            user = Student.query.filter_by(login=username).first()
+        user = find_principal_for_login(username, password)
 
-        if user and hasattr(user, 'check_password') and user.check_password(password):
+        if user:
             login_user(user)
             name = user.full_name if hasattr(user, 'full_name') else user.username
             flash(f'Добро пожаловать, {name}!')
@@ -105,16 +140,8 @@ def logout():
 def dashboard():
     if getattr(current_user, 'role', None):
         # Обычный пользователь (учитель/админ)
-        total_school_rating = db.session.query(db.func.sum(SchoolClass.total_rating)).scalar() or 0
-        classes_count = SchoolClass.query.count()
-        events_count = Event.query.count()
-        students_count = Student.query.count()
-
-        return render_template('dashboard.html',
-                               total_school_rating=total_school_rating,
-                               classes_count=classes_count,
-                               events_count=events_count,
-                               students_count=students_count)
+        # Счетчики берутся из кеша и сбрасываются при изменении классов, мероприятий и баллов
+        return render_template('dashboard.html', **queries.dashboard_counters())
     else:
         # Ученик
         return render_template('dashboard.html')
@@ -122,13 +149,17 @@ def dashboard():
 # ===== МАРШРУТЫ ДЛЯ КЛАССОВ =====
 @app.route('/classes')
 @login_required
+@read_only
 def classes():
     if getattr(current_user, 'role', None) not in ['admin', 'teacher']:
         flash('Недостаточно прав')
         return redirect(url_for('dashboard'))
 
-    classes_list = SchoolClass.query.all()
-    teachers = User.query.filter_by(role='teacher').all() if getattr(current_user, 'role', None) == 'admin' else []
+    # Таблица классов кешируется фрагментом; запросы выполнятся только при промахе
+    classes_list = queries.LazyResult(queries.classes_overview)
+    teachers = []
+    if getattr(current_user, 'role', None) == 'admin':
+        teachers = queries.LazyResult(User.query.filter_by(role='teacher').all)
     return render_template('classes/classes.html', classes=classes_list, teachers=teachers)
 
 
@@ -143,27 +174,32 @@ def add_class():
         name = request.form['name']
         grade = request.form['grade']
         student_list = request.form.get('student_list', '')
+        roster_file = request.files.get('roster_file')
+
+        student_names = [name.strip() for name in student_list.split('\n') if name.strip()]
+        if roster_file and roster_file.filename:
+            try:
+                student_names += read_roster(roster_file.stream, roster_file.filename)
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('add_class'))
+
+        # Повторная отправка той же формы: класс уже создан, показываем его задачу
+        queued = find_job(_idempotency_key(), current_user.get_id())
+        if queued is not None:
+            return redirect(url_for('job_status', job_id=queued.id))
 
         new_class = SchoolClass(name=name, grade=grade)
         db.session.add(new_class)
         db.session.commit()
 
-        # Создаем учеников из списка
-        if student_list:
-            student_names = [name.strip() for name in student_list.split('\n') if name.strip()]
-            if student_names:
-                students_data = create_students_from_list(student_names, new_class.id, f"{grade}{name}")
-
-                for data in students_data:
-                    db.session.add(data['student'])
-
-                db.session.commit()
-                flash(f'Класс "{grade}{name}" и {len(students_data)} учеников успешно добавлены')
-            else:
-                flash(f'Класс "{grade}{name}" успешно добавлен (без учеников)')
-        else:
-            flash(f'Класс "{grade}{name}" успешно добавлен')
+        # Учеников создает рабочий процесс: хеширование паролей долгое
+        if student_names:
+            queued = _enqueue('import_roster', class_id=new_class.id, student_names=student_names)
+            flash(f'Класс "{grade}{name}" добавлен, импорт учеников ({len(student_names)}) поставлен в очередь')
+            return redirect(url_for('job_status', job_id=queued.id))
 
+        flash(f'Класс "{grade}{name}" успешно добавлен')
         return redirect(url_for('classes'))
 
     return render_template('classes/add_class.html')
@@ -171,15 +207,37 @@ def add_class():
 
 @app.route('/class/<int:class_id>/students')
 @login_required
+@read_only
 def class_students(class_id):
     if not hasattr(current_user, 'role') or current_user.role not in ['admin', 'teacher']:
         flash('Недостаточно прав')
         return redirect(url_for('dashboard'))
 
-    school_class = SchoolClass.query.get_or_404(class_id)
+    school_class = queries.class_with_students(class_id)
     return render_template('classes/class_students.html', school_class=school_class)
 
 
+@app.route('/class/<int:class_id>/import_students', methods=['POST'])
+@login_required
+def import_class_students(class_id):
+    """Импорт списка учеников из CSV/XLSX в существующий класс"""
+    if getattr(current_user, 'role', None) != 'admin':
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    school_class = SchoolClass.query.get_or_404(class_id)
+    roster_file = request.files.get('roster_file')
+    if not roster_file or not roster_file.filename:
+        return jsonify({'success': False, 'message': 'Файл не выбран'}), 400
+
+    try:
+        student_names = read_roster(roster_file.stream, roster_file.filename)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    queued = _enqueue('import_roster', class_id=school_class.id, student_names=student_names)
+    return _job_accepted(queued, f'Импорт учеников ({len(student_names)}) поставлен в очередь')
+
+
 @app.route('/class/<int:class_id>/export_logins')
 @login_required
 def export_student_logins(class_id):
@@ -188,37 +246,73 @@ def export_student_logins(class_id):
         return redirect(url_for('dashboard'))
 
     school_class = SchoolClass.query.get_or_404(class_id)
+    # Новые пароли хешируются в рабочем процессе, файл скачивается со страницы задачи
+    queued = _enqueue('regenerate_credentials', class_id=school_class.id)
+    return redirect(url_for('job_status', job_id=queued.id))
 
-    # Создаем CSV в памяти
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ФИО', 'Логин', 'Пароль', 'Класс'])
 
-    for student in school_class.students:
-        # Генерируем новый пароль для каждого ученика
-        new_password = generate_password()
+@app.route('/export_logins/all')
+@login_required
+def export_all_student_logins():
+    """Выгрузка логинов всей школы: ZIP с CSV-файлом на каждый класс (фоновая задача)"""
+    if getattr(current_user, 'role', None) != 'admin':
+        flash('Недостаточно прав')
+        return redirect(url_for('dashboard'))
 
-        # Обновляем пароль ученика в базе данных
-        student.set_password(new_password)
+    queued = _enqueue('regenerate_credentials')
+    return redirect(url_for('job_status', job_id=queued.id))
 
-        writer.writerow([
-            student.full_name,
-            student.login,
-            new_password,
-            school_class.get_full_name()
-        ])
 
-    # Сохраняем все изменения паролей
-    db.session.commit()
+CREDENTIALS_HEADER = ['ФИО', 'Логин', 'Пароль', 'Класс']
 
-    output.seek(0)
 
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name=f'logins_{school_class.get_full_name()}.csv'
-    )
+def _credential_rows(class_id=None):
+    """Ученики для выгрузки логинов одним запросом, упорядоченные по классам"""
+    query = db.session.query(
+        Student.id,
+        Student.full_name,
+        Student.login,
+        Student.class_id,
+        (SchoolClass.grade + SchoolClass.name).label('class_name')
+    ).join(SchoolClass, SchoolClass.id == Student.class_id)
+    if class_id is not None:
+        query = query.filter(Student.class_id == class_id)
+    return query.order_by(SchoolClass.grade, SchoolClass.name, Student.class_id, Student.id).all()
+
+
+def _credential_row(student, password):
+    return [student.full_name, student.login, password, student.class_name]
+
+
+def _csv_line(row):
+    output = io.StringIO()
+    csv.writer(output).writerow(row)
+    return output.getvalue()
+
+
+def _write_credentials_csv(file, batches, on_batch):
+    file.write(_csv_line(CREDENTIALS_HEADER).encode('utf-8'))
+    for batch in batches:
+        file.write(''.join(_csv_line(_credential_row(student, password)) for student, password in batch).encode('utf-8'))
+        on_batch(len(batch))
+
+
+def _write_credentials_zip(file, batches, on_batch):
+    with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        entry = None
+        current_class = None
+        for batch in batches:
+            for student, password in batch:
+                if student.class_id != current_class:
+                    if entry:
+                        entry.close()
+                    current_class = student.class_id
+                    entry = archive.open(f'logins_{student.class_name}.csv', 'w')
+                    entry.write(_csv_line(CREDENTIALS_HEADER).encode('utf-8'))
+                entry.write(_csv_line(_credential_row(student, password)).encode('utf-8'))
+            on_batch(len(batch))
+        if entry:
+            entry.close()
 
 
 @app.route('/assign_teacher/<int:class_id>', methods=['POST'])
@@ -262,8 +356,8 @@ def add_class_points(class_id):
             reason=reason,
             assigned_by=current_user.id
         )
+        # Рейтинг класса пересчитывается при этом же коммите (rating_scheduler)
         db.session.add(class_points)
-        school_class.update_total_rating()
         db.session.commit()
 
         flash(f'Классу {school_class.get_full_name()} начислено {points} баллов')
@@ -274,6 +368,7 @@ def add_class_points(class_id):
 
 @app.route('/class_points_history/<int:class_id>')
 @login_required
+@read_only
 def class_points_history(class_id):
     if not hasattr(current_user, 'role') or current_user.role not in ['admin', 'teacher']:
         flash('Недостаточно прав')
@@ -288,11 +383,22 @@ def class_points_history(class_id):
 
 
 # ===== МАРШРУТЫ ДЛЯ МЕРОПРИЯТИЙ =====
+# Учеников на странице выбора участников (в классе обычно меньше)
+STUDENT_PICKER_PAGE_SIZE = 100
+
+
 @app.route('/events')
 @login_required
+@read_only
+@conditional(Event)
 def events():
-    events_list = Event.query.filter_by(is_active=True).all()
-    return render_template('events/events.html', events=events_list)
+    filters = ListFilters.from_args(request.args)
+    page = queries.active_events(filters, cursor=request.args.get('after'), limit=page_limit(request.args))
+    return render_template('events/events.html',
+                           events=page.items,
+                           next_cursor=page.next_cursor,
+                           filters=filters,
+                           levels=Event.LEVELS)
 
 
 @app.route('/add_event', methods=['GET', 'POST'])
@@ -363,7 +469,7 @@ def participate_in_event(event_id):
             participants_count = int(request.form['participants_count'])
             description = request.form['description']
 
-            registered_count = 0
+            entries = []
             for student_id in student_ids:
                 place = request.form.get(f'place_{student_id}')
                 # Если место "не участвовал", пропускаем ученика
@@ -372,33 +478,20 @@ def participate_in_event(event_id):
 
                 # Если место не указано (участие без места) или указано конкретное место
                 place = int(place) if place and place != 'not_participated' and place != '' else None
-
-                participation = Participation(
-                    event_id=event_id,
-                    student_id=student_id,
-                    news_link=news_link,
-                    participants_count=participants_count,
-                    description=description,
-                    place=place,
-                    approved=True
-                )
-                db.session.add(participation)
-                registered_count += 1
-
-                # Обновляем рейтинг ученика
-                student = Student.query.get(student_id)
-                student.update_personal_rating()
-
-            # Обновляем рейтинг класса после регистрации всех участников
-            if event.event_type in ['class', 'both'] and registered_count > 0:
-                # Находим класс первого зарегистрированного ученика
-                if student_ids:
-                    first_student = Student.query.get(student_ids[0])
-                    if first_student:
-                        first_student.school_class.update_total_rating()
-
-            db.session.commit()
-            flash(f'Участие зарегистрировано для {registered_count} учеников')
+                entries.append((student_id, place))
+
+            # Вставка одним пакетом в рабочем процессе, рейтинги обновляются агрегированно
+            queued = _enqueue(
+                'register_participations',
+                event_id=event.id,
+                entries=entries,
+                news_link=news_link,
+                participants_count=participants_count,
+                description=description,
+                approved_by=current_user.id
+            )
+            flash(f'Регистрация участия ({len(entries)} учеников) поставлена в очередь')
+            return redirect(url_for('job_status', job_id=queued.id))
 
         else:
             # Код для учеников
@@ -415,63 +508,144 @@ def participate_in_event(event_id):
                 approved=False
             )
             db.session.add(participation)
-
-            # Обновляем рейтинг ученика
-            current_user.update_personal_rating()
-
             db.session.commit()
             flash('Заявка на участие отправлена')
 
         return redirect(url_for('events'))
 
-    # Получаем студентов для выбора
+    # Получаем студентов для выбора: первая страница, остальные подгружаются
+    # через /api/students/search
+    next_cursor = None
     if getattr(current_user, 'role', None) in ['admin', 'teacher']:
         managed_class = None
+        class_id = None
         if getattr(current_user, 'role', None) == 'teacher' and current_user.managed_class:
             # Классный руководитель видит только своих учеников
-            managed_class = SchoolClass.query.get(
-                current_user.managed_class[0].id) if current_user.managed_class else None
-            if managed_class:
-                students = managed_class.students
-            else:
-                students = []
-                flash('У вас нет класса для управления')
+            managed_class = current_user.managed_class[0]
+            class_id = managed_class.id
+        elif getattr(current_user, 'role', None) == 'admin':
+            # Админ выбирает класс, ученики показываются после выбора
+            class_id = request.args.get('class_id', type=int)
+        else:
+            flash('У вас нет класса для управления')
+
+        if class_id is not None:
+            page = queries.search_students(ListFilters(class_id=class_id), class_ids=[class_id],
+                                           limit=page_limit(request.args, default=STUDENT_PICKER_PAGE_SIZE))
+            students, next_cursor = page
         else:
-            # Админ видит всех учеников
-            students = Student.query.all()
+            students = []
 
         # Получаем список классов для админа
-        classes = SchoolClass.query.all() if getattr(current_user, 'role', None) == 'admin' else []
+        classes = SchoolClass.query.order_by(SchoolClass.grade, SchoolClass.name).all() \
+            if getattr(current_user, 'role', None) == 'admin' else []
     else:
         students = [current_user]
         managed_class = None
+        class_id = None
         classes = []
 
     return render_template('events/participate_event.html',
                            event=event,
                            students=students,
+                           next_cursor=next_cursor,
+                           selected_class_id=class_id,
                            managed_class=managed_class,
                            classes=classes)
+
+
+@app.route('/api/students/search')
+@login_required
+@read_only
+def api_search_students():
+    """Поиск учеников для выбора участников: ?q=&class_id=&after=&limit="""
+    role = getattr(current_user, 'role', None)
+    if role not in ['admin', 'teacher']:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    # Классный руководитель ищет только среди учеников своего класса
+    class_ids = None
+    if role == 'teacher':
+        class_ids = [c.id for c in current_user.managed_class]
+
+    filters = ListFilters.from_args(request.args)
+    page = queries.search_students(filters, class_ids=class_ids, cursor=request.args.get('after'),
+                                   limit=page_limit(request.args, default=STUDENT_PICKER_PAGE_SIZE))
+    items = [{
+        'id': row.id,
+        'full_name': row.full_name,
+        'class_id': row.class_id,
+        'class_name': f'{row.grade}{row.class_letter}'
+    } for row in page.items]
+    return jsonify({'success': True, 'items': items, 'next_cursor': page.next_cursor})
+
+
+@app.route('/api/event/<int:event_id>/participations', methods=['POST'])
+@login_required
+def api_register_participations(event_id):
+    """Массовая регистрация участия: {"participants": [{"student_id": 1, "place": 1}, ...]}"""
+    if getattr(current_user, 'role', None) not in ['admin', 'teacher']:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    event = Event.query.get_or_404(event_id)
+    data = request.get_json(silent=True) or {}
+
+    try:
+        entries = []
+        for item in data.get('participants', []):
+            if isinstance(item, dict):
+                student_id, place = item['student_id'], item.get('place')
+            else:
+                student_id, place = item
+            entries.append((int(student_id), int(place) if place not in (None, '') else None))
+        participants_count = data.get('participants_count')
+        participants_count = int(participants_count) if participants_count is not None else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Неверный формат данных'}), 400
+
+    # Классный руководитель может регистрировать только учеников своего класса
+    class_ids = None
+    if current_user.role == 'teacher':
+        class_ids = [c.id for c in current_user.managed_class]
+
+    queued = _enqueue(
+        'register_participations',
+        event_id=event.id,
+        entries=entries,
+        news_link=data.get('news_link'),
+        participants_count=participants_count,
+        description=data.get('description'),
+        approved_by=current_user.id,
+        class_ids=class_ids
+    )
+    return _job_accepted(queued, f'Регистрация участия ({len(entries)} учеников) поставлена в очередь')
+
+
 # ===== МАРШРУТЫ ДЛЯ ПОРТФОЛИО =====
 @app.route('/portfolio/<int:student_id>')
 @login_required
+@read_only
 def student_portfolio(student_id):
-    if hasattr(current_user, 'role') and current_user.role in ['admin', 'teacher']:
-        student = Student.query.get_or_404(student_id)
-    else:
+    if not (hasattr(current_user, 'role') and current_user.role in ['admin', 'teacher']):
         if current_user.id != student_id:
             flash('Недостаточно прав')
             return redirect(url_for('dashboard'))
-        student = current_user
+    student = queries.student_for_portfolio(student_id)
 
     statistics = student.get_statistics()
-    participations = Participation.query.filter_by(student_id=student_id, approved=True).all()
-    portfolio_entries = PortfolioEntry.query.filter_by(student_id=student_id, approved=True).all()
+    filters = ListFilters.from_args(request.args)
+    participations, next_cursor = queries.approved_participations(
+        student_id, filters, cursor=request.args.get('after'), limit=page_limit(request.args)
+    )
+    portfolio_entries = queries.approved_portfolio_entries(student_id)
 
     return render_template('portfolio/student_portfolio.html',
                            student=student,
                            statistics=statistics,
                            participations=participations,
+                           next_cursor=next_cursor,
+                           filters=filters,
+                           levels=Event.LEVELS,
                            portfolio_entries=portfolio_entries)
 
 
@@ -505,22 +679,91 @@ def add_portfolio_entry():
     flash('Запись добавлена в портфолио и ожидает подтверждения')
     return redirect(url_for('student_portfolio', student_id=current_user.id))
 # ===== МАРШРУТЫ ДЛЯ РЕЙТИНГОВ И ОТЧЕТОВ =====
+RATINGS_PAGE_SIZE = 50
+RATINGS_MAX_PAGE_SIZE = 500
+# Таблицы, от которых зависит страница рейтингов (в т.ч. имена руководителей)
+RATING_MODELS = (StudentRanking, ClassRanking, Student, SchoolClass, User)
+
+
 @app.route('/ratings')
 @login_required
+@read_only
+@conditional(*RATING_MODELS, cache_body=True)
 def ratings():
-    class_ratings = SchoolClass.query.order_by(SchoolClass.total_rating.desc()).all()
-    student_ratings = Student.query.order_by(Student.personal_rating.desc()).all()
+    grade = request.args.get('grade') or None
+    after = request.args.get('after', type=int)
+    classes_after = request.args.get('classes_after', type=int)
+
+    # Таблицы кешируются фрагментами; запросы выполнятся только при промахе
+    class_page = queries.LazyResult(class_leaderboard, after=classes_after, limit=RATINGS_PAGE_SIZE, grade=grade)
+    student_page = queries.LazyResult(student_leaderboard, after=after, limit=RATINGS_PAGE_SIZE, grade=grade)
 
     return render_template('ratings.html',
-                           class_ratings=class_ratings,
-                           student_ratings=student_ratings)
+                           class_page=class_page,
+                           student_page=student_page,
+                           after=after,
+                           classes_after=classes_after,
+                           grade=grade)
+
+
+@app.route('/api/ratings/<kind>')
+@login_required
+@read_only
+def api_ratings(kind):
+    """Рейтинг учеников или классов в JSON; ETag меняется только при пересборке рейтингов"""
+    if kind not in ('students', 'classes'):
+        return jsonify({'success': False, 'message': 'Неизвестный рейтинг'}), 404
+
+    generation = leaderboard_generation()
+    etag = f'lb-{generation}-{kind}-{request.query_string.decode()}'
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    grade = request.args.get('grade') or None
+    after = request.args.get('after', type=int)
+    limit = min(request.args.get('limit', RATINGS_PAGE_SIZE, type=int), RATINGS_MAX_PAGE_SIZE)
+
+    if kind == 'students':
+        rows, next_cursor = student_leaderboard(after=after, limit=limit, grade=grade)
+        items = [{
+            'position': row.position,
+            'rank': row.rank,
+            'dense_rank': row.dense_rank,
+            'grade_rank': row.grade_rank,
+            'rating': row.rating,
+            'student_id': row.student_id,
+            'full_name': row.full_name,
+            'class_id': row.class_id,
+            'class_name': f'{row.grade}{row.class_letter}',
+            'teacher_name': row.teacher_name
+        } for row in rows]
+    else:
+        rows, next_cursor = class_leaderboard(after=after, limit=limit, grade=grade)
+        items = [{
+            'position': row.position,
+            'rank': row.rank,
+            'dense_rank': row.dense_rank,
+            'grade_rank': row.grade_rank,
+            'rating': row.rating,
+            'class_id': row.class_id,
+            'class_name': f'{row.grade}{row.class_letter}',
+            'teacher_name': row.teacher_name
+        } for row in rows]
+
+    response = jsonify({'items': items, 'next_cursor': next_cursor, 'generation': generation})
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/reports')
 @login_required
+@read_only
+@conditional(SchoolClass, Event)
 def reports():
-    classes = SchoolClass.query.all()
-    events = Event.query.all()
+    classes = queries.classes_for_reports()
+    events = queries.all_events()
 
     return render_template('reports.html', classes=classes, events=events)
 
@@ -528,89 +771,118 @@ def reports():
 # ===== API ДЛЯ ОТЧЕТОВ =====
 @app.route('/api/class_report/<int:class_id>')
 @login_required
+@read_only
+@conditional(SchoolClass, Student, Participation, Event)
 def class_report(class_id):
-    school_class = SchoolClass.query.get_or_404(class_id)
-    students = Student.query.filter_by(class_id=class_id).all()
+    SchoolClass.query.get_or_404(class_id)
 
-    report_data = {
-        'class_name': school_class.get_full_name(),
-        'total_rating': school_class.total_rating,
-        'students': [
-            {
-                'name': student.full_name,
-                'personal_rating': student.personal_rating,
+    report_data = None
+    students = []
+    for kind, item in queries.iter_class_report(queries.class_report_rows([class_id])):
+        if kind == 'class':
+            report_data = {'class_name': item['class_name'], 'total_rating': item['total_rating']}
+        else:
+            students.append({
+                'name': item['name'],
+                'personal_rating': item['personal_rating'],
                 'participations': [
-                    {
-                        'event_name': p.event.name,
-                        'points': p.get_points_earned(),
-                        'date': p.created_at.strftime('%Y-%m-%d')
-                    } for p in student.participations if p.approved
+                    {'event_name': p['event_name'], 'points': p['points'], 'date': p['date']}
+                    for p in item['participations']
                 ]
-            } for student in students
-        ]
-    }
+            })
+    report_data['students'] = students
 
     return jsonify(report_data)
 
 
-# ===== ОБНОВЛЕНИЕ БАЗЫ ДАННЫХ =====
-@app.route('/update-db')
-def update_db():
-    """Обновление структуры базы данных"""
-    with app.app_context():
-        # Создаем временную таблицу для событий
-        db.session.execute('''
-            CREATE TABLE IF NOT EXISTS events_new (
-                id INTEGER PRIMARY KEY,
-                name VARCHAR(200) NOT NULL,
-                description TEXT,
-                level VARCHAR(20) NOT NULL,
-                event_type VARCHAR(20) NOT NULL,
-                points INTEGER NOT NULL DEFAULT 0,
-                class_points INTEGER DEFAULT 0,
-                created_by INTEGER NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE,
-                FOREIGN KEY (created_by) REFERENCES users (id)
-            )
-        ''')
-
-        # Копируем данные из старой таблицы
-        db.session.execute('''
-            INSERT INTO events_new (id, name, description, level, event_type, points, created_by, created_at, is_active)
-            SELECT id, name, description, level, event_type, points, created_by, created_at, is_active FROM events
-        ''')
-
-        # Удаляем старую таблицу
-        db.session.execute('DROP TABLE events')
-
-        # Переименовываем новую таблицу
-        db.session.execute('ALTER TABLE events_new RENAME TO events')
-
-        # Создаем таблицу class_points если её нет
-        db.session.execute('''
-            CREATE TABLE IF NOT EXISTS class_points (
-                id INTEGER PRIMARY KEY,
-                class_id INTEGER NOT NULL,
-                points INTEGER NOT NULL,
-                reason VARCHAR(500) NOT NULL,
-                assigned_by INTEGER NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (class_id) REFERENCES school_classes (id),
-                FOREIGN KEY (assigned_by) REFERENCES users (id)
-            )
-        ''')
+@app.route('/api/v2/class_report')
+@login_required
+@read_only
+def class_report_v2():
+    """Потоковый отчет по одному, нескольким или всем классам.
 
-        db.session.commit()
-        flash('База данных успешно обновлена')
-    return redirect(url_for('index'))
+    Параметры: class_id (можно несколько), date_from, date_to (YYYY-MM-DD, включительно),
+    level, format=ndjson|json. При Accept-Encoding: gzip ответ сжимается на лету.
+    """
+    class_ids = request.args.getlist('class_id', type=int) or None
+    if class_ids is None and getattr(current_user, 'role', None) not in ['admin', 'teacher']:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    try:
+        date_from = request.args.get('date_from')
+        date_from = datetime.strptime(date_from, '%Y-%m-%d') if date_from else None
+        date_to = request.args.get('date_to')
+        date_to = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1) if date_to else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Неверный формат даты'}), 400
+
+    output_format = request.args.get('format', 'ndjson')
+    if output_format not in ('ndjson', 'json'):
+        return jsonify({'success': False, 'message': 'Неизвестный формат'}), 400
+
+    rows = queries.class_report_rows(class_ids, date_from=date_from, date_to=date_to,
+                                     level=request.args.get('level') or None)
+    items = queries.iter_class_report(rows)
+    chunks = _report_ndjson(items) if output_format == 'ndjson' else _report_json(items)
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        chunks = _gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+
+def _report_ndjson(items):
+    for kind, item in items:
+        yield json.dumps({'type': kind, **item}, ensure_ascii=False) + '\n'
+
+
+def _report_json(items):
+    """Тот же отчет единым JSON-массивом классов, кодируется по мере чтения строк"""
+    yield '['
+    first_class = True
+    first_student = True
+    for kind, item in items:
+        if kind == 'class':
+            if not first_class:
+                yield ']},'
+            first_class = False
+            first_student = True
+            yield json.dumps(item, ensure_ascii=False)[:-1] + ', "students": ['
+        else:
+            yield ('' if first_student else ',') + json.dumps(item, ensure_ascii=False)
+            first_student = False
+    if not first_class:
+        yield ']}'
+    yield ']'
+
+
+def _gzip_stream(chunks, min_size=16 * 1024):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= min_size:
+            compressed = compressor.compress(b''.join(pending))
+            pending, pending_size = [], 0
+            if compressed:
+                yield compressed
+    yield compressor.compress(b''.join(pending)) + compressor.flush()
 
+
+# ===== ОБНОВЛЕНИЕ БАЗЫ ДАННЫХ =====
 # ===== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ =====
 @app.route('/init-db')
 def init_db():
     with app.app_context():
         db.drop_all()
         db.create_all()
+        stamp_migrations()
 
         admin = User(username='admin', email='admin@school.ru', role='admin')
         admin.set_password('admin123')
@@ -684,6 +956,7 @@ def init_db():
 # ===== МАРШРУТЫ ДЛЯ СБОРА МАКУЛАТУРЫ =====
 @app.route('/paper_collection')
 @login_required
+@read_only
 def paper_collection():
     current_year = datetime.now().year
     """Главная страница сбора макулатуры"""
@@ -697,33 +970,10 @@ def paper_collection():
     else:
         classes = SchoolClass.query.all()
 
-    # Статистика по классам
-    class_stats = []
-    for class_obj in classes:
-        # Общее количество за год
-        total_year = db.session.query(db.func.sum(PaperCollection.kilograms)).filter(
-            PaperCollection.class_id == class_obj.id,
-            PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-        ).scalar() or 0
-
-        # Количество за последнюю сдачу
-        last_collection_date = db.session.query(db.func.max(PaperCollection.collection_date)).filter(
-            PaperCollection.class_id == class_obj.id
-        ).scalar()
-
-        last_collection_total = 0
-        if last_collection_date:
-            last_collection_total = db.session.query(db.func.sum(PaperCollection.kilograms)).filter(
-                PaperCollection.class_id == class_obj.id,
-                PaperCollection.collection_date == last_collection_date
-            ).scalar() or 0
-
-        class_stats.append({
-            'class': class_obj,
-            'total_year': round(total_year, 2),
-            'last_collection_total': round(last_collection_total, 2),
-            'last_collection_date': last_collection_date
-        })
+    # Статистика по классам: один запрос на все классы
+    overview = queries.paper_collection_overview(current_year)
+    empty = {'total_year': 0, 'last_collection_total': 0, 'last_collection_date': None}
+    class_stats = [{'class': class_obj, **overview.get(class_obj.id, empty)} for class_obj in classes]
 
     return render_template('paper_collection/paper_collection.html',
                          classes=classes,
@@ -731,8 +981,34 @@ def paper_collection():
                          current_year=current_year)
 
 
+@app.route('/api/paper_collection/overview')
+@login_required
+@read_only
+def api_paper_collection_overview():
+    """Итоги сбора макулатуры по классам в JSON"""
+    if not getattr(current_user, 'role', None) or current_user.role not in ['admin', 'teacher']:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    year = request.args.get('year', datetime.now().year, type=int)
+    overview = queries.paper_collection_overview(year)
+    if current_user.role == 'teacher' and current_user.managed_class:
+        class_ids = {c.id for c in current_user.managed_class}
+        overview = {class_id: stats for class_id, stats in overview.items() if class_id in class_ids}
+
+    return jsonify({
+        'year': year,
+        'classes': [{
+            'class_id': class_id,
+            'total_year': stats['total_year'],
+            'last_collection_total': stats['last_collection_total'],
+            'last_collection_date': stats['last_collection_date'].isoformat() if stats['last_collection_date'] else None
+        } for class_id, stats in overview.items()]
+    })
+
+
 @app.route('/paper_collection/class/<int:class_id>')
 @login_required
+@read_only
 def paper_collection_class(class_id):
     """Страница сбора макулатуры для конкретного класса"""
     if not getattr(current_user, 'role', None) or current_user.role not in ['admin', 'teacher']:
@@ -749,11 +1025,7 @@ def paper_collection_class(class_id):
         return redirect(url_for('paper_collection'))
 
     # Получаем даты сбора макулатуры
-    collection_dates = db.session.query(PaperCollection.collection_date).filter(
-        PaperCollection.class_id == class_id
-    ).distinct().order_by(PaperCollection.collection_date.desc()).all()
-
-    collection_dates = [date[0] for date in collection_dates]
+    collection_dates = queries.paper_collection_dates(class_id)
 
     # Получаем данные для выбранной даты или последней даты
     selected_date = request.args.get('date')
@@ -786,22 +1058,10 @@ def paper_collection_class(class_id):
     # Статистика
     total_today = sum(item['kilograms'] for item in table_data)
 
-    # Общее за год
-    total_year = db.session.query(db.func.sum(PaperCollection.kilograms)).filter(
-        PaperCollection.class_id == class_id,
-        PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-    ).scalar() or 0
-
-    # Статистика по ученикам за год
-    student_year_stats = db.session.query(
-        PaperCollection.student_id,
-        db.func.sum(PaperCollection.kilograms).label('total_kg')
-    ).filter(
-        PaperCollection.class_id == class_id,
-        PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-    ).group_by(PaperCollection.student_id).all()
-
-    student_stats_dict = {stat.student_id: stat.total_kg for stat in student_year_stats}
+    # Общее за год и статистика по ученикам за год (из сводных таблиц)
+    year_stats = queries.paper_class_year_stats(class_id, datetime.now().year, top=0)
+    total_year = year_stats['total_year']
+    student_stats_dict = year_stats['student_totals']
 
     return render_template('paper_collection/class_collection.html',
                            school_class=school_class,
@@ -833,49 +1093,74 @@ def save_paper_collection():
         return jsonify({'success': False, 'message': 'Неверный формат данных'})
 
     # Проверяем права доступа для учителя
-    school_class = SchoolClass.query.get(class_id)
-    if (getattr(current_user, 'role', None) == 'teacher' and
-            current_user.managed_class and
-            school_class.id not in [c.id for c in current_user.managed_class]):
+    if not _can_edit_paper_class(class_id):
         return jsonify({'success': False, 'message': 'У вас нет доступа к этому классу'})
 
-    # Обрабатываем данные учеников
+    # Обрабатываем данные учеников (пустое поле или 0 удаляет запись)
+    kilograms_by_student = {}
     for key, value in request.form.items():
         if key.startswith('kilograms_'):
-            student_id = int(key.replace('kilograms_', ''))
             try:
-                kilograms = float(value) if value else 0
+                kilograms_by_student[int(key.replace('kilograms_', ''))] = float(value) if value else 0
             except ValueError:
                 continue
 
-            if kilograms > 0:
-                # Ищем существующую запись
-                existing = PaperCollection.query.filter_by(
-                    student_id=student_id,
-                    class_id=class_id,
-                    collection_date=collection_date
-                ).first()
-
-                if existing:
-                    # Обновляем существующую запись
-                    existing.kilograms = kilograms
-                else:
-                    # Создаем новую запись
-                    collection = PaperCollection(
-                        student_id=student_id,
-                        class_id=class_id,
-                        kilograms=kilograms,
-                        collection_date=collection_date,
-                        created_by=current_user.id
-                    )
-                    db.session.add(collection)
-
-    db.session.commit()
+    save_paper_collections(
+        _paper_sheet_entries(class_id, collection_date, kilograms_by_student),
+        created_by=current_user.id
+    )
     return jsonify({'success': True, 'message': 'Данные успешно сохранены'})
 
 
+def _can_edit_paper_class(class_id):
+    """Учитель может вносить данные только по своему классу"""
+    if (getattr(current_user, 'role', None) == 'teacher' and
+            current_user.managed_class and
+            class_id not in [c.id for c in current_user.managed_class]):
+        return False
+    return True
+
+
+def _paper_sheet_entries(class_id, collection_date, kilograms_by_student):
+    """Строки ведомости для save_paper_collections (только ученики класса)"""
+    student_ids = set(db.session.scalars(
+        db.select(Student.id).where(Student.class_id == class_id)
+    ))
+    return [(class_id, collection_date, student_id, kilograms)
+            for student_id, kilograms in kilograms_by_student.items()
+            if student_id in student_ids]
+
+
+@app.route('/api/paper_collection/batch', methods=['POST'])
+@login_required
+def api_save_paper_collection_batch():
+    """Сохранение нескольких ведомостей:
+    {"sheets": [{"class_id": 1, "collection_date": "2024-10-01", "kilograms": {"5": 2.5, "6": 0}}, ...]}
+    """
+    if not getattr(current_user, 'role', None) or current_user.role not in ['admin', 'teacher']:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+
+    data = request.get_json(silent=True) or {}
+    entries = []
+    try:
+        for sheet in data.get('sheets', []):
+            class_id = int(sheet['class_id'])
+            collection_date = datetime.strptime(sheet['collection_date'], '%Y-%m-%d').date()
+            kilograms_by_student = {int(student_id): float(kilograms or 0)
+                                    for student_id, kilograms in sheet.get('kilograms', {}).items()}
+            if not _can_edit_paper_class(class_id):
+                return jsonify({'success': False, 'message': 'У вас нет доступа к этому классу'}), 403
+            entries.extend(_paper_sheet_entries(class_id, collection_date, kilograms_by_student))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify({'success': False, 'message': 'Неверный формат данных'}), 400
+
+    result = save_paper_collections(entries, created_by=current_user.id)
+    return jsonify({'success': True, **result})
+
+
 @app.route('/paper_collection/class/<int:class_id>/stats')
 @login_required
+@read_only
 def paper_collection_stats(class_id):
     """Подробная статистика по сбору макулатуры"""
     if not getattr(current_user, 'role', None) or current_user.role not in ['admin', 'teacher']:
@@ -891,35 +1176,13 @@ def paper_collection_stats(class_id):
         flash('У вас нет доступа к этому классу')
         return redirect(url_for('paper_collection'))
 
-    # Статистика по месяцам
-    monthly_stats = db.session.query(
-        db.func.strftime('%Y-%m', PaperCollection.collection_date).label('month'),
-        db.func.sum(PaperCollection.kilograms).label('total_kg')
-    ).filter(
-        PaperCollection.class_id == class_id,
-        PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-    ).group_by('month').order_by('month').all()
-
-    # Топ учеников
-    top_students = db.session.query(
-        Student,
-        db.func.sum(PaperCollection.kilograms).label('total_kg')
-    ).join(PaperCollection).filter(
-        PaperCollection.class_id == class_id,
-        PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-    ).group_by(Student.id).order_by(db.desc('total_kg')).limit(10).all()
-
-    # Общая статистика
-    total_year = db.session.query(db.func.sum(PaperCollection.kilograms)).filter(
-        PaperCollection.class_id == class_id,
-        PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-    ).scalar() or 0
-
-    collection_days = db.session.query(PaperCollection.collection_date).filter(
-        PaperCollection.class_id == class_id,
-        PaperCollection.collection_date >= datetime(datetime.now().year, 1, 1).date()
-    ).distinct().count()
+    # Статистика по месяцам, топ учеников и общие итоги (из сводных таблиц)
     current_year = datetime.now().year
+    year_stats = queries.paper_class_year_stats(class_id, current_year)
+    monthly_stats = year_stats['monthly']
+    top_students = year_stats['top_students']
+    total_year = year_stats['total_year']
+    collection_days = year_stats['collection_days']
     avg_per_day = total_year / collection_days if collection_days > 0 else 0
 
     return render_template('paper_collection/class_stats.html',
@@ -930,17 +1193,458 @@ def paper_collection_stats(class_id):
                          collection_days=collection_days,
                          avg_per_day=round(avg_per_day, 2),
                          current_year=current_year)
-with app.app_context():
+
+
+# ===== ФОНОВЫЕ ЗАДАЧИ =====
+# Тяжелые операции выполняет рабочий процесс (flask jobs-worker): маршрут ставит
+# задачу и сразу возвращает ее id, ход выполнения опрашивается через /api/jobs/<id>
+app.config.setdefault('JOB_FILES_PATH',
+                      os.environ.get('JOB_FILES_PATH', os.path.join(app.instance_path, 'job_files')))
+
+# Пересборка рейтингов ждет столько секунд, чтобы слить записи подряд в одну
+RANKINGS_REFRESH_DELAY = 2
+
+# Заголовок страницы задачи и куда вернуться после нее
+JOB_PAGES = {
+    'import_roster': ('Импорт учеников', 'classes'),
+    'regenerate_credentials': ('Выгрузка логинов и паролей', 'classes'),
+    'register_participations': ('Регистрация участия', 'events'),
+    'recompute_ratings': ('Пересчет рейтингов', 'ratings'),
+    'refresh_rankings': ('Пересборка рейтингов', 'ratings'),
+    'flush_ratings': ('Отложенный пересчет рейтингов', 'ratings'),
+}
+
+
+def _idempotency_key():
+    """Ключ из заголовка Idempotency-Key, поля формы или JSON idempotency_key"""
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    if not key and request.is_json:
+        key = (request.get_json(silent=True) or {}).get('idempotency_key')
+    return str(key)[:100] if key else None
+
+
+def _enqueue(kind, **params):
+    return enqueue(kind, params, idempotency_key=_idempotency_key(), created_by=current_user.get_id())
+
+
+def _job_accepted(queued, message):
+    return jsonify({
+        'success': True,
+        'message': message,
+        'job_id': queued.id,
+        'status': queued.status,
+        'status_url': url_for('api_job_status', job_id=queued.id)
+    }), 202
+
+
+def _visible_job(job_id):
+    """Задача, если ее поставил текущий пользователь или он администратор"""
+    queued = Job.query.get_or_404(job_id)
+    if queued.created_by != current_user.get_id() and getattr(current_user, 'role', None) != 'admin':
+        return None
+    return queued
+
+
+def _job_file(queued):
+    """Путь к файлу результата задачи или None"""
+    result = json.loads(queued.result) if queued.result else {}
+    if queued.status != 'done' or not result.get('file'):
+        return None
+    path = os.path.join(app.config['JOB_FILES_PATH'], os.path.basename(result['file']))
+    return path if os.path.exists(path) else None
+
+
+def _job_payload(queued):
+    data = queued.to_dict()
+    data['download_url'] = url_for('download_job_file', job_id=queued.id) if _job_file(queued) else None
+    return data
+
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+@read_only
+def job_status(job_id):
+    queued = _visible_job(job_id)
+    if queued is None:
+        flash('Недостаточно прав')
+        return redirect(url_for('dashboard'))
+    title, back_endpoint = JOB_PAGES.get(queued.kind, (queued.kind, 'dashboard'))
+    return render_template('jobs/job.html', job=_job_payload(queued), title=title,
+                           back_url=url_for(back_endpoint))
+
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+@read_only
+def api_job_status(job_id):
+    """Состояние задачи для опроса: статус, прогресс, результат или ошибка"""
+    queued = _visible_job(job_id)
+    if queued is None:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+    return jsonify({'success': True, 'job': _job_payload(queued)})
+
+
+@app.route('/api/jobs/<int:job_id>/download')
+@login_required
+def download_job_file(job_id):
+    """Файл результата задачи; в нем пароли, поэтому после скачивания он удаляется"""
+    queued = _visible_job(job_id)
+    if queued is None:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+    path = _job_file(queued)
+    if path is None:
+        return jsonify({'success': False, 'message': 'Файл уже скачан или удален'}), 404
+
+    # Файл отдается с диска по частям. Удаляется он, только когда клиент получил его
+    # целиком: при обрыве скачивание можно повторить (иначе пароли уже не получить).
+    # Нескачанные файлы удаляет flask purge-jobs.
+    response = send_file(path, as_attachment=True, download_name=json.loads(queued.result)['filename'],
+                         max_age=0, conditional=False)
+    body, sent = response.response, []
+
+    def stream():
+        yield from body
+        sent.append(True)
+
+    response.response = stream()
+    # Иначе Werkzeug отдает итератор серверу напрямую и не вызывает call_on_close
+    response.direct_passthrough = False
+    response.call_on_close(lambda: sent and _remove_file(path))
+    return response
+
+
+def _remove_file(path):
     try:
-        # Проверяем существование таблицы paper_collections
-        result = db.session.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='paper_collections'")
-        if not result.fetchone():
-            print("Создание таблицы для макулатуры...")
-            db.create_all()
-            print("Таблица paper_collections создана")
-    except Exception as e:
-        print(f"Ошибка при проверке таблицы макулатуры: {e}")
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@app.route('/api/jobs/recompute_ratings', methods=['POST'])
+@login_required
+def api_recompute_ratings():
+    """Полный пересчет рейтингов в фоне"""
+    if getattr(current_user, 'role', None) != 'admin':
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+    return _job_accepted(_enqueue('recompute_ratings'), 'Пересчет рейтингов поставлен в очередь')
+
+
+# Повтор импорта создал бы учеников второй раз
+@job('import_roster', max_attempts=1)
+def _import_roster_job(context, class_id, student_names):
+    school_class = db.session.get(SchoolClass, class_id)
+    if school_class is None:
+        raise LookupError(f'Класс {class_id} удален')
+    context.progress(0, len(student_names))
+    students_data = import_students(student_names, school_class.id, school_class.get_full_name())
+    context.progress(len(students_data))
+    return {
+        'class_id': school_class.id,
+        'class_name': school_class.get_full_name(),
+        'imported': len(students_data),
+        'students': [{'full_name': data['full_name'], 'login': data['login']} for data in students_data]
+    }
+
+
+# Повтор безопасен: до записи файла пароли в БД не меняются, повтор сгенерирует новые
+@job('regenerate_credentials')
+def _regenerate_credentials_job(context, class_id=None):
+    students = _credential_rows(class_id=class_id)
+    if class_id is not None:
+        school_class = db.session.get(SchoolClass, class_id)
+        filename, write = f'logins_{school_class.get_full_name()}.csv', _write_credentials_csv
+    else:
+        filename, write = 'logins_all.zip', _write_credentials_zip
+
+    done = 0
+    hashes = []
+
+    def on_batch(count):
+        nonlocal done
+        done += count
+        context.progress(done)
+
+    def batches():
+        # Новые пароли хешируются в пуле процессов; хеши копятся до конца записи файла
+        for batch in iter_new_credentials(students):
+            hashes.extend((student.id, password_hash) for student, _, password_hash in batch)
+            yield [(student, password) for student, password, _ in batch]
+
+    context.progress(0, len(students))
+    os.makedirs(app.config['JOB_FILES_PATH'], exist_ok=True)
+    stored = f'job-{context.job_id}{os.path.splitext(filename)[1]}'
+    path = os.path.join(app.config['JOB_FILES_PATH'], stored)
+    try:
+        with open(path, 'wb') as file:
+            write(file, batches(), on_batch)
+        # Пароли меняются одним коммитом, только когда файл с ними записан целиком
+        save_password_hashes(hashes)
+    except Exception:
+        # Файл с паролями, которые не сохранились в БД, никому не нужен
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return {'file': stored, 'filename': filename, 'students': len(students)}
+
+
+# Повтор безопасен: уже зарегистрированные ученики пропускаются
+@job('register_participations')
+def _register_participations_job(context, event_id, entries, news_link=None, participants_count=None,
+                                 description=None, approved_by=None, class_ids=None):
+    event = db.session.get(Event, event_id)
+    if event is None:
+        raise LookupError(f'Мероприятие {event_id} удалено')
+    context.progress(0, len(entries))
+    result = register_participations(
+        event, [tuple(entry) for entry in entries],
+        news_link=news_link,
+        participants_count=participants_count,
+        description=description,
+        approved_by=approved_by,
+        class_ids=class_ids
+    )
+    context.progress(len(entries))
+    return {'event_id': event_id, **result}
+
+
+@job('refresh_rankings')
+def _refresh_rankings_job(context):
+    return {'generation': refresh_rankings()}
+
+
+# Страницы рейтингов только читают последнюю сборку; после записи ее обновляет рабочий
+@on_rankings_stale
+def _schedule_rankings_refresh():
+    enqueue_once('refresh_rankings', delay=RANKINGS_REFRESH_DELAY)
+
+
+@job('flush_ratings')
+def _flush_ratings_job(context):
+    marks = rating_scheduler.flush(db.session)
+    db.session.commit()
+    return {'marks': marks}
+
+
+# Страховка таймера процесса: если процесс, отложивший пересчет, завершится,
+# пометки из dirty_ratings досчитает рабочий очереди
+@on_ratings_deferred
+def _schedule_ratings_flush():
+    enqueue_once('flush_ratings', delay=RATING_RECOMPUTE_MAX_WAIT)
+
+
+@job('recompute_ratings')
+def _recompute_ratings_job(context):
+    context.progress(0, 3)
+    students_fixed = len(recompute_all(fix=True))
+    context.progress(1)
+    classes_fixed = len(recompute_class_ratings(fix=True))
+    context.progress(2)
+    generation = refresh_rankings()
+    context.progress(3)
+    return {'students_fixed': students_fixed, 'classes_fixed': classes_fixed, 'generation': generation}
+
+
+# ===== КОМАНДЫ CLI =====
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='Только показать непримененные миграции')
+def migrate_command(status):
+    """Применить миграции схемы БД (запускать до старта рабочих процессов)"""
+    if status:
+        pending = pending_migrations()
+        for version, name in pending:
+            click.echo(f'{version:04d} {name}')
+        click.echo(f'Непримененных миграций: {len(pending)}')
+        return
+    done = migrate(echo=click.echo)
+    click.echo(f'Применено миграций: {len(done)}')
+
+
+@app.cli.command('recompute-ratings')
+@click.option('--dry-run', is_flag=True, help='Только показать расхождения, не исправлять')
+def recompute_ratings_command(dry_run):
+    """Пересчитать личные рейтинги с нуля и показать расхождения"""
+    drift = recompute_all(fix=not dry_run)
+    for item in drift:
+        click.echo(f"{item['student_id']}\t{item['full_name']}\t{item['stored']} -> {item['expected']}")
+    action = 'найдено' if dry_run else 'исправлено'
+    click.echo(f'Расхождений {action}: {len(drift)}')
+
+
+@app.cli.command('recompute-class-ratings')
+@click.option('--dry-run', is_flag=True, help='Только показать расхождения, не исправлять')
+def recompute_class_ratings_command(dry_run):
+    """Пересчитать рейтинги всех классов одним запросом"""
+    changes = recompute_class_ratings(fix=not dry_run)
+    for item in changes:
+        click.echo(f"{item['class_id']}\t{item['class_name']}\t{item['stored']} -> {item['expected']}")
+    action = 'найдено' if dry_run else 'исправлено'
+    click.echo(f'Расхождений {action}: {len(changes)}')
+
+
+# Страницы, запросы которых проверяет index-advisor; id подставляются из БД
+ADVISOR_PATHS = (
+    '/dashboard', '/classes', '/class/{class_id}/students', '/class_points_history/{class_id}',
+    '/events', '/event/{event_id}/participate', '/ratings', '/api/ratings/students', '/api/ratings/classes',
+    '/reports', '/api/class_report/{class_id}', '/portfolio/{student_id}',
+    '/paper_collection', '/paper_collection/class/{class_id}', '/paper_collection/class/{class_id}/stats',
+)
+
+
+@app.cli.command('index-advisor')
+@click.option('--path', 'paths', multiple=True, help='Проверить только эти страницы')
+def index_advisor_command(paths):
+    """Выполнить запросы страниц под EXPLAIN QUERY PLAN и показать полные просмотры таблиц"""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('index-advisor поддерживает только SQLite')
+
+    admin = User.query.filter_by(role='admin').first()
+    if admin is None:
+        raise click.ClickException('В базе нет администратора')
+    ids = {
+        'class_id': db.session.scalar(db.select(db.func.min(SchoolClass.id))) or 0,
+        'student_id': db.session.scalar(db.select(db.func.min(Student.id))) or 0,
+        'event_id': db.session.scalar(db.select(db.func.min(Event.id))) or 0,
+    }
+
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['_user_id'] = admin.get_id()
+        client_session['_fresh'] = True
+
+    with queries.capture_statements() as statements:
+        for path in paths or ADVISOR_PATHS:
+            client.get(path.format(**ids))
+        recompute_all(fix=False)
+        recompute_class_ratings(fix=False)
+
+    scans = queries.explain_full_scans(statements)
+    for scan in scans:
+        click.echo(f"{scan['detail']}\n    {' '.join(scan['sql'].split())}\n")
+    click.echo(f'Запросов проверено: {len(statements)}, полных просмотров таблиц: {len(scans)}')
+
+
+@app.cli.command('slow-routes')
+@click.option('--window', default=15, show_default=True, help='За сколько последних минут')
+@click.option('--limit', default=10, show_default=True, help='Сколько маршрутов показать')
+def slow_routes_command(window, limit):
+    """Самые медленные маршруты (по p95) и кандидаты N+1 за последние минуты"""
+    if instrumentation.store is None:
+        raise click.ClickException('Записи запросов отключены (METRICS_PATH)')
+    seconds = window * 60
+    report = instrumentation.store.slowest(seconds, limit=limit)
+    if not report:
+        click.echo(f'Нет запросов за последние {window} мин.')
+        return
+
+    click.echo(f"{'маршрут':<32}{'запросов':>9}{'p50 мс':>9}{'p95 мс':>9}{'max мс':>9}"
+               f"{'SQL':>6}{'SQL мс':>9}{'шаблон мс':>11}{'коммитов':>10}{'N+1':>5}")
+    for item in report:
+        click.echo(f"{item['endpoint']:<32}{item['requests']:>9}{item['p50'] * 1000:>9.1f}"
+                   f"{item['p95'] * 1000:>9.1f}{item['max'] * 1000:>9.1f}{item['queries']:>6.1f}"
+                   f"{item['sql_time'] * 1000:>9.1f}{item['render_time'] * 1000:>11.1f}"
+                   f"{item['commits']:>10.1f}{item['n_plus_one']:>5}")
+
+    repeated = instrumentation.store.repeated_statements(seconds, limit=limit)
+    if repeated:
+        click.echo('')
+        click.echo('Повторяющиеся запросы (кандидаты N+1):')
+        for endpoint, statement, requests_count, max_count in repeated:
+            click.echo(f'{endpoint}: до {max_count} раз за запрос, в {requests_count} запросах')
+            click.echo(f"    {' '.join(statement.split())}")
+
+
+@app.cli.command('rebuild-paper-rollups')
+def rebuild_paper_rollups_command():
+    """Пересобрать сводные таблицы сбора макулатуры"""
+    days = rebuild_paper_rollups()
+    paper_overview_cache.clear()
+    click.echo(f'Сводные таблицы пересобраны, дней сбора: {days}')
+
+
+
+
+@app.cli.command('refresh-rankings')
+def refresh_rankings_command():
+    """Пересобрать таблицы рейтингов учеников и классов"""
+    generation = refresh_rankings()
+    click.echo(f'Рейтинги пересобраны (сборка {generation})')
+
+
+@app.cli.command('jobs-worker')
+@click.option('--processes', default=2, show_default=True, help='Число рабочих процессов')
+def jobs_worker_command(processes):
+    """Запустить рабочие процессы очереди фоновых задач (Ctrl+C - остановить)"""
+    # Кеш в памяти у каждого процесса свой: сброс из рабочего процесса веб-процессы не увидят
+    if app.config['CACHE_URL'] in ('', 'memory://'):
+        raise click.ClickException('Рабочим процессам нужен общий кеш: задайте CACHE_URL, например '
+                                   'sqlite:///instance/cache.db')
+    pool = start_worker_pool(app, processes=processes)
+    click.echo(f'Рабочих процессов: {len(pool)}')
+
+    # SIGTERM от супервизора останавливает и дочерние процессы
+    def stop(signum, frame):
+        for process in pool:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in pool:
+            process.join()
+    except KeyboardInterrupt:
+        for process in pool:
+            process.join()
+
+
+@app.cli.command('purge-jobs')
+@click.option('--days', default=JOB_RETENTION_DAYS, show_default=True, help='Старше скольких дней')
+def purge_jobs_command(days):
+    """Удалить давно завершенные задачи и их нескачанные файлы"""
+    removed = purge_finished(days)
+    files = 0
+    folder = app.config['JOB_FILES_PATH']
+    if os.path.isdir(folder):
+        before = time.time() - days * 24 * 3600
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.getmtime(path) < before:
+                _remove_file(path)
+                files += 1
+    click.echo(f'Удалено задач: {removed}, файлов: {files}')
+
+
+@app.cli.command('import-roster')
+@click.argument('roster', type=click.Path(exists=True, dir_okay=False))
+@click.option('--grade', required=True, help='Класс (цифра), например 5')
+@click.option('--name', required=True, help='Буква класса, например А')
+@click.option('--workers', type=int, default=None, help='Число процессов для хеширования паролей')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='CSV для сохранения логинов и паролей')
+def import_roster_command(roster, grade, name, workers, output):
+    """Импортировать список учеников из CSV/XLSX (класс создается при необходимости)"""
+    with open(roster, 'rb') as stream:
+        student_names = read_roster(stream, roster)
+
+    school_class = SchoolClass.query.filter_by(grade=grade, name=name).first()
+    if not school_class:
+        school_class = SchoolClass(name=name, grade=grade)
+        db.session.add(school_class)
+        db.session.commit()
+
+    students_data = import_students(student_names, school_class.id, school_class.get_full_name(), workers=workers)
+
+    if output:
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ФИО', 'Логин', 'Пароль', 'Класс'])
+            for data in students_data:
+                writer.writerow([data['full_name'], data['login'], data['password'], school_class.get_full_name()])
+
+    click.echo(f'Класс {school_class.get_full_name()}: добавлено учеников {len(students_data)}')
+
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-    app.run(debug=True, host ='0.0.0.0')
\ No newline at end of file
+        migrate(echo=print)
+    # Сервер разработки выполняет фоновые задачи сам (в процессе с перезагрузчиком)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_worker_thread(app)
+    app.run(debug=True, host ='0.0.0.0')
@@ -0,0 +1,403 @@
+# Нагрузочный прогон приложения смесью запросов реального дня: «день результатов»
+# (ученики смотрят рейтинг и портфолио, учителя регистрируют участие) и «день сбора
+# макулатуры» (учителя сохраняют ведомости). Запросы идут через тестовый клиент WSGI
+# или локальный HTTP-сервер на базе из bench/seed.py. Расписание запросов строится
+# детерминированно и может быть сохранено и воспроизведено.
+#
+#   python bench/load_test.py --traffic results_day --concurrency 8 --requests 2000
+#   python bench/load_test.py --traffic paper_day --mode server --profile default
+#   python bench/load_test.py --replay schedule.json --url http://127.0.0.1:5000
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scenarios import CLASSES_PER_SCHOOL, prepare_database  # noqa: E402
+from seed import BENCH_PASSWORD, EVENTS_PER_SCHOOL, PAPER_DAYS, STUDENTS_PER_CLASS  # noqa: E402
+
+LOCKED_MESSAGE = 'database is locked'
+
+
+def _student(rng, pool):
+    student_id = rng.choice(pool['students'])
+    return f'student{student_id}', student_id
+
+
+def _teacher(rng, pool):
+    class_id = rng.choice(pool['classes'])
+    return f'teacher{class_id}', class_id
+
+
+def _class_students(class_id):
+    first = (class_id - 1) * STUDENTS_PER_CLASS + 1
+    return range(first, first + STUDENTS_PER_CLASS)
+
+
+def _ratings(rng, pool):
+    user, _ = _student(rng, pool)
+    return user, 'GET', '/ratings', None, None
+
+
+def _portfolio(rng, pool):
+    user, student_id = _student(rng, pool)
+    return user, 'GET', f'/portfolio/{student_id}', None, None
+
+
+def _student_dashboard(rng, pool):
+    user, _ = _student(rng, pool)
+    return user, 'GET', '/dashboard', None, None
+
+
+def _register_participations(rng, pool):
+    user, class_id = _teacher(rng, pool)
+    school = (class_id - 1) // CLASSES_PER_SCHOOL
+    event_id = school * EVENTS_PER_SCHOOL + rng.randrange(EVENTS_PER_SCHOOL) + 1
+    students = rng.sample(list(_class_students(class_id)), rng.randrange(1, 8))
+    participants = [{'student_id': student_id, 'place': rng.choice((None, None, 4, 3, 2, 1))}
+                    for student_id in students]
+    return user, 'POST', f'/api/event/{event_id}/participations', None, {
+        'participants': participants, 'participants_count': len(participants), 'description': 'load test'
+    }
+
+
+def _class_report(rng, pool):
+    user, class_id = _teacher(rng, pool)
+    return user, 'GET', f'/api/class_report/{class_id}', None, None
+
+
+def _paper_sheet(rng, pool):
+    user, class_id = _teacher(rng, pool)
+    return user, 'GET', f'/paper_collection/class/{class_id}', None, None
+
+
+def _paper_save(rng, pool):
+    user, class_id = _teacher(rng, pool)
+    form = {'class_id': str(class_id),
+            'collection_date': f"{pool['year']}-{rng.randrange(PAPER_DAYS) + 1:02d}-15"}
+    for student_id in _class_students(class_id):
+        if rng.random() < 0.7:
+            form[f'kilograms_{student_id}'] = f'{rng.uniform(0.5, 15):.1f}'
+    return user, 'POST', '/paper_collection/save', form, None
+
+
+def _paper_overview(rng, pool):
+    user, _ = _teacher(rng, pool)
+    return user, 'GET', '/api/paper_collection/overview', None, None
+
+
+# Смеси запросов: (вес, построитель запроса)
+TRAFFIC = {
+    'results_day': (
+        (45, _ratings),
+        (25, _portfolio),
+        (15, _student_dashboard),
+        (10, _register_participations),
+        (5, _class_report),
+    ),
+    'paper_day': (
+        (25, _paper_save),
+        (20, _paper_sheet),
+        (15, _paper_overview),
+        (25, _ratings),
+        (15, _student_dashboard),
+    ),
+}
+
+
+def build_schedule(traffic, requests, schools, year, users=200, teachers=20, seed=0):
+    """Детерминированное расписание: [{'user', 'method', 'path', 'form', 'json'}, ...]"""
+    rng = random.Random(seed)
+    classes = schools * CLASSES_PER_SCHOOL
+    pool = {
+        'students': rng.sample(range(1, classes * STUDENTS_PER_CLASS + 1), min(users, classes * STUDENTS_PER_CLASS)),
+        'classes': rng.sample(range(1, classes + 1), min(teachers, classes)),
+        'year': year,
+    }
+    weights, builders = zip(*TRAFFIC[traffic])
+    schedule = []
+    for builder in rng.choices(builders, weights=weights, k=requests):
+        user, method, path, form, body = builder(rng, pool)
+        schedule.append({'user': user, 'method': method, 'path': path, 'form': form, 'json': body})
+    return schedule
+
+
+class ClientSession:
+    """Пользователь, работающий через тестовый клиент WSGI"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None, body=None):
+        response = self.client.open(path, method=method, data=form, json=body)
+        return response.status_code, response.get_data()
+
+
+class HttpSession:
+    """Пользователь, работающий с HTTP-сервером (cookie сессии, без перехода по редиректам)"""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect
+        )
+
+    def request(self, method, path, form=None, body=None):
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif body is not None:
+            data, headers = json.dumps(body).encode(), {'Content-Type': 'application/json'}
+        request = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+class Stats:
+    """Время ответов и ошибки по маршрутам (общие для всех потоков)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def _route(self, route):
+        return self.routes.setdefault(route, {'timings': [], 'errors': 0, 'locked': 0})
+
+    def add(self, route, seconds, status, body):
+        with self._lock:
+            item = self._route(route)
+            item['timings'].append(seconds)
+            if status >= 400:
+                item['errors'] += 1
+            # Без доступа к процессу сервера (--url) блокировку видно только по тексту ответа
+            if status >= 500 and LOCKED_MESSAGE.encode() in body:
+                item['locked'] += 1
+
+    def add_locked(self, route):
+        with self._lock:
+            self._route(route)['locked'] += 1
+
+
+def route_key(method, path):
+    """Маршрут без идентификаторов: GET /portfolio/17 -> GET /portfolio/<id>"""
+    path = urllib.parse.urlsplit(path).path
+    return f"{method} {'/'.join('<id>' if part.isdigit() else part for part in path.split('/'))}"
+
+
+class SessionPool:
+    """Вошедшие в систему сессии пользователей; сессию одновременно использует один поток"""
+
+    def __init__(self, factory, stats):
+        self.factory = factory
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, user, record=True):
+        with self._lock:
+            idle = self._idle.get(user)
+            if idle:
+                return idle.pop()
+        session = self.factory()
+        started = time.perf_counter()
+        status, body = session.request('POST', '/login', {'username': user, 'password': BENCH_PASSWORD})
+        if record:
+            self.stats.add(route_key('POST', '/login'), time.perf_counter() - started, status, body)
+        return session
+
+    def release(self, user, session):
+        with self._lock:
+            self._idle.setdefault(user, []).append(session)
+
+    def login_all(self, users, concurrency):
+        """Заранее войти всеми пользователями (вход в замер не попадает)"""
+        _in_threads([lambda user=user: self.release(user, self.acquire(user, record=False)) for user in users],
+                    concurrency)
+
+
+def _in_threads(tasks, concurrency):
+    tasks = iter(tasks)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                task = next(tasks, None)
+            if task is None:
+                return
+            task()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_load(schedule, pool, concurrency, stats):
+    """Выполнить расписание в concurrency потоках; возвращает время прогона в секундах"""
+
+    def send(item):
+        session = pool.acquire(item['user'])
+        started = time.perf_counter()
+        status, body = session.request(item['method'], item['path'], item['form'], item['json'])
+        stats.add(route_key(item['method'], item['path']), time.perf_counter() - started, status, body)
+        pool.release(item['user'], session)
+
+    started = time.perf_counter()
+    _in_threads([lambda item=item: send(item) for item in schedule], concurrency)
+    return time.perf_counter() - started
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(stats, seconds):
+    routes = {}
+    for route, item in sorted(stats.routes.items()):
+        timings = sorted(item['timings'])
+        if not timings:
+            continue
+        routes[route] = {
+            'requests': len(timings),
+            'per_s': round(len(timings) / seconds, 1),
+            'p50_ms': round(_percentile(timings, 0.50) * 1000, 2),
+            'p95_ms': round(_percentile(timings, 0.95) * 1000, 2),
+            'p99_ms': round(_percentile(timings, 0.99) * 1000, 2),
+            'errors': item['errors'],
+            'locked': item['locked'],
+        }
+    total = sum(route['requests'] for route in routes.values())
+    return {'seconds': round(seconds, 2), 'requests': total, 'per_s': round(total / seconds, 1), 'routes': routes}
+
+
+def print_summary(summary, stream=sys.stderr):
+    print(f"{'маршрут':<44}{'запросов':>9}{'в с':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"
+          f"{'ошибок':>8}{'locked':>8}", file=stream)
+    for route, item in summary['routes'].items():
+        print(f"{route:<44}{item['requests']:>9}{item['per_s']:>8.1f}{item['p50_ms']:>9.1f}"
+              f"{item['p95_ms']:>9.1f}{item['p99_ms']:>9.1f}{item['errors']:>8}{item['locked']:>8}", file=stream)
+    print(f"Всего: {summary['requests']} запросов за {summary['seconds']} с, {summary['per_s']} в секунду",
+          file=stream)
+
+
+def _watch_lock_errors(app, stats):
+    """Считать ошибки блокировки SQLite по исключениям приложения"""
+    from flask import got_request_exception, request
+    from sqlalchemy.exc import OperationalError
+
+    def on_exception(sender, exception, **extra):
+        if isinstance(exception, OperationalError) and LOCKED_MESSAGE in str(exception):
+            stats.add_locked(route_key(request.method, request.path))
+
+    got_request_exception.connect(on_exception, app, weak=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон смесью запросов реального дня')
+    parser.add_argument('--traffic', choices=sorted(TRAFFIC), default='results_day')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=200, help='Сколько разных учеников в смеси')
+    parser.add_argument('--teachers', type=int, default=20, help='Сколько разных учителей в смеси')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--schools', type=int, default=1)
+    parser.add_argument('--year', type=int, default=datetime.now().year)
+    parser.add_argument('--mode', choices=('client', 'server'), default='client',
+                        help='client - тестовый клиент WSGI, server - локальный HTTP-сервер')
+    parser.add_argument('--url', help='Уже запущенный сервер (на базе bench/seed.py с теми же параметрами)')
+    parser.add_argument('--profile', help='DATABASE_PROFILE приложения (default, sqlite)')
+    parser.add_argument('--cache-url', help='CACHE_URL приложения')
+    parser.add_argument('--save-schedule', help='Сохранить расписание запросов в файл')
+    parser.add_argument('--replay', help='Воспроизвести сохраненное расписание')
+    parser.add_argument('--output', help='Записать JSON со сводкой в файл')
+    parser.add_argument('--with-logins', action='store_true',
+                        help='Входить в систему во время прогона (по умолчанию все входят заранее)')
+    parser.add_argument('--job-workers', type=int, default=1,
+                        help='Потоков очереди фоновых задач в процессе приложения (0 - задачи не выполнять)')
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay, encoding='utf-8') as file:
+            schedule = json.load(file)
+    else:
+        schedule = build_schedule(args.traffic, args.requests, args.schools, args.year,
+                                  users=args.users, teachers=args.teachers, seed=args.seed)
+    if args.save_schedule:
+        with open(args.save_schedule, 'w', encoding='utf-8') as file:
+            json.dump(schedule, file, ensure_ascii=False)
+
+    stats = Stats()
+    server = None
+    if args.url:
+        def session_factory():
+            return HttpSession(args.url)
+    else:
+        if args.profile:
+            os.environ['DATABASE_PROFILE'] = args.profile
+        if args.cache_url:
+            os.environ['CACHE_URL'] = args.cache_url
+        app, _ = prepare_database(args.schools, args.seed, args.year)
+        _watch_lock_errors(app, stats)
+        # Регистрация участия уходит в очередь: ее запись идет параллельно с запросами
+        from jobs import start_worker_thread
+        for _ in range(args.job_workers):
+            start_worker_thread(app)
+        if args.mode == 'server':
+            from werkzeug.serving import WSGIRequestHandler, make_server
+
+            class QuietHandler(WSGIRequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+
+            server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_port}'
+
+            def session_factory():
+                return HttpSession(base_url)
+        else:
+            def session_factory():
+                return ClientSession(app)
+
+    pool = SessionPool(session_factory, stats)
+    try:
+        if not args.with_logins:
+            pool.login_all(sorted({item['user'] for item in schedule}), args.concurrency)
+        seconds = run_load(schedule, pool, args.concurrency, stats)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    summary = summarize(stats, seconds)
+    summary['settings'] = {
+        'traffic': None if args.replay else args.traffic, 'replay': args.replay,
+        'concurrency': args.concurrency, 'mode': 'url' if args.url else args.mode,
+        'profile': args.profile, 'cache_url': args.cache_url, 'schools': args.schools,
+        'with_logins': args.with_logins, 'job_workers': 0 if args.url else args.job_workers,
+    }
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Нагрузочный тест блокировок SQLite: параллельные писатели (регистрация участия
+# с обновлением рейтинга) и читатели (рейтинг класса) на профилях 'default' и 'sqlite'.
+#
+#   python bench/lock_contention.py --writers 4 --readers 4 --seconds 5
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, exc, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import PROFILES, apply_pragmas, engine_options  # noqa: E402
+from models import db  # noqa: E402
+
+STUDENTS = 500
+
+WRITE_SQL = (
+    text('SELECT id FROM students WHERE id = :student_id'),
+    text('INSERT INTO participations (event_id, student_id, place, approved, created_at) '
+         'VALUES (1, :student_id, NULL, 1, :now)'),
+    text('UPDATE students SET personal_rating = personal_rating + 1 WHERE id = :student_id'),
+)
+READ_SQL = text(
+    'SELECT s.class_id, sum(s.personal_rating), count(p.id) FROM students s '
+    'LEFT JOIN participations p ON p.student_id = s.id GROUP BY s.class_id'
+)
+
+
+def _create_database(path):
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, username, email, password_hash, role) "
+                          "VALUES (1, 'admin', 'admin@school.ru', '-', 'admin')"))
+        conn.execute(text("INSERT INTO school_classes (id, name, grade, total_rating) VALUES (1, 'А', '5', 0)"))
+        conn.execute(text("INSERT INTO events (id, name, level, event_type, points, created_by, is_active) "
+                          "VALUES (1, 'Олимпиада', 'school', 'individual', 0, 1, 1)"))
+        conn.execute(text("INSERT INTO students (id, full_name, class_id, personal_rating, login, password_hash) "
+                          "VALUES (:id, :name, 1, 0, :login, '-')"),
+                     [{'id': i, 'name': f'Ученик {i}', 'login': f'student{i}'} for i in range(1, STUDENTS + 1)])
+    engine.dispose()
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_profile(profile, writers, readers, seconds):
+    """Прогнать нагрузку на новой БД и вернуть сводку по профилю"""
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    _create_database(path)
+    options = engine_options(profile)
+    options.setdefault('pool_size', writers + readers)
+    write_engine = create_engine(f'sqlite:///{path}', **options)
+    read_engine = create_engine(f'sqlite:///{path}', **engine_options(profile, read_only=True))
+    apply_pragmas(write_engine, profile)
+    apply_pragmas(read_engine, profile, read_only=True)
+
+    stats = {'write': [], 'read': [], 'write_locked': 0, 'read_locked': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def writer(number):
+        student_id = number
+        while time.monotonic() < deadline:
+            student_id = student_id % STUDENTS + 1
+            started = time.monotonic()
+            try:
+                with write_engine.begin() as conn:
+                    for statement in WRITE_SQL:
+                        conn.execute(statement, {'student_id': student_id, 'now': datetime.utcnow()})
+            except exc.OperationalError:
+                with lock:
+                    stats['write_locked'] += 1
+                continue
+            with lock:
+                stats['write'].append(time.monotonic() - started)
+
+    def reader():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                with read_engine.connect() as conn:
+                    conn.execute(READ_SQL).all()
+            except exc.OperationalError:
+                with lock:
+                    stats['read_locked'] += 1
+                continue
+            with lock:
+                stats['read'].append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    write_engine.dispose()
+    read_engine.dispose()
+
+    return {
+        'profile': profile,
+        'writes_per_s': len(stats['write']) / seconds,
+        'reads_per_s': len(stats['read']) / seconds,
+        'write_p95_ms': _percentile(stats['write'], 0.95) * 1000,
+        'read_p95_ms': _percentile(stats['read'], 0.95) * 1000,
+        'locked_errors': stats['write_locked'] + stats['read_locked'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение профилей SQLite под параллельной записью и чтением')
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--profile', action='append', choices=[name for name in PROFILES if name != 'postgresql'],
+                        help='По умолчанию сравниваются default и sqlite')
+    args = parser.parse_args()
+
+    print(f"{'профиль':<10}{'запись/с':>10}{'чтение/с':>10}{'p95 записи':>13}{'p95 чтения':>13}{'locked':>8}")
+    for profile in args.profile or ['default', 'sqlite']:
+        result = run_profile(profile, args.writers, args.readers, args.seconds)
+        print(f"{result['profile']:<10}{result['writes_per_s']:>10.0f}{result['reads_per_s']:>10.0f}"
+              f"{result['write_p95_ms']:>11.1f}мс{result['read_p95_ms']:>11.1f}мс{result['locked_errors']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+# Бенчмарк горячих путей приложения на синтетических данных (bench/seed.py).
+# Каждый сценарий выполняется --repeat раз через тестовый клиент Flask; результат -
+# JSON с временем (первый запуск отдельно: холодные кеши) и числом SQL-запросов.
+#
+#   python bench/scenarios.py --schools 10 --output results.json
+#   python bench/scenarios.py --schools 10 --compare results.json
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from importlib import metadata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import BENCH_PASSWORD, EVENTS_PER_SCHOOL, GRADES, LETTERS, PAPER_DAYS, STUDENTS_PER_CLASS  # noqa: E402
+from seed import full_name, generate, load_app  # noqa: E402
+
+# Сгенерированные базы переиспользуются между запусками
+SEED_CACHE = os.path.join(tempfile.gettempdir(), 'topclass-bench')
+CLASSES_PER_SCHOOL = len(GRADES) * len(LETTERS)
+
+SCENARIOS = []
+
+
+def scenario(name):
+    """Зарегистрировать сценарий: функция (bench, номер запуска) выполняет одну итерацию"""
+
+    def register(function):
+        SCENARIOS.append((name, function))
+        return function
+
+    return register
+
+
+class Bench:
+    """Приложение, клиенты и размеры сгенерированных данных для сценариев"""
+
+    def __init__(self, app, schools, year):
+        self.app = app
+        self.schools = schools
+        self.year = year
+        self.classes = schools * CLASSES_PER_SCHOOL
+        self.admin = self.login('admin')
+
+    def login(self, username):
+        client = self.app.test_client()
+        self.check(client.post('/login', data={'username': username, 'password': BENCH_PASSWORD}), 302)
+        return client
+
+    @staticmethod
+    def check(response, status=200):
+        if response.status_code != status:
+            raise RuntimeError(f'{response.request.path}: ответ {response.status_code}, ожидался {status}')
+        if response.is_json and response.get_json().get('success') is False:
+            raise RuntimeError(f"{response.request.path}: {response.get_json().get('message')}")
+        return response
+
+    def run_jobs(self, response):
+        """Выполнить поставленную маршрутом фоновую задачу, как это сделал бы рабочий процесс"""
+        from jobs import run_pending
+
+        self.check(response, 202)
+        with self.app.app_context():
+            run_pending()
+        self.check(self.admin.get(response.get_json()['status_url']))
+
+    def class_id(self, run):
+        return run % self.classes + 1
+
+    def class_students(self, class_id):
+        first = (class_id - 1) * STUDENTS_PER_CLASS + 1
+        return list(range(first, first + STUDENTS_PER_CLASS))
+
+
+@scenario('login')
+def _login(bench, run):
+    bench.login(f'student{run % (bench.classes * STUDENTS_PER_CLASS) + 1}')
+
+
+@scenario('dashboard')
+def _dashboard(bench, run):
+    bench.check(bench.admin.get('/dashboard'))
+
+
+@scenario('ratings')
+def _ratings(bench, run):
+    bench.check(bench.admin.get('/ratings'))
+
+
+@scenario('class_report')
+def _class_report(bench, run):
+    bench.check(bench.admin.get(f'/api/class_report/{bench.class_id(run)}'))
+
+
+@scenario('bulk_participation')
+def _bulk_participation(bench, run):
+    class_id = bench.class_id(run)
+    school = (class_id - 1) // CLASSES_PER_SCHOOL
+    # Каждый запуск - новое мероприятие той же школы, чтобы участия не повторялись
+    event_id = school * EVENTS_PER_SCHOOL + (run // bench.classes) % EVENTS_PER_SCHOOL + 1
+    participants = [{'student_id': student_id, 'place': (1, 2, 3, None)[index % 4]}
+                    for index, student_id in enumerate(bench.class_students(class_id))]
+    bench.run_jobs(bench.admin.post(f'/api/event/{event_id}/participations', json={
+        'participants': participants, 'participants_count': len(participants), 'description': 'bench'
+    }))
+
+
+@scenario('roster_import')
+def _roster_import(bench, run):
+    rng = random.Random(run)
+    roster = 'ФИО\n' + '\n'.join(full_name(rng) for _ in range(STUDENTS_PER_CLASS))
+    bench.run_jobs(bench.admin.post(f'/class/{bench.class_id(run)}/import_students', data={
+        'roster_file': (io.BytesIO(roster.encode('utf-8')), 'roster.csv')
+    }, content_type='multipart/form-data'))
+
+
+@scenario('paper_save')
+def _paper_save(bench, run):
+    class_id = bench.class_id(run)
+    form = {'class_id': class_id, 'collection_date': f'{bench.year}-{run % PAPER_DAYS + 1:02d}-15'}
+    for index, student_id in enumerate(bench.class_students(class_id)):
+        form[f'kilograms_{student_id}'] = '' if index % 5 == 0 else f'{(run + index) % 12 + 0.5}'
+    bench.check(bench.admin.post('/paper_collection/save', data=form))
+
+
+@scenario('paper_overview')
+def _paper_overview(bench, run):
+    bench.check(bench.admin.get('/api/paper_collection/overview'))
+
+
+@scenario('rating_recompute')
+def _rating_recompute(bench, run):
+    from models import recompute_all, recompute_class_ratings, refresh_rankings
+    with bench.app.app_context():
+        recompute_all(fix=True)
+        recompute_class_ratings(fix=True)
+        refresh_rankings()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_scenarios(bench, names, repeat):
+    from queries import count_queries
+
+    results = {}
+    for name, function in SCENARIOS:
+        if names and name not in names:
+            continue
+        timings, query_counts = [], []
+        for run in range(repeat):
+            with count_queries() as counter:
+                started = time.perf_counter()
+                function(bench, run)
+                timings.append((time.perf_counter() - started) * 1000)
+            query_counts.append(counter['count'])
+        # Первый запуск идет с холодными кешами и считается отдельно
+        warm = timings[1:] or timings
+        results[name] = {
+            'runs': repeat,
+            'first_ms': round(timings[0], 3),
+            'min_ms': round(min(warm), 3),
+            'median_ms': round(statistics.median(warm), 3),
+            'p95_ms': round(_percentile(warm, 0.95), 3),
+            'max_ms': round(max(warm), 3),
+            'queries_first': query_counts[0],
+            'queries': round(statistics.median(query_counts[1:] or query_counts), 1),
+        }
+    return results
+
+
+def _git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{revision}-dirty' if dirty else revision
+
+
+def _copy_database(source, target):
+    # backup() переносит и то, что еще лежит в WAL-файле
+    if os.path.exists(target):
+        os.remove(target)
+    src, dst = sqlite3.connect(source), sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+
+
+def prepare_database(schools, seed, year):
+    """Рабочая копия сгенерированной базы; генерация - только если ее нет в SEED_CACHE"""
+    from migrations import MIGRATIONS
+
+    os.makedirs(SEED_CACHE, exist_ok=True)
+    schema = MIGRATIONS[-1][0]
+    cached = os.path.join(SEED_CACHE, f'seed-{schools}-{seed}-{year}-m{schema}.db')
+    work = os.path.join(tempfile.mkdtemp(prefix='topclass-bench-'), 'bench.db')
+    if os.path.exists(cached):
+        _copy_database(cached, work)
+        return load_app(work), None
+    started = time.monotonic()
+    counts = generate(work, schools, seed, year)
+    _copy_database(work, cached)
+    return load_app(work), {'rows': counts, 'seconds': round(time.monotonic() - started, 2)}
+
+
+def print_table(results, baseline=None, stream=sys.stderr):
+    header = f"{'сценарий':<20}{'первый мс':>11}{'медиана мс':>12}{'p95 мс':>10}{'SQL':>7}"
+    print(header + (f"{'было мс':>10}{'изм.':>8}" if baseline else ''), file=stream)
+    for name, item in results.items():
+        line = (f"{name:<20}{item['first_ms']:>11.1f}{item['median_ms']:>12.2f}"
+                f"{item['p95_ms']:>10.2f}{item['queries']:>7}")
+        old = (baseline or {}).get(name)
+        if old:
+            change = (item['median_ms'] / old['median_ms'] - 1) * 100 if old['median_ms'] else 0.0
+            line += f"{old['median_ms']:>10.2f}{change:>+7.0f}%"
+        print(line, file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк горячих путей на синтетических данных')
+    parser.add_argument('--schools', type=int, default=1, help='Масштаб данных: 1, 10, 100 школ')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--year', type=int, default=datetime.now().year)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--scenario', action='append', choices=[name for name, _ in SCENARIOS],
+                        help='Только эти сценарии (по умолчанию все)')
+    parser.add_argument('--output', help='Записать JSON в файл (по умолчанию - в stdout)')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения медиан')
+    args = parser.parse_args()
+
+    # Приложение импортируется только после выбора базы (DATABASE_URL)
+    app, generated = prepare_database(args.schools, args.seed, args.year)
+    bench = Bench(app, args.schools, args.year)
+    results = run_scenarios(bench, args.scenario, args.repeat)
+
+    report = {
+        'revision': _git_revision(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'scale': {'schools': args.schools, 'seed': args.seed, 'year': args.year},
+        'environment': {
+            'python': platform.python_version(),
+            'flask': metadata.version('flask'),
+            'sqlalchemy': metadata.version('sqlalchemy'),
+            'sqlite': sqlite3.sqlite_version,
+            'database_profile': app.config.get('DATABASE_PROFILE'),
+        },
+        'generated': generated,
+        'scenarios': results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file).get('scenarios')
+    print_table(results, baseline)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# Детерминированный генератор синтетических данных школы для бенчмарков.
+# Одна «школа» - 33 класса (1-11 параллели по три буквы) по 25 учеников, классные
+# руководители, мероприятия, участия, портфолио, баллы классов и сбор макулатуры.
+# При одинаковых --schools, --seed и --year получается одна и та же база.
+#
+#   python bench/seed.py --schools 10 --output /tmp/school-10.db
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Пароль всех сгенерированных пользователей и учеников
+BENCH_PASSWORD = 'bench123'
+
+GRADES = range(1, 12)
+LETTERS = 'АБВ'
+STUDENTS_PER_CLASS = 25
+EVENTS_PER_SCHOOL = 40
+MAX_PARTICIPATIONS_PER_STUDENT = 6
+PORTFOLIO_SHARE = 0.5
+CLASS_POINTS_PER_CLASS = 10
+PAPER_DAYS = 8
+PAPER_SHARE = 0.6
+
+LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов',
+              'Михайлов', 'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов')
+FIRST_NAMES = ('Александр', 'Дмитрий', 'Максим', 'Сергей', 'Андрей', 'Алексей', 'Артем', 'Илья',
+               'Кирилл', 'Михаил', 'Никита', 'Матвей', 'Роман', 'Егор', 'Арсений', 'Иван')
+PATRONYMICS = ('Александрович', 'Дмитриевич', 'Сергеевич', 'Андреевич', 'Алексеевич', 'Иванович',
+               'Михайлович', 'Николаевич')
+LEVELS = ('school', 'city', 'republic', 'russian')
+EVENT_TYPES = ('student', 'class', 'both')
+ENTRY_TYPES = ('achievement', 'project', 'competition', 'olympiad', 'sport', 'art')
+PLACES = (None, None, None, 4, 3, 2, 1)
+
+BATCH_SIZE = 5000
+
+
+def full_name(rng):
+    return f'{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(PATRONYMICS)}'
+
+
+def _insert(conn, table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.execute(insert(table), rows[start:start + BATCH_SIZE])
+
+
+def generate_rows(schools=1, seed=0, year=None):
+    """Строки всех таблиц: {имя таблицы: [dict, ...]} в порядке вставки"""
+    rng = random.Random(seed)
+    year = year or date.today().year
+    start = datetime(year, 1, 9, 9, 0)
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+
+    def moment():
+        return start + timedelta(minutes=rng.randrange(0, 270 * 24 * 60))
+
+    users = [{'id': 1, 'username': 'admin', 'email': 'admin@bench.local', 'password_hash': password_hash,
+              'role': 'admin', 'created_at': start}]
+    classes, students, events, participations = [], [], [], []
+    portfolio_entries, class_points, paper_collections = [], [], []
+    paper_days = [date(year, 1 + month, 15) for month in range(PAPER_DAYS)]
+
+    for school in range(1, schools + 1):
+        school_class_ids = []
+        for grade in GRADES:
+            for letter in LETTERS:
+                class_id = len(classes) + 1
+                teacher_id = len(users) + 1
+                users.append({'id': teacher_id, 'username': f'teacher{class_id}',
+                              'email': f'teacher{class_id}@bench.local', 'password_hash': password_hash,
+                              'role': 'teacher', 'created_at': start})
+                classes.append({'id': class_id, 'name': letter if schools == 1 else f'{letter}-{school}',
+                                'grade': str(grade), 'class_teacher_id': teacher_id, 'total_rating': 0,
+                                'created_at': start})
+                school_class_ids.append(class_id)
+                for _ in range(STUDENTS_PER_CLASS):
+                    student_id = len(students) + 1
+                    students.append({'id': student_id, 'full_name': full_name(rng), 'class_id': class_id,
+                                     'personal_rating': 0, 'login': f'student{student_id}',
+                                     'password_hash': password_hash, 'created_at': start})
+
+        school_event_ids = []
+        for number in range(EVENTS_PER_SCHOOL):
+            event_id = len(events) + 1
+            events.append({'id': event_id, 'name': f'Мероприятие {school}-{number + 1}',
+                           'description': 'Сгенерировано для бенчмарка', 'level': rng.choice(LEVELS),
+                           'event_type': rng.choice(EVENT_TYPES), 'points': 0,
+                           'class_points': rng.choice((0, 2, 5)), 'created_by': 1,
+                           'created_at': moment(), 'is_active': True})
+            school_event_ids.append(event_id)
+
+        first_student = (school_class_ids[0] - 1) * STUDENTS_PER_CLASS + 1
+        for student_id in range(first_student, first_student + len(school_class_ids) * STUDENTS_PER_CLASS):
+            class_id = students[student_id - 1]['class_id']
+            count = rng.randrange(0, MAX_PARTICIPATIONS_PER_STUDENT + 1)
+            for event_id in rng.sample(school_event_ids, count):
+                created_at = moment()
+                approved = rng.random() < 0.9
+                participations.append({
+                    'id': len(participations) + 1, 'event_id': event_id, 'student_id': student_id,
+                    'participants_count': 1, 'description': 'Участие', 'place': rng.choice(PLACES),
+                    'created_at': created_at, 'approved': approved,
+                    'approved_by': users[class_id]['id'] if approved else None,
+                    'approved_at': created_at if approved else None,
+                })
+            if rng.random() < PORTFOLIO_SHARE:
+                achieved = moment()
+                portfolio_entries.append({
+                    'id': len(portfolio_entries) + 1, 'student_id': student_id,
+                    'title': 'Достижение', 'description': 'Сгенерировано для бенчмарка',
+                    'entry_type': rng.choice(ENTRY_TYPES), 'date_achieved': achieved.date(),
+                    'points_earned': rng.randrange(1, 6), 'created_at': achieved, 'approved': True,
+                    'approved_by': 1, 'approved_at': achieved,
+                })
+            for collection_date in paper_days:
+                if rng.random() < PAPER_SHARE:
+                    paper_collections.append({
+                        'id': len(paper_collections) + 1, 'student_id': student_id, 'class_id': class_id,
+                        'kilograms': round(rng.uniform(0.5, 15), 1), 'collection_date': collection_date,
+                        'created_by': users[class_id]['id'],
+                        'created_at': datetime.combine(collection_date, datetime.min.time()),
+                    })
+
+        for class_id in school_class_ids:
+            for _ in range(CLASS_POINTS_PER_CLASS):
+                class_points.append({'id': len(class_points) + 1, 'class_id': class_id,
+                                     'points': rng.randrange(1, 11), 'reason': 'Дежурство',
+                                     'assigned_by': users[class_id]['id'], 'created_at': moment()})
+
+    return {
+        'users': users,
+        'school_classes': classes,
+        'students': students,
+        'events': events,
+        'participations': participations,
+        'portfolio_entries': portfolio_entries,
+        'class_points': class_points,
+        'paper_collections': paper_collections,
+    }
+
+
+def generate(path, schools=1, seed=0, year=None):
+    """Создать базу по пути path (существующий файл заменяется); возвращает число строк по таблицам"""
+    if os.path.exists(path):
+        os.remove(path)
+    app = load_app(path)
+
+    from models import db, recompute_all, recompute_class_ratings, refresh_rankings, rebuild_paper_rollups
+    from migrations import stamp_migrations
+
+    rows = generate_rows(schools, seed, year)
+    with app.app_context():
+        db.create_all()
+        stamp_migrations()
+        with db.engine.begin() as conn:
+            for name, table_rows in rows.items():
+                _insert(conn, db.metadata.tables[name], table_rows)
+
+        # Производные данные считаются теми же функциями, что и в приложении
+        recompute_all(fix=True)
+        recompute_class_ratings(fix=True)
+        rebuild_paper_rollups()
+        refresh_rankings()
+        db.session.remove()
+    return {name: len(table_rows) for name, table_rows in rows.items()}
+
+
+def load_app(path):
+    """Приложение, подключенное к базе path (импортируется один раз на процесс)"""
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(path)}'
+    # Файл записей инструментирования бенчмаркам не нужен
+    os.environ.setdefault('METRICS_PATH', '')
+    from app import app
+    if app.config['SQLALCHEMY_DATABASE_URI'] != os.environ['DATABASE_URL']:
+        raise RuntimeError('Приложение уже загружено с другой базой')
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Синтетические данные школы для бенчмарков')
+    parser.add_argument('--schools', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--year', type=int, default=None, help='Учебный год данных (по умолчанию текущий)')
+    parser.add_argument('--output', required=True, help='Путь к файлу базы SQLite')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    counts = generate(args.output, args.schools, args.seed, args.year)
+    for name, count in counts.items():
+        print(f'{name:<20}{count:>10}')
+    print(f'Готово за {time.monotonic() - started:.1f} с: {args.output}')
+
+
+if __name__ == '__main__':
+    main()
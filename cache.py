@@ -0,0 +1,219 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+# Метки тегов живут долго; потерянная метка только приводит к пересчету значений
+TAG_TTL = 30 * 24 * 3600
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кеш в памяти процесса с ограничением времени жизни записей"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """Кеш в файле SQLite, общий для нескольких рабочих процессов на одной машине"""
+
+    # Просроченные записи удаляются раз в столько вызовов set()
+    PURGE_EVERY = 100
+
+    def __init__(self, path, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._sets = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value BLOB NOT NULL)'
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, default=None):
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)',
+            (key, expires_at, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        )
+        self._sets += 1
+        if self._sets % self.PURGE_EVERY == 0:
+            connection.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM cache').fetchone()[0]
+
+
+def create_backend(url, ttl=300, maxsize=8192):
+    """Хранилище по адресу: 'memory://' (по умолчанию) или 'sqlite:///путь/к/cache.db'"""
+    if not url or url == 'memory://':
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):], ttl=ttl)
+    raise ValueError(f'Неизвестное хранилище кеша: {url}')
+
+
+class TaggedCache:
+    """Кеш значений с тегами поверх хранилища (TTLCache или SQLiteCache).
+
+    Каждый тег хранит случайную метку; значение запоминается вместе с метками своих
+    тегов и считается устаревшим, если хотя бы одна метка сменилась. invalidate(tag)
+    просто выдает тегу новую метку, поэтому работает и с общим хранилищем.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, url, **options):
+        self.backend = create_backend(url, **options)
+
+    def _tag_tokens(self, tags):
+        tokens = []
+        for tag in tags:
+            token = self.backend.get(f'tag:{tag}')
+            if token is None:
+                token = self._new_tag_token(tag)
+            tokens.append(token)
+        return tuple(tokens)
+
+    def _new_tag_token(self, tag):
+        token = os.urandom(8).hex()
+        self.backend.set(f'tag:{tag}', token, ttl=TAG_TTL)
+        return token
+
+    def get_or_set(self, key, factory, tags=(), ttl=None):
+        """Вернуть значение из кеша или вычислить его через factory() и запомнить"""
+        tokens = self._tag_tokens(tags)
+        item = self.backend.get(key)
+        if item is not None and item[0] == tokens:
+            self.hits += 1
+            return item[1]
+        self.misses += 1
+        value = factory()
+        self.backend.set(key, (tokens, value), ttl=ttl)
+        return value
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self._new_tag_token(tag)
+
+    def region(self, name, ttl=60):
+        """Область кеша для значений без тегов (сбрасываются по ключу или целиком)"""
+        return CacheRegion(self, name, ttl)
+
+    def memoize(self, *tags, ttl=None):
+        """Декоратор: кешировать результат функции по аргументам с тегами tags"""
+
+        def decorator(function):
+            prefix = f'{function.__module__}.{function.__qualname__}'
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                key = f'{prefix}:{args!r}:{sorted(kwargs.items())!r}'
+                return self.get_or_set(key, lambda: function(*args, **kwargs), tags, ttl)
+
+            wrapper.uncached = function
+            return wrapper
+
+        return decorator
+
+
+class CacheRegion:
+    """Именованная область хранилища TaggedCache с интерфейсом TTLCache (get/set/delete/clear).
+
+    Записи лежат в настроенном хранилище (CACHE_URL), поэтому delete() и clear()
+    из одного процесса видны всем остальным; clear() выдает области новую метку.
+    """
+
+    def __init__(self, cache, name, ttl=60):
+        self.cache = cache
+        self.name = name
+        self.ttl = ttl
+
+    def _key(self, key):
+        backend = self.cache.backend
+        token = backend.get(f'region:{self.name}')
+        if token is None:
+            token = self._new_token()
+        return f'{self.name}:{token}:{key}'
+
+    def _new_token(self):
+        token = os.urandom(8).hex()
+        self.cache.backend.set(f'region:{self.name}', token, ttl=TAG_TTL)
+        return token
+
+    def get(self, key, default=None):
+        return self.cache.backend.get(self._key(key), default)
+
+    def set(self, key, value, ttl=None):
+        self.cache.backend.set(self._key(key), value, ttl=self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.cache.backend.delete(self._key(key))
+
+    def clear(self):
+        self._new_token()
+
+
+# Общий кеш приложения; хранилище задается через app_cache.configure(CACHE_URL)
+app_cache = TaggedCache(create_backend('memory://'))
@@ -0,0 +1,71 @@
+# Условные HTTP-ответы: ETag строится из версий таблиц (models.version_stamp),
+# поэтому на повторный запрос без изменений отвечаем 304, не читая строки
+# и не отрисовывая шаблон.
+import hashlib
+import os
+from functools import wraps
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from cache import app_cache
+from models import Student, User, version_stamp
+
+# Время жизни отрисованных страниц в кеше (ключ все равно меняется вместе с версией)
+RENDERED_TTL = 300
+
+
+def _principal():
+    if current_user.is_authenticated:
+        return current_user.get_id(), (Student if isinstance(current_user, Student) else User)
+    return '-', User
+
+
+def conditional(*models, cache_body=False):
+    """Отвечать 304 Not Modified, пока не изменились таблицы моделей models.
+
+    ETag зависит от адреса, пользователя (его таблица тоже учитывается - имя в меню)
+    и версий таблиц. Last-Modified выставляется для информации, но 304 выдается
+    только по If-None-Match: одна дата изменения не различает пользователей.
+    cache_body=True дополнительно хранит отрисованный ответ в app_cache.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Страницу с flash-сообщениями нужно отрисовать, чтобы их показать
+            if session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            principal_id, principal_model = _principal()
+            stamp, modified = version_stamp(*models, principal_model)
+            release = current_app.config.get('RELEASE', os.environ.get('RELEASE', ''))
+            etag = hashlib.sha1(
+                f'{request.endpoint}|{request.full_path}|{principal_id}|{stamp}|{release}'.encode()
+            ).hexdigest()[:32]
+
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                cached = app_cache.backend.get(f'page:{etag}') if cache_body else None
+                if cached is not None:
+                    mimetype, body = cached
+                    response = current_app.response_class(body, mimetype=mimetype)
+                else:
+                    response = current_app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    if cache_body:
+                        app_cache.backend.set(f'page:{etag}', (response.mimetype, response.get_data()),
+                                              ttl=RENDERED_TTL)
+
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
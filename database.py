@@ -0,0 +1,152 @@
+# Профили подключения к БД: параметры пула, PRAGMA для SQLite и отдельное
+# подключение только для чтения, через которое идут страницы без записи.
+import os
+from functools import wraps
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+# Ключ привязки (SQLALCHEMY_BINDS) для подключения только для чтения
+READ_BIND = 'readonly'
+
+PROFILES = {
+    # Настройки по умолчанию: журнал отката, без ожидания блокировки (как раньше)
+    'default': {
+        'engine_options': {},
+        'pragmas': {},
+        'read_pragmas': {},
+    },
+    'sqlite': {
+        'engine_options': {
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': 30,
+            'connect_args': {'timeout': 10, 'check_same_thread': False},
+        },
+        'pragmas': {
+            'journal_mode': 'WAL',         # читатели не ждут писателя
+            'synchronous': 'NORMAL',       # в режиме WAL надежно и без fsync на каждый коммит
+            'busy_timeout': 10000,         # мс ожидания блокировки вместо "database is locked"
+            'cache_size': -32000,          # 32 МБ страничного кеша на подключение
+            'mmap_size': 268435456,        # 256 МБ
+            'temp_store': 'MEMORY',
+        },
+        'read_pragmas': {'query_only': 'ON'},
+    },
+    'postgresql': {
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_recycle': 1800,
+            'pool_pre_ping': True,
+        },
+        'pragmas': {},
+        'read_pragmas': {},
+        'read_engine_options': {
+            'connect_args': {'options': '-c default_transaction_read_only=on'},
+        },
+    },
+}
+
+
+def profile_for_uri(uri):
+    """Профиль по умолчанию для строки подключения; для других СУБД - настройки SQLAlchemy"""
+    if uri.startswith('postgresql'):
+        return 'postgresql'
+    if uri.startswith('sqlite'):
+        return 'sqlite'
+    return 'default'
+
+
+def engine_options(profile, read_only=False):
+    """Параметры create_engine для профиля"""
+    settings = PROFILES[profile]
+    options = dict(settings['engine_options'])
+    if read_only:
+        options.update(settings.get('read_engine_options', {}))
+    return options
+
+
+def apply_pragmas(engine, profile, read_only=False):
+    """Выполнять PRAGMA профиля при каждом новом подключении SQLite"""
+    settings = PROFILES[profile]
+    pragmas = dict(settings['pragmas'])
+    if read_only:
+        pragmas.update(settings['read_pragmas'])
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def register_functions(engine):
+    """SQL-функции SQLite на Python: casefold(x) для поиска без учета регистра.
+
+    Встроенные lower() и LIKE в SQLite меняют регистр только у латиницы.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _create_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('casefold', 1, _casefold, deterministic=True)
+
+
+def _casefold(value):
+    return value.casefold() if isinstance(value, str) else value
+
+
+def configure_database(app, db):
+    """Настроить подключения по профилю и инициализировать db.
+
+    Профиль берется из DATABASE_PROFILE (по умолчанию - по SQLALCHEMY_DATABASE_URI).
+    Подключение только для чтения использует DATABASE_READ_URL или основную БД;
+    отключается через DATABASE_READ_ONLY_ROUTES = False.
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    profile = app.config.setdefault('DATABASE_PROFILE', os.environ.get('DATABASE_PROFILE') or profile_for_uri(uri))
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(profile))
+    if app.config.setdefault('DATABASE_READ_ONLY_ROUTES', True):
+        read_uri = app.config.setdefault('DATABASE_READ_URL', os.environ.get('DATABASE_READ_URL') or uri)
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        binds.setdefault(READ_BIND, {'url': read_uri, **engine_options(profile, read_only=True)})
+
+    db.init_app(app)
+    with app.app_context():
+        for key, engine in db.engines.items():
+            apply_pragmas(engine, profile, read_only=key == READ_BIND)
+            register_functions(engine)
+
+
+class RoutingSession(Session):
+    """Сессия, которая в маршрутах @read_only читает через подключение только для чтения.
+
+    Запись (flush, INSERT/UPDATE/DELETE) всегда идет в основную БД.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and has_request_context() and g.get('db_read_only')
+                and not self._flushing and not isinstance(clause, UpdateBase)):
+            engine = self._db.engines.get(READ_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(view):
+    """Маршрут только читает БД: запросы идут через подключение только для чтения"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+
+    return wrapper
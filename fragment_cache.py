@@ -0,0 +1,75 @@
+# Кеш фрагментов шаблонов: {% cache 'имя', ключ..., версия %} ... {% endcache %}.
+# Отрисованный фрагмент хранится в общем кеше приложения (app_cache) под ключом
+# из всех аргументов; версию берут из table_version(...), поэтому фрагмент
+# отрисовывается заново только после изменения данных.
+import threading
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import app_cache
+from models import version_stamp
+
+FRAGMENT_TTL = 3600
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def fragment_cache_stats():
+    """Попадания и промахи по фрагментам: {имя: {'hits': n, 'misses': n}}"""
+    with _stats_lock:
+        return {name: dict(counts) for name, counts in _stats.items()}
+
+
+def fragment_cache_metrics():
+    """Счетчики для /metrics (instrumentation.add_collector) с меткой fragment"""
+    stats = sorted(fragment_cache_stats().items())
+    return [
+        ('fragment_cache_hits_total', 'counter', 'Template fragments served from cache',
+         [('', (('fragment', name),), counts['hits']) for name, counts in stats]),
+        ('fragment_cache_misses_total', 'counter', 'Template fragments rendered and stored',
+         [('', (('fragment', name),), counts['misses']) for name, counts in stats]),
+    ]
+
+
+def _count(name, outcome):
+    with _stats_lock:
+        _stats.setdefault(name, {'hits': 0, 'misses': 0})[outcome] += 1
+
+
+def table_version(*tables):
+    """Версия таблиц для ключа фрагмента (см. models.version_stamp)"""
+    return version_stamp(*tables)[0]
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        name = str(parts[0])
+        key = 'fragment:' + '|'.join(str(part) for part in parts)
+        html = app_cache.backend.get(key)
+        if html is not None:
+            _count(name, 'hits')
+            return Markup(html)
+        _count(name, 'misses')
+        html = caller()
+        app_cache.backend.set(key, str(html), ttl=FRAGMENT_TTL)
+        return Markup(html)
+
+
+def install_fragment_cache(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals['table_version'] = table_version
@@ -0,0 +1,379 @@
+# Инструментирование запросов: по каждому маршруту считаются SQL-запросы и их время,
+# время рендера шаблонов и коммиты; одинаковые запросы, повторенные в одном
+# HTTP-запросе много раз, отмечаются как кандидаты N+1.
+# Счетчики Prometheus копятся в памяти процесса (/metrics, у каждого рабочего
+# процесса свои). Записи о запросах пачками пишутся в отдельный файл SQLite, общий
+# для процессов; по нему flask slow-routes строит отчет за последние минуты.
+# На SQL-запрос приходится два вызова perf_counter и запись в словарь, поэтому
+# инструментирование можно не выключать в продакшене.
+import atexit
+import hmac
+import os
+import sqlite3
+import threading
+import time
+from time import perf_counter
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from flask import before_render_template, request_finished, request_started, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+
+# Запрос, повторенный в одном HTTP-запросе столько раз, - кандидат N+1
+N_PLUS_ONE_THRESHOLD = 5
+# Границы корзин гистограммы времени ответа, секунды
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Записи копятся в памяти и пишутся в файл не чаще раза в FLUSH_INTERVAL секунд
+FLUSH_INTERVAL = 5
+FLUSH_SIZE = 200
+# Записи старше RETENTION секунд удаляются из файла
+RETENTION = 24 * 3600
+# Длина текста запроса в отчете о N+1
+STATEMENT_PREVIEW = 300
+
+METRIC_PREFIX = 'topclass'
+
+
+class RequestMetrics:
+    """Счетчики одного HTTP-запроса (g.request_metrics)"""
+    __slots__ = ('started', 'queries', 'sql_time', 'render_time', 'commits', 'statements', 'render_stack')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.commits = 0
+        self.statements = {}
+        self.render_stack = []
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Запросы, выполненные не меньше threshold раз: [(число, текст)], частые первыми"""
+        return sorted(((count, statement) for statement, count in self.statements.items()
+                       if count >= threshold), reverse=True)
+
+
+class RouteMetrics:
+    """Накопленные счетчики маршрутов для /metrics (в памяти процесса)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def add(self, endpoint, status, duration, metrics, flagged):
+        with self._lock:
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = {
+                    'statuses': {}, 'buckets': [0] * len(DURATION_BUCKETS), 'duration': 0.0,
+                    'queries': 0, 'sql_time': 0.0, 'render_time': 0.0, 'commits': 0, 'n_plus_one': 0,
+                }
+            route['statuses'][status] = route['statuses'].get(status, 0) + 1
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    route['buckets'][index] += 1
+            route['duration'] += duration
+            route['queries'] += metrics.queries
+            route['sql_time'] += metrics.sql_time
+            route['render_time'] += metrics.render_time
+            route['commits'] += metrics.commits
+            route['n_plus_one'] += 1 if flagged else 0
+
+    def render(self):
+        """Счетчики в текстовом формате Prometheus"""
+        with self._lock:
+            routes = {endpoint: dict(route, statuses=dict(route['statuses']), buckets=list(route['buckets']))
+                      for endpoint, route in self.routes.items()}
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.extend(_metric_lines(name, kind, help_text, samples))
+
+        metric('requests_total', 'counter', 'HTTP requests by route and status', [
+            ('', (('endpoint', endpoint), ('status', status)), count)
+            for endpoint, route in routes.items() for status, count in sorted(route['statuses'].items())
+        ])
+        duration_samples = []
+        for endpoint, route in routes.items():
+            for bound, count in zip(DURATION_BUCKETS, route['buckets']):
+                duration_samples.append(('_bucket', (('endpoint', endpoint), ('le', bound)), count))
+            total = sum(route['statuses'].values())
+            duration_samples.append(('_bucket', (('endpoint', endpoint), ('le', '+Inf')), total))
+            duration_samples.append(('_sum', (('endpoint', endpoint),), round(route['duration'], 6)))
+            duration_samples.append(('_count', (('endpoint', endpoint),), total))
+        metric('request_duration_seconds', 'histogram', 'Request duration', duration_samples)
+        for key, name, help_text in (
+            ('queries', 'sql_queries_total', 'SQL statements executed'),
+            ('sql_time', 'sql_seconds_total', 'Time spent in SQL statements'),
+            ('render_time', 'template_render_seconds_total', 'Time spent rendering templates'),
+            ('commits', 'db_commits_total', 'Database commits'),
+            ('n_plus_one', 'n_plus_one_requests_total', 'Requests with repeated identical statements'),
+        ):
+            metric(name, 'counter', help_text, [
+                ('', (('endpoint', endpoint),), round(route[key], 6) if isinstance(route[key], float) else route[key])
+                for endpoint, route in routes.items()
+            ])
+        return '\n'.join(lines) + '\n'
+
+
+def _metric_lines(name, kind, help_text, samples):
+    """Одна метрика в текстовом формате Prometheus; samples - [(суффикс, метки, значение)]"""
+    lines = [f'# HELP {METRIC_PREFIX}_{name} {help_text}', f'# TYPE {METRIC_PREFIX}_{name} {kind}']
+    for suffix, labels, value in samples:
+        label_text = ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels)
+        lines.append(f'{METRIC_PREFIX}_{name}{suffix}{{{label_text}}} {value}')
+    return lines
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsStore:
+    """Записи о запросах в файле SQLite для отчета о медленных маршрутах"""
+
+    def __init__(self, path, retention=RETENTION):
+        self.path = path
+        self.retention = retention
+        self._local = threading.local()
+        self._connection().executescript(
+            'CREATE TABLE IF NOT EXISTS request_metrics ('
+            ' at REAL NOT NULL, endpoint TEXT NOT NULL, status INTEGER NOT NULL,'
+            ' duration REAL NOT NULL, queries INTEGER NOT NULL, sql_time REAL NOT NULL,'
+            ' render_time REAL NOT NULL, commits INTEGER NOT NULL,'
+            ' repeated_count INTEGER, repeated_statement TEXT);'
+            'CREATE INDEX IF NOT EXISTS ix_request_metrics_at ON request_metrics (at);'
+        )
+
+    def _connection(self):
+        # Подключение не переживает fork: рабочий процесс открывает свое
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def write(self, records):
+        connection = self._connection()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany('INSERT INTO request_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+            connection.execute('DELETE FROM request_metrics WHERE at < ?', (time.time() - self.retention,))
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def slowest(self, window, limit=10):
+        """Маршруты за последние window секунд, самые медленные (по p95) первыми"""
+        rows = self._connection().execute(
+            'SELECT endpoint, duration, queries, sql_time, render_time, commits, repeated_count '
+            'FROM request_metrics WHERE at >= ? ORDER BY endpoint, duration', (time.time() - window,)
+        ).fetchall()
+        routes = {}
+        for endpoint, *values in rows:
+            routes.setdefault(endpoint, []).append(values)
+
+        report = []
+        for endpoint, items in routes.items():
+            durations = [item[0] for item in items]
+            count = len(items)
+            report.append({
+                'endpoint': endpoint,
+                'requests': count,
+                'p50': _percentile(durations, 50),
+                'p95': _percentile(durations, 95),
+                'max': durations[-1],
+                'queries': sum(item[1] for item in items) / count,
+                'sql_time': sum(item[2] for item in items) / count,
+                'render_time': sum(item[3] for item in items) / count,
+                'commits': sum(item[4] for item in items) / count,
+                'n_plus_one': sum(1 for item in items if item[5]),
+            })
+        report.sort(key=lambda item: item['p95'], reverse=True)
+        return report[:limit]
+
+    def repeated_statements(self, window, limit=10):
+        """Кандидаты N+1 за последние window секунд: (маршрут, запрос, запросов, наибольший повтор)"""
+        return self._connection().execute(
+            'SELECT endpoint, repeated_statement, count(*), max(repeated_count) FROM request_metrics '
+            'WHERE at >= ? AND repeated_count IS NOT NULL '
+            'GROUP BY endpoint, repeated_statement ORDER BY max(repeated_count) DESC LIMIT ?',
+            (time.time() - window, limit)
+        ).fetchall()
+
+
+def _percentile(sorted_values, percent):
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Instrumentation:
+    """Подключение счетчиков к приложению: install(app, db)"""
+
+    def __init__(self):
+        self.routes = RouteMetrics()
+        self.store = None
+        self.collectors = []
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def install(self, app, db):
+        """Подписаться на события SQLAlchemy и сигналы Flask, добавить /metrics.
+
+        Настройки: METRICS_ENABLED (по умолчанию True), METRICS_PATH - файл записей
+        для flask slow-routes (пустая строка - не писать), METRICS_TOKEN - токен
+        для /metrics (без него доступ только администраторам).
+        """
+        if not app.config.setdefault('METRICS_ENABLED', os.environ.get('METRICS_ENABLED', '1') != '0'):
+            return
+        path = app.config.setdefault(
+            'METRICS_PATH', os.environ.get('METRICS_PATH', os.path.join(app.instance_path, 'metrics.db'))
+        )
+        app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.store = MetricsStore(path)
+            atexit.register(self.flush)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+                event.listen(engine, 'handle_error', _on_error)
+                event.listen(engine, 'commit', _on_commit)
+
+        request_started.connect(_on_request_started, app)
+        request_finished.connect(self._on_request_finished, app)
+        before_render_template.connect(_on_before_render, app)
+        template_rendered.connect(_on_rendered, app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def add_collector(self, collector):
+        """Добавить в /metrics счетчики модуля: collector() -> [(имя, тип, описание, samples)]"""
+        self.collectors.append(collector)
+
+    def _on_request_finished(self, sender, response, **extra):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return
+        duration = perf_counter() - metrics.started
+        endpoint = request.endpoint or 'unmatched'
+        repeated = metrics.repeated()
+        self.routes.add(endpoint, response.status_code, duration, metrics, bool(repeated))
+        if repeated and sender.debug:
+            sender.logger.warning('%s: запрос выполнен %d раз (N+1?): %s', endpoint, *repeated[0])
+        if self.store is not None:
+            count, statement = repeated[0] if repeated else (None, None)
+            self._record((time.time(), endpoint, response.status_code, duration, metrics.queries,
+                          metrics.sql_time, metrics.render_time, metrics.commits,
+                          count, statement[:STATEMENT_PREVIEW] if statement else None))
+
+    def _record(self, record):
+        with self._buffer_lock:
+            self._buffer.append(record)
+            if len(self._buffer) < FLUSH_SIZE and time.monotonic() - self._flushed_at < FLUSH_INTERVAL:
+                return
+            records, self._buffer = self._buffer, []
+            self._flushed_at = time.monotonic()
+        try:
+            self.store.write(records)
+        except sqlite3.Error:
+            # Отчет о медленных маршрутах не должен ломать ответы
+            pass
+
+    def flush(self):
+        """Записать накопленные записи в файл"""
+        with self._buffer_lock:
+            records, self._buffer = self._buffer, []
+            self._flushed_at = time.monotonic()
+        if records and self.store is not None:
+            try:
+                self.store.write(records)
+            except sqlite3.Error:
+                pass
+
+    def metrics_view(self):
+        """Счетчики этого процесса в формате Prometheus"""
+        # Адрес клиента не проверяем: за прокси на том же хосте все запросы приходят с localhost
+        token = current_app.config.get('METRICS_TOKEN')
+        authorized = bool(token) and hmac.compare_digest(
+            request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+        if not authorized and getattr(current_user, 'role', None) != 'admin':
+            abort(403)
+        text = self.routes.render()
+        for collector in self.collectors:
+            for metric in collector():
+                text += '\n'.join(_metric_lines(*metric)) + '\n'
+        return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+def _on_request_started(sender, **extra):
+    g.request_metrics = RequestMetrics()
+
+
+def _request_metrics():
+    return g.get('request_metrics') if has_request_context() else None
+
+
+# Счетчики блоков count_queries() текущего потока
+_local = threading.local()
+
+
+def thread_counters():
+    """Список счетчиков запросов текущего потока: [{'count': n}, ...]"""
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    return counters
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_started'].pop()
+    metrics = _request_metrics()
+    if metrics is not None:
+        metrics.queries += 1
+        metrics.sql_time += elapsed
+        metrics.statements[statement] = metrics.statements.get(statement, 0) + 1
+    for counter in thread_counters():
+        counter['count'] += 1
+
+
+def _on_error(context):
+    # Запрос завершился ошибкой - after_cursor_execute не будет
+    conn = context.connection
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+
+def _on_commit(conn):
+    metrics = _request_metrics()
+    if metrics is not None:
+        metrics.commits += 1
+
+
+def _on_before_render(sender, template, context, **extra):
+    metrics = _request_metrics()
+    if metrics is not None:
+        metrics.render_stack.append(perf_counter())
+
+
+def _on_rendered(sender, template, context, **extra):
+    metrics = _request_metrics()
+    if metrics is not None and metrics.render_stack:
+        started = metrics.render_stack.pop()
+        # Вложенный рендер уже входит во время внешнего
+        if not metrics.render_stack:
+            metrics.render_time += perf_counter() - started
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,312 @@
+# Фоновые задачи без внешнего брокера: очередь - таблица jobs в основной БД,
+# выполняют ее рабочие процессы (flask jobs-worker). Маршрут ставит задачу и сразу
+# возвращает ее id, ход выполнения читается через /api/jobs/<id>.
+# Повтор при ошибке - с нарастающей паузой, ключ идемпотентности не дает
+# поставить одну и ту же задачу дважды (повторная отправка формы, ретрай клиента).
+# Рабочие процессы пишут в БД сами: кеш app_cache в памяти веб-процесса об этом
+# не узнает до истечения TTL, поэтому при отдельных рабочих нужен общий CACHE_URL.
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db
+
+# Пауза перед повтором: JOB_RETRY_DELAY * 2 ** (попытка - 1) секунд
+JOB_RETRY_DELAY = 10
+JOB_MAX_ATTEMPTS = 3
+# Задача, от которой нет вестей столько секунд, считается брошенной (процесс умер)
+JOB_STALE_AFTER = 600
+# Пока задача выполняется, рабочий отмечается так часто (фоновым потоком), секунды
+JOB_HEARTBEAT_INTERVAL = 30
+# Пауза рабочего процесса при пустой очереди, секунды
+JOB_POLL_INTERVAL = 1.0
+# Готовые задачи и их файлы хранятся столько дней
+JOB_RETENTION_DAYS = 7
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+HANDLERS = {}
+
+
+class Job(db.Model):
+    """Фоновая задача"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=QUEUED)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=JOB_MAX_ATTEMPTS)
+    # Ключ идемпотентности с префиксом автора: одна задача на ключ
+    idempotency_key = db.Column(db.String(200), unique=True)
+    created_by = db.Column(db.String(50))
+    worker = db.Column(db.String(100))
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'percent': round(100 * self.progress / self.total) if self.total else (100 if self.status == DONE else 0),
+            'attempts': self.attempts,
+            'result': json.loads(self.result) if self.result else None,
+            # Трассировка остается в БД, наружу - только последняя строка
+            'error': self.error.strip().splitlines()[-1] if self.status == FAILED and self.error else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+def job(kind, max_attempts=JOB_MAX_ATTEMPTS):
+    """Зарегистрировать обработчик задачи: function(context, **params) -> результат (JSON)"""
+
+    def register(function):
+        HANDLERS[kind] = (function, max_attempts)
+        return function
+
+    return register
+
+
+def find_job(idempotency_key, created_by=None):
+    """Задача, уже поставленная с этим ключом идемпотентности, или None"""
+    if not idempotency_key:
+        return None
+    return Job.query.filter_by(idempotency_key=f'{created_by}:{idempotency_key}').first()
+
+
+def enqueue(kind, params=None, idempotency_key=None, created_by=None):
+    """Поставить задачу в очередь и вернуть ее.
+
+    Если задача с тем же ключом идемпотентности уже есть, возвращается она.
+    """
+    _, max_attempts = HANDLERS[kind]
+    existing = find_job(idempotency_key, created_by)
+    if existing is not None:
+        return existing
+    key = f'{created_by}:{idempotency_key}' if idempotency_key else None
+    new_job = Job(kind=kind, params=json.dumps(params or {}, ensure_ascii=False), idempotency_key=key,
+                  created_by=created_by, max_attempts=max_attempts, status=QUEUED, run_after=datetime.utcnow())
+    db.session.add(new_job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Тот же ключ только что поставил параллельный запрос
+        db.session.rollback()
+        return Job.query.filter_by(idempotency_key=key).one()
+    return new_job
+
+
+def enqueue_once(kind, delay=0):
+    """Поставить задачу без параметров, если такой же еще нет в очереди; возвращает ее id.
+
+    Пишет отдельной транзакцией, поэтому годится и для after_commit. Пока задача ждет
+    delay секунд, повторные вызовы сливаются с ней.
+    """
+    _, max_attempts = HANDLERS[kind]
+    table = Job.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        queued = conn.execute(
+            db.select(table.c.id).where(table.c.kind == kind, table.c.status == QUEUED).limit(1)
+        ).scalar()
+        if queued is not None:
+            return queued
+        return conn.execute(table.insert().values(
+            kind=kind, params='{}', status=QUEUED, max_attempts=max_attempts,
+            run_after=now + timedelta(seconds=delay), created_at=now
+        )).inserted_primary_key[0]
+
+
+class JobContext:
+    """Передается обработчику первым аргументом: отметка прогресса задачи"""
+
+    def __init__(self, job_id, worker):
+        self.job_id = job_id
+        self.worker = worker
+
+    def progress(self, done, total=None):
+        """Отметить ход выполнения (отдельной транзакцией, вызывать между коммитами обработчика)"""
+        values = {'progress': done, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            values['total'] = total
+        _update(self.job_id, self.worker, **values)
+
+
+def _update(job_id, owner, engine=None, **values):
+    # Запись только от процесса, который держит задачу
+    table = Job.__table__
+    with (engine or db.engine).begin() as conn:
+        conn.execute(table.update().where(table.c.id == job_id, table.c.worker == owner).values(**values))
+
+
+def _requeue_stale():
+    """Вернуть в очередь задачи, рабочий процесс которых перестал отмечаться"""
+    table = Job.__table__
+    now = datetime.utcnow()
+    stale = (table.c.status == RUNNING) & (table.c.heartbeat_at < now - timedelta(seconds=JOB_STALE_AFTER))
+    error = 'Рабочий процесс не отвечает'
+    with db.engine.begin() as conn:
+        # Задачи без права на повтор (импорт учеников) заново не запускаются
+        conn.execute(table.update().where(stale, table.c.attempts >= table.c.max_attempts)
+                     .values(status=FAILED, worker=None, error=error, finished_at=now))
+        conn.execute(table.update().where(stale).values(status=QUEUED, worker=None, error=error))
+
+
+def claim(worker):
+    """Взять следующую задачу из очереди; None, если брать нечего"""
+    table = Job.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        job_id = conn.execute(
+            db.select(table.c.id).where(table.c.status == QUEUED, table.c.run_after <= now)
+            .order_by(table.c.run_after, table.c.id).limit(1)
+        ).scalar()
+        if job_id is None:
+            return None
+        # Условие на статус: задачу, взятую другим процессом, второй раз не взять
+        taken = conn.execute(table.update().where(table.c.id == job_id, table.c.status == QUEUED).values(
+            status=RUNNING, worker=worker, attempts=table.c.attempts + 1,
+            started_at=now, heartbeat_at=now, progress=0
+        )).rowcount
+    return job_id if taken else claim(worker)
+
+
+class _Heartbeat(threading.Thread):
+    """Отметки живости задачи, независимые от progress() обработчика"""
+
+    def __init__(self, job_id, worker, engine, interval=None):
+        super().__init__(name=f'jobs-heartbeat-{job_id}', daemon=True)
+        self.job_id = job_id
+        self.worker = worker
+        self.engine = engine
+        self.interval = interval or JOB_HEARTBEAT_INTERVAL
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                _update(self.job_id, self.worker, engine=self.engine, heartbeat_at=datetime.utcnow())
+            except Exception:
+                # Пропущенная отметка не страшна: следующая будет через interval
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(job_id, worker):
+    """Выполнить взятую задачу и записать результат, повтор или ошибку"""
+    current = db.session.get(Job, job_id)
+    function, _ = HANDLERS.get(current.kind, (None, None))
+    params, attempts, max_attempts = json.loads(current.params), current.attempts, current.max_attempts
+    db.session.rollback()
+    heartbeat = _Heartbeat(job_id, worker, db.engine)
+    heartbeat.start()
+    try:
+        if function is None:
+            raise LookupError(f'Неизвестный тип задачи: {current.kind}')
+        result = function(JobContext(job_id, worker), **params)
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc(limit=5)
+        if attempts < max_attempts:
+            delay = JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            _update(job_id, worker, status=QUEUED, error=error, worker=None,
+                    run_after=datetime.utcnow() + timedelta(seconds=delay))
+        else:
+            _update(job_id, worker, status=FAILED, error=error, finished_at=datetime.utcnow())
+        return False
+    finally:
+        heartbeat.stop()
+        db.session.remove()
+    _update(job_id, worker, status=DONE, error=None, finished_at=datetime.utcnow(),
+            result=json.dumps(result, ensure_ascii=False, default=str))
+    return True
+
+
+def run_pending(worker=None, limit=None):
+    """Выполнять задачи из очереди, пока она не опустеет; возвращает число выполненных"""
+    worker = worker or _worker_name()
+    _requeue_stale()
+    done = 0
+    while limit is None or done < limit:
+        job_id = claim(worker)
+        if job_id is None:
+            break
+        run_job(job_id, worker)
+        done += 1
+    return done
+
+
+def purge_finished(days=JOB_RETENTION_DAYS):
+    """Удалить давно завершенные задачи; возвращает их число"""
+    table = Job.__table__
+    before = datetime.utcnow() - timedelta(days=days)
+    with db.engine.begin() as conn:
+        return conn.execute(table.delete().where(
+            table.c.status.in_((DONE, FAILED)), table.c.finished_at < before
+        )).rowcount
+
+
+def _worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def work_forever(app, poll_interval=JOB_POLL_INTERVAL, stop=None):
+    """Цикл рабочего: выполнять задачи, при пустой очереди ждать poll_interval"""
+    while stop is None or not stop.is_set():
+        with app.app_context():
+            done = run_pending()
+        if not done:
+            time.sleep(poll_interval)
+
+
+def _process_main(app, poll_interval):
+    # Подключения, открытые до fork, дочернему процессу использовать нельзя
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    try:
+        work_forever(app, poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def start_worker_pool(app, processes=2, poll_interval=JOB_POLL_INTERVAL):
+    """Запустить processes рабочих процессов; возвращает их список"""
+    context = multiprocessing.get_context('fork') if hasattr(os, 'fork') else multiprocessing.get_context()
+    pool = [context.Process(target=_process_main, args=(app, poll_interval), name=f'jobs-worker-{number}')
+            for number in range(processes)]
+    for process in pool:
+        process.start()
+    return pool
+
+
+def start_worker_thread(app, poll_interval=JOB_POLL_INTERVAL):
+    """Рабочий поток внутри веб-процесса (для сервера разработки)"""
+    thread = threading.Thread(target=work_forever, args=(app, poll_interval), name='jobs-worker', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,231 @@
+# Версионированные миграции схемы БД. Запускаются один раз перед стартом
+# рабочих процессов: flask migrate (процессы приложения схему не трогают).
+# Новая миграция добавляется в конец с очередным номером и не меняется
+# после выпуска; каждая миграция должна быть безопасна для повторного запуска.
+from datetime import datetime
+
+from sqlalchemy.schema import CreateTable
+
+from models import db, Event, Participation, TableVersion, DirtyRating
+from models import StudentRanking, ClassRanking, LeaderboardState, refresh_rankings
+from models import create_missing_indexes, ensure_paper_collection_unique_index, ensure_paper_rollups
+from jobs import Job
+
+# Размер порции при копировании таблиц
+MIGRATION_BATCH_SIZE = 1000
+
+MIGRATIONS = []
+
+
+class SchemaMigration(db.Model):
+    """Примененные миграции"""
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def migration(version, name):
+    """Зарегистрировать функцию миграции под номером version"""
+
+    def register(function):
+        MIGRATIONS.append((version, name, function))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+
+    return register
+
+
+def applied_versions():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    return set(db.session.scalars(db.select(SchemaMigration.version)))
+
+
+def pending_migrations():
+    """Миграции, которые еще не применены, по порядку: [(version, name), ...]"""
+    applied = applied_versions()
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+def migrate(echo=None):
+    """Применить все недостающие миграции по порядку; возвращает их список"""
+    applied = applied_versions()
+    done = []
+    for version, name, function in MIGRATIONS:
+        if version in applied:
+            continue
+        if echo:
+            echo(f'{version:04d} {name}')
+        function()
+        db.session.add(SchemaMigration(version=version, name=name))
+        db.session.commit()
+        done.append((version, name))
+    return done
+
+
+def stamp_migrations():
+    """Отметить все миграции примененными (схема только что создана через create_all)"""
+    applied = applied_versions()
+    for version, name, _ in MIGRATIONS:
+        if version not in applied:
+            db.session.add(SchemaMigration(version=version, name=name))
+    db.session.commit()
+
+
+def _table_columns(table_name):
+    return [column['name'] for column in db.inspect(db.engine).get_columns(table_name)]
+
+
+def rebuild_table(table, batch_size=MIGRATION_BATCH_SIZE):
+    """Пересоздать таблицу SQLite по описанию модели без долгой блокировки записи.
+
+    Новая таблица заполняется порциями по первичному ключу, каждая порция - отдельная
+    транзакция. Изменения, сделанные во время копирования, переносятся триггерами.
+    Замена таблицы выполняется одной короткой транзакцией. Переносятся столбцы,
+    которые есть и в старой таблице, и в модели.
+    """
+    name = table.name
+    new_name = f'{name}_new'
+    columns = [column for column in _table_columns(name) if column in table.c]
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'NEW.{column}' for column in columns)
+    # Копия описания нужна в той же MetaData, чтобы разрешились внешние ключи
+    new_table = table.to_metadata(db.metadata, name=new_name)
+    try:
+        create_new_table = str(CreateTable(new_table).compile(db.engine))
+    finally:
+        db.metadata.remove(new_table)
+
+    with db.engine.begin() as conn:
+        for suffix in ('ins', 'upd', 'del'):
+            conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}_copy_{suffix}')
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS {new_name}')
+        conn.exec_driver_sql(create_new_table)
+        conn.exec_driver_sql(
+            f'CREATE TRIGGER {name}_copy_ins AFTER INSERT ON {name} BEGIN '
+            f'INSERT OR REPLACE INTO {new_name} ({column_list}) VALUES ({new_values}); END'
+        )
+        conn.exec_driver_sql(
+            f'CREATE TRIGGER {name}_copy_upd AFTER UPDATE ON {name} BEGIN '
+            f'INSERT OR REPLACE INTO {new_name} ({column_list}) VALUES ({new_values}); END'
+        )
+        conn.exec_driver_sql(
+            f'CREATE TRIGGER {name}_copy_del AFTER DELETE ON {name} BEGIN '
+            f'DELETE FROM {new_name} WHERE id = OLD.id; END'
+        )
+
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            upper = conn.exec_driver_sql(
+                f'SELECT max(id) FROM (SELECT id FROM {name} WHERE id > ? ORDER BY id LIMIT ?)',
+                (last_id, batch_size)
+            ).scalar()
+            if upper is None:
+                break
+            # Строки, уже перенесенные триггерами, новее копируемых - их не трогаем
+            conn.exec_driver_sql(
+                f'INSERT OR IGNORE INTO {new_name} ({column_list}) '
+                f'SELECT {column_list} FROM {name} WHERE id > ? AND id <= ?',
+                (last_id, upper)
+            )
+            last_id = upper
+
+    with db.engine.begin() as conn:
+        for suffix in ('ins', 'upd', 'del'):
+            conn.exec_driver_sql(f'DROP TRIGGER {name}_copy_{suffix}')
+        conn.exec_driver_sql(f'DROP TABLE {name}')
+        conn.exec_driver_sql(f'ALTER TABLE {new_name} RENAME TO {name}')
+        for index in table.indexes:
+            index.create(conn)
+
+
+# ===== МИГРАЦИИ =====
+@migration(1, 'create_tables')
+def _create_tables():
+    # Создает отсутствующие таблицы; существующие не затрагиваются
+    db.create_all()
+
+
+@migration(2, 'events_class_points')
+def _events_class_points():
+    # Раньше выполнялось маршрутом /update-db
+    if 'class_points' in _table_columns(Event.__tablename__):
+        return
+    if db.engine.dialect.name == 'sqlite':
+        rebuild_table(Event.__table__)
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('UPDATE events SET class_points = 0 WHERE class_points IS NULL')
+    else:
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('ALTER TABLE events ADD COLUMN class_points INTEGER DEFAULT 0')
+
+
+@migration(3, 'paper_collections_unique')
+def _paper_collections_unique():
+    ensure_paper_collection_unique_index()
+
+
+@migration(4, 'query_indexes')
+def _query_indexes():
+    create_missing_indexes()
+
+
+@migration(5, 'paper_rollups')
+def _paper_rollups():
+    ensure_paper_rollups()
+
+
+@migration(6, 'table_versions')
+def _table_versions():
+    TableVersion.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(7, 'keyset_indexes')
+def _keyset_indexes():
+    create_missing_indexes()
+
+
+@migration(8, 'jobs')
+def _jobs():
+    Job.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(9, 'dirty_ratings')
+def _dirty_ratings():
+    DirtyRating.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(10, 'created_at_not_null')
+def _created_at_not_null():
+    # created_at - ключ постраничного вывода (keyset_page) и не может быть NULL
+    events, participations = Event.__table__, Participation.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        earliest = conn.scalar(db.select(db.func.min(events.c.created_at)))
+        conn.execute(events.update().where(events.c.created_at.is_(None)).values(created_at=earliest or now))
+        event_created = db.select(events.c.created_at).where(
+            events.c.id == participations.c.event_id
+        ).scalar_subquery()
+        conn.execute(participations.update().where(participations.c.created_at.is_(None)).values(
+            created_at=db.func.coalesce(participations.c.approved_at, event_created, now)
+        ))
+
+    for table in (events, participations):
+        columns = {column['name']: column for column in db.inspect(db.engine).get_columns(table.name)}
+        if not columns['created_at']['nullable']:
+            continue
+        if db.engine.dialect.name == 'sqlite':
+            rebuild_table(table)
+        else:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ALTER COLUMN created_at SET NOT NULL')
+
+
+@migration(11, 'rankings')
+def _rankings():
+    # Страницы рейтингов только читают таблицы рейтингов: в существующей БД их нужно собрать
+    for model in (StudentRanking, ClassRanking, LeaderboardState):
+        model.__table__.create(db.engine, checkfirst=True)
+    refresh_rankings()
@@ -1,11 +1,41 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import Table, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql.dml import UpdateBase
 from werkzeug.security import generate_password_hash, check_password_hash
+from cache import app_cache
+from database import RoutingSession
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+import atexit
+import csv
+import io
+import logging
+import os
 import random
 import string
+import threading
+import time
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Баллы за занятое место; участие без места или с любым другим местом = 1 балл
+PLACE_POINTS = {1: 5, 2: 4, 3: 3, 4: 2}
+DEFAULT_PLACE_POINTS = 1
+
+# Префиксы идентификаторов в сессии: пользователи и ученики имеют пересекающиеся id
+USER_PREFIX = 'u'
+STUDENT_PREFIX = 's'
+
+# Классные мероприятия: 2 балла классу за участие (независимо от количества участников)
+CLASS_EVENT_TYPES = ('class', 'both')
+CLASS_EVENT_POINTS = 2
 
 
 class User(UserMixin, db.Model):
@@ -29,6 +59,9 @@ class User(UserMixin, db.Model):
                                                  foreign_keys='PortfolioEntry.approved_by')
     class_points = db.relationship('ClassPoints', backref='teacher', foreign_keys='ClassPoints.assigned_by')
 
+    def get_id(self):
+        return f'{USER_PREFIX}:{self.id}'
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -49,6 +82,9 @@ class SchoolClass(db.Model):
     total_rating = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Количество учеников, заполняется запросом (см. queries.classes_overview)
+    students_count = db.query_expression()
+
     # Связи с учениками и баллами
     students = db.relationship('Student', backref='school_class', lazy=True, cascade='all, delete-orphan')
     class_points = db.relationship('ClassPoints', backref='school_class', lazy=True, cascade='all, delete-orphan')
@@ -57,29 +93,8 @@ class SchoolClass(db.Model):
         return f"{self.grade}{self.name}"
 
     def update_total_rating(self):
-        """Обновить общий рейтинг класса"""
-        # Суммируем баллы от мероприятий
-        participations = Participation.query.join(Student).filter(
-            Student.class_id == self.id,
-            Participation.approved == True
-        ).all()
-
-        event_points = 0
-        # Собираем уникальные мероприятия, в которых участвовал класс
-        participated_events = set()
-
-        for participation in participations:
-            if participation.event.event_type in ['class', 'both']:
-                # Для классных мероприятий даем 2 балла за участие (независимо от количества участников)
-                if participation.event.id not in participated_events:
-                    event_points += 2
-                    participated_events.add(participation.event.id)
-
-        # Добавляем баллы, начисленные классным руководителем
-        teacher_points = sum(cp.points for cp in self.class_points)
-
-        self.total_rating = event_points + teacher_points
-        db.session.commit()
+        """Пересчитать общий рейтинг класса при ближайшем коммите"""
+        rating_scheduler.mark(db.session, classes=[self.id])
 
     def __repr__(self):
         return f'<SchoolClass {self.grade}{self.name}>'
@@ -87,6 +102,13 @@ class SchoolClass(db.Model):
 
 class Student(UserMixin, db.Model):
     __tablename__ = 'students'
+    __table_args__ = (
+        db.Index('ix_students_class_id', 'class_id'),
+        db.Index('ix_students_personal_rating', 'personal_rating'),
+        # Постраничный поиск учеников по ФИО (pagination.keyset_page)
+        db.Index('ix_students_class_name', 'class_id', 'full_name', 'id'),
+        db.Index('ix_students_full_name', 'full_name', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     full_name = db.Column(db.String(100), nullable=False)
@@ -100,6 +122,9 @@ class Student(UserMixin, db.Model):
     participations = db.relationship('Participation', backref='student', lazy=True, cascade='all, delete-orphan')
     portfolio_entries = db.relationship('PortfolioEntry', backref='student', lazy=True, cascade='all, delete-orphan')
 
+    def get_id(self):
+        return f'{STUDENT_PREFIX}:{self.id}'
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -107,75 +132,17 @@ class Student(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def update_personal_rating(self):
-        """Обновить личный рейтинг ученика"""
-        total = 0
-        for participation in self.participations:
-            if participation.approved:
-                # Участие без указания места = 1 балл
-                if participation.place is None:
-                    total += 1
-                # Участие с указанием места
-                elif participation.place == 1:
-                    total += 5
-                elif participation.place == 2:
-                    total += 4
-                elif participation.place == 3:
-                    total += 3
-                elif participation.place == 4:
-                    total += 2
-                # Любое другое место (участие) = 1 балл
-                else:
-                    total += 1
-
-        # Добавляем баллы из портфолио
-        portfolio_points = sum(entry.points_earned for entry in self.portfolio_entries if entry.approved)
-
-        self.personal_rating = total + portfolio_points
-        db.session.commit()
-
-        self.personal_rating = total + portfolio_points
+        """Обновить личный рейтинг ученика (полный пересчет одним запросом при коммите)"""
+        rating_scheduler.mark(db.session, students=[self.id])
         db.session.commit()
 
     def get_statistics(self):
-        """Получить статистику ученика"""
-        self.update_personal_rating()
-
-        participations = [p for p in self.participations if p.approved]
-        total_events = len(participations)
-        total_points = self.personal_rating
-
-        # Статистика по уровням мероприятий
-        level_stats = {}
-        for level in ['school', 'city', 'republic', 'russian']:
-            level_participations = [p for p in participations if p.event.level == level]
-            level_points = sum(self._calculate_points(p.place) for p in level_participations)
-            level_stats[level] = {
-                'count': len(level_participations),
-                'points': level_points
-            }
-
-        # Записи в портфолио
-        portfolio_count = len([p for p in self.portfolio_entries if p.approved])
-
-        return {
-            'total_events': total_events,
-            'total_points': total_points,
-            'level_stats': level_stats,
-            'portfolio_entries': portfolio_count
-        }
+        """Получить статистику ученика (только чтение, результат кешируется)"""
+        return student_statistics(self)
 
     def _calculate_points(self, place):
         """Рассчитать баллы за место"""
-        if place == 1:
-            return 5
-        elif place == 2:
-            return 4
-        elif place == 3:
-            return 3
-        elif place == 4:
-            return 2
-        else:
-            return 1
+        return Participation.points_for_place(place)
 
     def __repr__(self):
         return f'<Student {self.full_name}>'
@@ -183,6 +150,10 @@ class Student(UserMixin, db.Model):
 
 class Event(db.Model):
     __tablename__ = 'events'
+    __table_args__ = (
+        db.Index('ix_events_is_active', 'is_active'),
+        db.Index('ix_events_active_created', 'is_active', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
@@ -192,20 +163,21 @@ class Event(db.Model):
     points = db.Column(db.Integer, nullable=False, default=0)  # устаревшее поле
     class_points = db.Column(db.Integer, default=0)  # баллы для класса
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # ключ keyset_page
     is_active = db.Column(db.Boolean, default=True)
 
     # Связи
     participations = db.relationship('Participation', backref='event', lazy=True, cascade='all, delete-orphan')
 
+    LEVELS = {
+        'school': 'Школьный',
+        'city': 'Городской',
+        'republic': 'Республиканский',
+        'russian': 'Российский'
+    }
+
     def get_level_display(self):
-        levels = {
-            'school': 'Школьный',
-            'city': 'Городской',
-            'republic': 'Республиканский',
-            'russian': 'Российский'
-        }
-        return levels.get(self.level, self.level)
+        return self.LEVELS.get(self.level, self.level)
 
     def get_type_display(self):
         types = {
@@ -221,16 +193,26 @@ class Event(db.Model):
 
 class Participation(db.Model):
     __tablename__ = 'participations'
+    __table_args__ = (
+        # Покрывающий индекс для подсчета баллов ученика (см. _student_rating_sql)
+        db.Index('ix_participations_student_approved_place', 'student_id', 'approved', 'place'),
+        db.Index('ix_participations_event_approved', 'event_id', 'approved'),
+        db.Index('ix_participations_student_approved_created', 'student_id', 'approved', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
-    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    # active_history: при переносе на другого ученика прежний student_id загружается,
+    # чтобы снять баллы с прежнего ученика (см. _apply_rating_deltas)
+    student_id = db.orm.column_property(
+        db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False), active_history=True
+    )
     news_link = db.Column(db.String(500))
     participants_count = db.Column(db.Integer, default=1)
     media_files = db.Column(db.String(500))
     description = db.Column(db.Text)
     place = db.Column(db.Integer, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # ключ keyset_page
     approved = db.Column(db.Boolean, default=False)
     approved_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     approved_at = db.Column(db.DateTime)
@@ -251,22 +233,20 @@ class Participation(db.Model):
         """Получить количество заработанных баллов"""
         if not self.approved:
             return 0
+        return self.points_for_place(self.place)
 
-        # Участие без указания места = 1 балл
-        if self.place is None:
-            return 1
-        # Участие с указанием места
-        elif self.place == 1:
-            return 5
-        elif self.place == 2:
-            return 4
-        elif self.place == 3:
-            return 3
-        elif self.place == 4:
-            return 2
-        # Любое другое место (участие) = 1 балл
-        else:
-            return 1
+    @staticmethod
+    def points_for_place(place):
+        """Баллы за место (None или любое место после 4-го = участие)"""
+        return PLACE_POINTS.get(place, DEFAULT_PLACE_POINTS)
+
+    @staticmethod
+    def points_sql(place_column):
+        """SQL-выражение CASE с теми же правилами начисления, что и points_for_place"""
+        return db.case(
+            *[(place_column == place, points) for place, points in PLACE_POINTS.items()],
+            else_=DEFAULT_PLACE_POINTS
+        )
 
     def get_place_display(self):
         if self.place == 1:
@@ -287,9 +267,14 @@ class Participation(db.Model):
 
 class PortfolioEntry(db.Model):
     __tablename__ = 'portfolio_entries'
+    __table_args__ = (
+        db.Index('ix_portfolio_entries_student_approved', 'student_id', 'approved'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    student_id = db.orm.column_property(
+        db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False), active_history=True
+    )  # см. Participation.student_id
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
     entry_type = db.Column(db.String(50), nullable=False)
@@ -318,6 +303,9 @@ class PortfolioEntry(db.Model):
 
 class ClassPoints(db.Model):
     __tablename__ = 'class_points'
+    __table_args__ = (
+        db.Index('ix_class_points_class_created', 'class_id', 'created_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     class_id = db.Column(db.Integer, db.ForeignKey('school_classes.id'), nullable=False)
@@ -364,8 +352,8 @@ def create_students_from_list(student_names, class_id, class_name):
 
     return students_data
 # Вспомогательные функции
-def generate_student_login(full_name, class_name):
-    """Генерация логина для ученика"""
+def _base_student_login(full_name, class_name):
+    """Логин ученика без счетчика уникальности"""
     names = full_name.split()
     if len(names) >= 2:
         last_name = names[0].lower()
@@ -375,7 +363,12 @@ def generate_student_login(full_name, class_name):
     else:
         base_login = full_name.lower().replace(' ', '_')
 
-    login = f"{base_login}_{class_name.lower().replace(' ', '')}"
+    return f"{base_login}_{class_name.lower().replace(' ', '')}"
+
+
+def generate_student_login(full_name, class_name):
+    """Генерация логина для ученика"""
+    login = _base_student_login(full_name, class_name)
 
     # Проверяем уникальность
     counter = 1
@@ -387,8 +380,30 @@ def generate_student_login(full_name, class_name):
     return login
 
 
+def generate_student_logins(full_names, class_name, existing_logins):
+    """Генерация логинов для списка учеников без запросов к БД.
+
+    existing_logins - множество уже занятых логинов; пополняется новыми.
+    """
+    logins = []
+    for full_name in full_names:
+        original_login = login = _base_student_login(full_name, class_name)
+        counter = 1
+        while login in existing_logins:
+            login = f"{original_login}{counter}"
+            counter += 1
+        existing_logins.add(login)
+        logins.append(login)
+    return logins
+
+
 class PaperCollection(db.Model):
     __tablename__ = 'paper_collections'
+    __table_args__ = (
+        # Одна запись на ученика, класс и дату сдачи (цель для INSERT ... ON CONFLICT)
+        db.Index('uq_paper_collections_student_class_date', 'student_id', 'class_id', 'collection_date', unique=True),
+        db.Index('ix_paper_collections_class_date', 'class_id', 'collection_date', 'kilograms'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
@@ -432,4 +447,1384 @@ def create_students_from_list(student_names, class_id, class_name):
                 'password': password  # сохраняем пароль
             })
 
-    return students_data
\ No newline at end of file
+    return students_data
+
+# ===== ИНКРЕМЕНТАЛЬНЫЙ ПЕРЕСЧЕТ ЛИЧНОГО РЕЙТИНГА =====
+def _participation_points(approved, place):
+    return Participation.points_for_place(place) if approved else 0
+
+
+def _portfolio_points(approved, points_earned):
+    return (points_earned or 0) if approved else 0
+
+
+_UNKNOWN = object()
+
+
+def _attr_values(obj, key):
+    """Старое и новое значение атрибута в рамках текущего flush.
+
+    Если старое значение не было загружено, возвращается _UNKNOWN -
+    такой ученик пересчитывается полностью.
+    """
+    history = get_history(obj, key)
+    if history.added:
+        new = history.added[0]
+        old = history.deleted[0] if history.deleted else _UNKNOWN
+    elif history.unchanged:
+        new = old = history.unchanged[0]
+    else:
+        new = old = history.deleted[0] if history.deleted else None
+    return old, new
+
+
+
+def _rating_source(obj):
+    """Поля, влияющие на рейтинг, и функция подсчета баллов для объекта"""
+    if isinstance(obj, Participation):
+        return ('student_id', 'approved', 'place'), _participation_points
+    if isinstance(obj, PortfolioEntry):
+        return ('student_id', 'approved', 'points_earned'), _portfolio_points
+    return None
+
+
+def _student_rating_sql(student_id_column):
+    """Коррелированный подзапрос: полный личный рейтинг ученика"""
+    participation_points = db.select(
+        db.func.coalesce(db.func.sum(Participation.points_sql(Participation.place)), 0)
+    ).where(
+        Participation.student_id == student_id_column,
+        Participation.approved == True
+    ).scalar_subquery()
+
+    portfolio_points = db.select(
+        db.func.coalesce(db.func.sum(PortfolioEntry.points_earned), 0)
+    ).where(
+        PortfolioEntry.student_id == student_id_column,
+        PortfolioEntry.approved == True
+    ).scalar_subquery()
+
+    return participation_points + portfolio_points
+
+
+def _apply_rating_deltas_sql(connection, deltas):
+    """Прибавить дельты {student_id: баллы} к personal_rating одним executemany"""
+    students = Student.__table__
+    connection.execute(
+        students.update()
+        .where(students.c.id == db.bindparam('b_student_id'))
+        .values(personal_rating=db.func.coalesce(students.c.personal_rating, 0) + db.bindparam('b_delta')),
+        [{'b_student_id': student_id, 'b_delta': delta} for student_id, delta in deltas.items()]
+    )
+
+
+@event.listens_for(Session, 'after_flush')
+def _apply_rating_deltas(session, flush_context):
+    """Применить изменения баллов от участий и записей портфолио одним UPDATE"""
+    deltas = {}
+    recompute = set()
+
+    def add(student_id, points):
+        if student_id is not None and points:
+            deltas[student_id] = deltas.get(student_id, 0) + points
+
+    for obj in session.new:
+        source = _rating_source(obj)
+        if source:
+            keys, points = source
+            add(obj.student_id, points(*(getattr(obj, key) for key in keys[1:])))
+
+    for obj in session.deleted:
+        source = _rating_source(obj)
+        if source:
+            keys, points = source
+            old = [_attr_values(obj, key)[0] for key in keys]
+            if _UNKNOWN in old:
+                recompute.add(_attr_values(obj, 'student_id')[1])
+            else:
+                add(old[0], -points(*old[1:]))
+
+    for obj in session.dirty:
+        source = _rating_source(obj)
+        if not source or not session.is_modified(obj):
+            continue
+        keys, points = source
+        values = [_attr_values(obj, key) for key in keys]
+        old = [value[0] for value in values]
+        new = [value[1] for value in values]
+        if _UNKNOWN in old:
+            recompute.update(v for v in (old[0], new[0]) if v is not _UNKNOWN)
+            continue
+        if old != new:
+            add(old[0], -points(*old[1:]))
+            add(new[0], points(*new[1:]))
+
+    # Явно записанный в этом flush рейтинг имеет приоритет над дельтой
+    for obj in session.dirty:
+        if isinstance(obj, Student) and get_history(obj, 'personal_rating').added:
+            deltas.pop(obj.id, None)
+            recompute.discard(obj.id)
+
+    recompute.discard(None)
+    for student_id in recompute:
+        deltas.pop(student_id, None)
+    deltas = {student_id: delta for student_id, delta in deltas.items() if delta}
+    if not deltas and not recompute:
+        return
+
+    if recompute:
+        # Полный пересчет - один раз на транзакцию, сколько бы flush ни было
+        rating_scheduler.mark(session, students=recompute)
+    if deltas:
+        _apply_rating_deltas_sql(session.connection(), deltas)
+        session.info.setdefault('rating_touched', set()).update(deltas)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _expire_touched_ratings(session, flush_context):
+    """Сбросить устаревший personal_rating у загруженных учеников"""
+    touched = session.info.pop('rating_touched', None)
+    if touched:
+        _expire_loaded(session, Student, touched, 'personal_rating')
+
+
+def _expire_loaded(session, model, ids, attribute):
+    """Сбросить атрибут у уже загруженных в сессию объектов (значение изменено запросом)"""
+    mapper = db.inspect(model)
+    for object_id in ids:
+        obj = session.identity_map.get(mapper.identity_key_from_primary_key((object_id,)))
+        if obj is not None:
+            session.expire(obj, [attribute])
+
+
+def recompute_all(fix=True):
+    """Сверка: пересчитать personal_rating всех учеников с нуля.
+
+    Возвращает список расхождений [{'student_id', 'full_name', 'stored', 'expected'}].
+    При fix=True расхождения исправляются одним executemany.
+    """
+    expected = _student_rating_sql(Student.id).label('expected')
+    rows = db.session.execute(
+        db.select(Student.id, Student.full_name, Student.personal_rating, expected)
+    ).all()
+
+    drift = [
+        {'student_id': row.id, 'full_name': row.full_name,
+         'stored': row.personal_rating, 'expected': row.expected}
+        for row in rows if (row.personal_rating or 0) != row.expected or row.personal_rating is None
+    ]
+
+    if fix and drift:
+        students = Student.__table__
+        db.session.execute(
+            students.update()
+            .where(students.c.id == db.bindparam('b_student_id'))
+            .values(personal_rating=db.bindparam('b_rating')),
+            [{'b_student_id': item['student_id'], 'b_rating': item['expected']} for item in drift]
+        )
+        mark_rankings_stale()
+        invalidate_tags_after_commit(db.session, 'ratings')
+        for item in drift:
+            invalidate_after_commit(db.session, statistics_cache, item['student_id'])
+        db.session.commit()
+
+    return drift
+
+
+# ===== ПЕРЕСЧЕТ РЕЙТИНГА КЛАССОВ =====
+def recompute_class_ratings(class_ids=None, fix=True):
+    """Пересчитать total_rating классов одним агрегирующим запросом.
+
+    Баллы класса = CLASS_EVENT_POINTS за каждое уникальное классное мероприятие
+    с подтвержденным участием + сумма баллов от классного руководителя.
+    Возвращает список изменений [{'class_id', 'class_name', 'stored', 'expected'}];
+    при fix=True они записываются одним executemany.
+    """
+    changes = _class_rating_changes(class_ids)
+    if fix:
+        _write_class_ratings(db.session, changes)
+        db.session.commit()
+
+    return changes
+
+
+def _class_rating_changes(class_ids=None, session=None):
+    events_query = db.select(
+        Student.class_id.label('class_id'),
+        db.func.count(db.distinct(Participation.event_id)).label('events_count')
+    ).select_from(Participation).join(
+        Student, Student.id == Participation.student_id
+    ).join(
+        Event, Event.id == Participation.event_id
+    ).where(
+        Participation.approved == True,
+        Event.event_type.in_(CLASS_EVENT_TYPES)
+    ).group_by(Student.class_id)
+
+    teacher_query = db.select(
+        ClassPoints.class_id.label('class_id'),
+        db.func.sum(ClassPoints.points).label('points')
+    ).group_by(ClassPoints.class_id)
+
+    if class_ids is not None:
+        events_query = events_query.where(Student.class_id.in_(class_ids))
+        teacher_query = teacher_query.where(ClassPoints.class_id.in_(class_ids))
+    events_sub = events_query.subquery()
+    teacher_sub = teacher_query.subquery()
+
+    expected = (
+        db.func.coalesce(events_sub.c.events_count, 0) * CLASS_EVENT_POINTS
+        + db.func.coalesce(teacher_sub.c.points, 0)
+    ).label('expected')
+    query = db.select(
+        SchoolClass.id, SchoolClass.grade, SchoolClass.name, SchoolClass.total_rating, expected
+    ).outerjoin(
+        events_sub, events_sub.c.class_id == SchoolClass.id
+    ).outerjoin(
+        teacher_sub, teacher_sub.c.class_id == SchoolClass.id
+    )
+    if class_ids is not None:
+        query = query.where(SchoolClass.id.in_(class_ids))
+    rows = (session or db.session).execute(query).all()
+
+    return [
+        {'class_id': row.id, 'class_name': f"{row.grade}{row.name}",
+         'stored': row.total_rating, 'expected': row.expected}
+        for row in rows if row.total_rating != row.expected
+    ]
+
+
+def _write_class_ratings(session, changes):
+    if not changes:
+        return
+    classes = SchoolClass.__table__
+    session.execute(
+        classes.update()
+        .where(classes.c.id == db.bindparam('b_class_id'))
+        .values(total_rating=db.bindparam('b_rating')),
+        [{'b_class_id': item['class_id'], 'b_rating': item['expected']} for item in changes]
+    )
+    mark_rankings_stale(session)
+    invalidate_tags_after_commit(session, 'ratings')
+    _expire_loaded(session, SchoolClass, [item['class_id'] for item in changes], 'total_rating')
+
+
+# ===== ОТЛОЖЕННЫЙ ПЕРЕСЧЕТ РЕЙТИНГОВ =====
+# Запись помечает учеников и классы «грязными» (after_flush или rating_scheduler.mark),
+# пометки одной транзакции сливаются, и перед коммитом каждый рейтинг пересчитывается
+# один раз пакетным запросом в той же транзакции. С RATING_RECOMPUTE_DELAY > 0
+# пометки копятся и между транзакциями: пересчет идет отдельной транзакцией после
+# того, как записи затихнут на столько секунд (но не позже RATING_RECOMPUTE_MAX_WAIT).
+# Отложенные пометки записываются в dirty_ratings той же транзакцией, что и данные:
+# их досчитает любой процесс, даже если пометивший процесс завершился.
+RATING_RECOMPUTE_MAX_WAIT = 10
+# Сколько раз подряд процесс повторяет неудавшийся отложенный пересчет
+RATING_RECOMPUTE_MAX_RETRIES = 5
+
+logger = logging.getLogger(__name__)
+
+
+def _dirty_marks():
+    # students - полный пересчет личного рейтинга; classes - рейтинг класса;
+    # class_students - пересчет класса, в котором учится ученик (класс ищется при пересчете)
+    return {'students': set(), 'classes': set(), 'class_students': set()}
+
+
+class DirtyRating(db.Model):
+    """Отложенная пометка рейтинга (вид - ключ _dirty_marks), ожидающая пересчета"""
+    __tablename__ = 'dirty_ratings'
+
+    kind = db.Column(db.String(16), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+
+
+# Вызываются после коммита, отложившего пересчет рейтингов
+_ratings_deferred_hooks = []
+
+
+def on_ratings_deferred(callback):
+    """Зарегистрировать callback() на коммит транзакции с отложенными пометками рейтингов"""
+    _ratings_deferred_hooks.append(callback)
+    return callback
+
+
+class RatingScheduler:
+    """Слияние пометок и пакетный пересчет рейтингов; счетчики - в counters"""
+
+    def __init__(self):
+        self.delay = 0
+        self.app = None
+        self.counters = {'marked_students': 0, 'marked_classes': 0,
+                         'recomputed_students': 0, 'recomputed_classes': 0, 'batches': 0}
+        self._lock = threading.Lock()
+        self._pending_since = None
+        self._timer = None
+        self._failures = 0
+
+    def configure(self, app):
+        """Настройка RATING_RECOMPUTE_DELAY (секунды, 0 - пересчет в транзакции записи)"""
+        self.app = app
+        self.delay = float(app.config.setdefault(
+            'RATING_RECOMPUTE_DELAY', float(os.environ.get('RATING_RECOMPUTE_DELAY', 0))
+        ))
+        if self.delay:
+            atexit.register(self.flush_pending)
+
+    def mark(self, session, students=(), classes=(), class_students=()):
+        """Пометить рейтинги для пересчета при коммите транзакции session"""
+        dirty = session.info.setdefault('dirty_ratings', _dirty_marks())
+        students, classes, class_students = set(students), set(classes), set(class_students)
+        students.discard(None)
+        classes.discard(None)
+        class_students.discard(None)
+        dirty['students'].update(students)
+        dirty['classes'].update(classes)
+        dirty['class_students'].update(class_students)
+        with self._lock:
+            self.counters['marked_students'] += len(students)
+            self.counters['marked_classes'] += len(classes) + len(class_students)
+
+    def recompute(self, session, dirty):
+        """Пересчитать помеченные рейтинги в транзакции session (без коммита)"""
+        students = Student.__table__
+        student_ids = sorted(dirty['students'])
+        for chunk in _chunks(student_ids):
+            session.execute(
+                students.update()
+                .where(students.c.id.in_(chunk))
+                .values(personal_rating=_student_rating_sql(students.c.id))
+            )
+        if student_ids:
+            mark_rankings_stale(session)
+            invalidate_tags_after_commit(session, 'ratings')
+            for student_id in student_ids:
+                invalidate_after_commit(session, statistics_cache, student_id)
+            _expire_loaded(session, Student, student_ids, 'personal_rating')
+
+        class_ids = set(dirty['classes'])
+        for chunk in _chunks(sorted(dirty['class_students'])):
+            class_ids.update(session.execute(
+                db.select(Student.class_id).where(Student.id.in_(chunk))
+            ).scalars())
+        if class_ids:
+            _write_class_ratings(session, _class_rating_changes(class_ids, session=session))
+
+        with self._lock:
+            self.counters['recomputed_students'] += len(student_ids)
+            self.counters['recomputed_classes'] += len(class_ids)
+            self.counters['batches'] += 1
+
+    def persist(self, session, dirty):
+        """Записать пометки в dirty_ratings в транзакции session; возвращает их число"""
+        rows = [{'kind': kind, 'entity_id': entity_id} for kind, ids in dirty.items() for entity_id in ids]
+        if rows:
+            session.execute(dialect_insert(DirtyRating.__table__).on_conflict_do_nothing(), rows)
+        return len(rows)
+
+    def defer(self):
+        """Отложить пересчет закоммиченных пометок до затишья записей"""
+        with self._lock:
+            now = time.monotonic()
+            if self._pending_since is None:
+                self._pending_since = now
+            # Пока записи идут, таймер сдвигается, но не дальше RATING_RECOMPUTE_MAX_WAIT
+            if self._timer is not None:
+                if now - self._pending_since + self.delay > RATING_RECOMPUTE_MAX_WAIT:
+                    return
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush_pending)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self, session):
+        """Пересчитать все пометки из dirty_ratings в транзакции session (без коммита).
+
+        Таблица блокируется на запись: две транзакции не заберут одни и те же пометки.
+        Возвращает число пометок.
+        """
+        table = DirtyRating.__table__
+        lock_table_for_write(session, table)
+        dirty = _dirty_marks()
+        rows = session.execute(db.select(table.c.kind, table.c.entity_id)).all()
+        for kind, entity_id in rows:
+            dirty[kind].add(entity_id)
+        if rows:
+            session.execute(table.delete())
+            self.recompute(session, dirty)
+        return len(rows)
+
+    def flush_pending(self):
+        """Пересчитать отложенные пометки отдельной транзакцией"""
+        with self._lock:
+            self._pending_since = None
+            self._timer = None
+        with self.app.app_context():
+            try:
+                self.flush(db.session)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._failures += 1
+                    retry = self._failures < RATING_RECOMPUTE_MAX_RETRIES
+                    if not retry:
+                        self._failures = 0
+                if retry:
+                    logger.exception('Отложенный пересчет рейтингов не удался, повтор позже')
+                    self.defer()
+                else:
+                    # Пометки остаются в dirty_ratings: их заберет следующий пересчет любого процесса
+                    logger.exception('Отложенный пересчет рейтингов не удался %s раз подряд',
+                                     RATING_RECOMPUTE_MAX_RETRIES)
+            else:
+                with self._lock:
+                    self._failures = 0
+
+    def metrics(self):
+        """Счетчики для /metrics: пометки, пересчеты и слитые (лишние) пересчеты"""
+        with self._lock:
+            counters = dict(self.counters)
+        samples = {
+            kind: (counters[f'marked_{kind}'], counters[f'recomputed_{kind}'])
+            for kind in ('students', 'classes')
+        }
+        return [
+            ('rating_marks_total', 'counter', 'Rating recompute requests by entity',
+             [('', (('entity', kind),), marked) for kind, (marked, _) in samples.items()]),
+            ('rating_recomputes_total', 'counter', 'Ratings actually recomputed by entity',
+             [('', (('entity', kind),), recomputed) for kind, (_, recomputed) in samples.items()]),
+            ('rating_recomputes_coalesced_total', 'counter', 'Recompute requests merged into another recompute',
+             [('', (('entity', kind),), max(0, marked - recomputed)) for kind, (marked, recomputed) in samples.items()]),
+            ('rating_recompute_batches_total', 'counter', 'Batched recompute runs', [('', (), counters['batches'])]),
+        ]
+
+
+rating_scheduler = RatingScheduler()
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_dirty_class_ratings(session, flush_context):
+    """Пометить классы, рейтинг которых зависит от записанных объектов"""
+    classes, class_students = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        changed = obj in session.new or obj in session.deleted
+        if isinstance(obj, ClassPoints):
+            if changed or any(get_history(obj, key).has_changes() for key in ('points', 'class_id')):
+                classes.update(get_history(obj, 'class_id').sum())
+        elif isinstance(obj, Participation):
+            if changed or any(get_history(obj, key).has_changes() for key in ('approved', 'event_id', 'student_id')):
+                class_students.update(get_history(obj, 'student_id').sum())
+        elif isinstance(obj, Student):
+            if obj in session.deleted or get_history(obj, 'class_id').has_changes():
+                classes.update(get_history(obj, 'class_id').sum())
+    if classes or class_students:
+        rating_scheduler.mark(session, classes=classes, class_students=class_students)
+
+
+# Раньше _bump_table_versions: пересчет меняет таблицы, их версии должны увеличиться
+@event.listens_for(Session, 'before_commit', insert=True)
+def _recompute_dirty_ratings(session):
+    session.flush()
+    dirty = session.info.pop('dirty_ratings', None)
+    if not dirty:
+        return
+    if rating_scheduler.delay:
+        if rating_scheduler.persist(session, dirty):
+            session.info['deferred_ratings'] = True
+    else:
+        rating_scheduler.recompute(session, dirty)
+
+
+@event.listens_for(Session, 'after_commit')
+def _defer_dirty_ratings(session):
+    if not session.info.pop('deferred_ratings', None):
+        return
+    rating_scheduler.defer()
+    for callback in _ratings_deferred_hooks:
+        try:
+            callback()
+        except Exception:
+            # Пометки уже в dirty_ratings; их заберет таймер этого процесса или следующий пересчет
+            logger.exception('Не удалось запланировать отложенный пересчет рейтингов')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_dirty_ratings(session):
+    session.info.pop('dirty_ratings', None)
+    session.info.pop('deferred_ratings', None)
+
+
+# ===== МАССОВАЯ РЕГИСТРАЦИЯ УЧАСТИЯ =====
+SQL_CHUNK_SIZE = 500
+
+
+def _chunks(items, size=SQL_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def register_participations(event, entries, news_link=None, participants_count=None,
+                            description=None, approved=True, approved_by=None, class_ids=None):
+    """Массовая регистрация участия в мероприятии.
+
+    entries - список пар (student_id, place). Ученики, уже зарегистрированные
+    на это мероприятие, пропускаются, поэтому повторный вызов безопасен.
+    Если задан class_ids, принимаются только ученики этих классов.
+    Все участия вставляются одним executemany, рейтинги учеников и классов
+    обновляются агрегированно, коммит - один.
+    """
+    places = {}
+    for student_id, place in entries:
+        places.setdefault(int(student_id), place)
+
+    student_classes = {}
+    already_registered = set()
+    for chunk in _chunks(places):
+        student_query = db.select(Student.id, Student.class_id).where(Student.id.in_(chunk))
+        if class_ids is not None:
+            student_query = student_query.where(Student.class_id.in_(class_ids))
+        student_classes.update(db.session.execute(student_query).all())
+        already_registered.update(db.session.execute(
+            db.select(Participation.student_id).where(
+                Participation.event_id == event.id,
+                Participation.student_id.in_(chunk)
+            )
+        ).scalars())
+
+    unknown = [student_id for student_id in places if student_id not in student_classes]
+    skipped = [student_id for student_id in places if student_id in already_registered]
+    new_ids = [student_id for student_id in places
+               if student_id in student_classes and student_id not in already_registered]
+
+    now = datetime.utcnow()
+    mappings = [{
+        'event_id': event.id,
+        'student_id': student_id,
+        'news_link': news_link,
+        'participants_count': participants_count if participants_count is not None else len(new_ids),
+        'description': description,
+        'place': places[student_id],
+        'approved': approved,
+        'approved_by': approved_by if approved else None,
+        'approved_at': now if approved else None,
+        'created_at': now,
+    } for student_id in new_ids]
+
+    if mappings:
+        db.session.bulk_insert_mappings(Participation, mappings)
+        if approved:
+            deltas = {student_id: Participation.points_for_place(places[student_id]) for student_id in new_ids}
+            _apply_rating_deltas_sql(db.session.connection(), deltas)
+            mark_rankings_stale()
+            invalidate_tags_after_commit(db.session, 'ratings')
+            for student_id in new_ids:
+                invalidate_after_commit(db.session, statistics_cache, student_id)
+
+    if mappings and approved and event.event_type in CLASS_EVENT_TYPES:
+        # bulk_insert_mappings минует after_flush: классы помечаются явно
+        rating_scheduler.mark(db.session, classes={student_classes[student_id] for student_id in new_ids})
+    db.session.commit()
+
+    return {'registered': len(new_ids), 'skipped': skipped, 'unknown': unknown}
+
+
+# ===== ИМПОРТ СПИСКА УЧЕНИКОВ =====
+# Меньше этого числа паролей пул процессов не окупает свой запуск
+PARALLEL_HASH_THRESHOLD = 16
+
+
+def iter_password_hashes(passwords, workers=None):
+    """Хеши паролей в исходном порядке по мере готовности (пул процессов для больших списков)"""
+    passwords = list(passwords)
+    workers = workers or os.cpu_count() or 1
+    if len(passwords) < PARALLEL_HASH_THRESHOLD or workers == 1:
+        for password in passwords:
+            yield generate_password_hash(password)
+        return
+
+    chunksize = max(1, len(passwords) // (workers * 4))
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        yield from pool.map(generate_password_hash, passwords, chunksize=chunksize)
+    finally:
+        # Если потребитель прервал выгрузку, оставшиеся хеши не считаем
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def hash_passwords(passwords, workers=None):
+    """Хеширование паролей в пуле процессов (generate_password_hash медленный)"""
+    return list(iter_password_hashes(passwords, workers=workers))
+
+
+def iter_new_credentials(students, batch_size=100, workers=None):
+    """Сгенерировать новые пароли ученикам и отдавать их пакетами.
+
+    students - последовательность строк с атрибутом id. Пакеты -
+    [(student, password, password_hash), ...]; в БД ничего не пишется: хеши
+    сохраняет save_password_hashes, когда пароли уже выгружены.
+    """
+    students = list(students)
+    passwords = [generate_password() for _ in students]
+
+    batch = []
+    hashes = iter_password_hashes(passwords, workers=workers)
+    try:
+        for student, password, password_hash in zip(students, passwords, hashes):
+            batch.append((student, password, password_hash))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        hashes.close()
+
+
+def save_password_hashes(credentials, chunk_size=SQL_CHUNK_SIZE):
+    """Записать новые хеши паролей; credentials - [(student_id, password_hash)].
+
+    UPDATE идет порциями по chunk_size строк, коммит - один в конце: либо
+    сохраняются все пароли, либо ни одного.
+    """
+    if not credentials:
+        return
+    table = Student.__table__
+    update = table.update().where(table.c.id == db.bindparam('b_student_id')).values(
+        password_hash=db.bindparam('b_password_hash')
+    )
+    for chunk in _chunks(credentials, chunk_size):
+        db.session.execute(update, [
+            {'b_student_id': student_id, 'b_password_hash': password_hash} for student_id, password_hash in chunk
+        ])
+    db.session.commit()
+    for student_id, _ in credentials:
+        principal_cache.delete(f'{STUDENT_PREFIX}:{student_id}')
+
+
+def import_students(student_names, class_id, class_name, chunk_size=SQL_CHUNK_SIZE, workers=None):
+    """Быстрый импорт учеников в класс.
+
+    Занятые логины загружаются одним запросом, коллизии разрешаются в памяти,
+    пароли хешируются параллельно, вставка идет пакетами по chunk_size.
+    Возвращает [{'full_name', 'login', 'password'}].
+    """
+    full_names = [name.strip() for name in student_names if name and name.strip()]
+    if not full_names:
+        return []
+
+    # Все логины класса имеют общий суффикс - загружаем только их
+    suffix = class_name.lower().replace(' ', '')
+    suffix_pattern = '%\\_' + suffix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    existing_logins = set(db.session.execute(
+        db.select(Student.login).where(Student.login.like(suffix_pattern, escape='\\'))
+    ).scalars())
+
+    logins = generate_student_logins(full_names, class_name, existing_logins)
+    passwords = [generate_password() for _ in full_names]
+    password_hashes = hash_passwords(passwords, workers=workers)
+
+    now = datetime.utcnow()
+    rows = [{
+        'full_name': full_name,
+        'class_id': class_id,
+        'login': login,
+        'password_hash': password_hash,
+        'personal_rating': 0,
+        'created_at': now,
+    } for full_name, login, password_hash in zip(full_names, logins, password_hashes)]
+
+    for chunk in _chunks(rows, chunk_size):
+        db.session.bulk_insert_mappings(Student, chunk)
+    mark_rankings_stale()
+    invalidate_tags_after_commit(db.session, 'students', 'ratings')
+    db.session.commit()
+
+    return [{'full_name': full_name, 'login': login, 'password': password}
+            for full_name, login, password in zip(full_names, logins, passwords)]
+
+
+def read_roster(stream, filename):
+    """Список ФИО из CSV или XLSX (первый столбец, строка-заголовок «ФИО» пропускается)"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.xlsx':
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError('Для импорта XLSX необходимо установить пакет openpyxl')
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        cells = [row[0] if row else None for row in workbook.active.iter_rows(values_only=True)]
+    elif extension in ('.csv', '.txt'):
+        text = stream.read()
+        if isinstance(text, bytes):
+            text = text.decode('utf-8-sig')
+        try:
+            dialect = csv.Sniffer().sniff(text[:2048], delimiters=',;\t')
+        except csv.Error:
+            # Один столбец без разделителей
+            dialect = csv.excel
+        cells = [row[0] if row else None for row in csv.reader(io.StringIO(text), dialect)]
+    else:
+        raise ValueError('Поддерживаются только файлы CSV и XLSX')
+
+    names = [str(cell).strip() for cell in cells if cell is not None and str(cell).strip()]
+    if names and names[0].lower() in ('фио', 'full_name', 'имя'):
+        names = names[1:]
+    return names
+
+
+# ===== ЗАГРУЗКА ПОЛЬЗОВАТЕЛЕЙ И УЧЕНИКОВ =====
+# Кешируются только неизменяемые в обычной работе столбцы; personal_rating
+# и password_hash не кешируются и при обращении подгружаются из БД.
+_PRINCIPAL_MODELS = {
+    USER_PREFIX: (User, ('id', 'username', 'email', 'role', 'class_id', 'created_at')),
+    STUDENT_PREFIX: (Student, ('id', 'full_name', 'class_id', 'login', 'created_at')),
+}
+
+# Кеши в общем хранилище app_cache: сброс из рабочего процесса очереди виден веб-процессам
+principal_cache = app_cache.region('principals', ttl=60)
+
+
+def load_principal(principal_id):
+    """Пользователь или ученик по идентификатору вида 'u:5' / 's:5'.
+
+    При попадании в кеш объект присоединяется к сессии без запроса к БД,
+    иначе загружается одним запросом.
+    """
+    prefix, _, raw_id = str(principal_id).partition(':')
+    if prefix not in _PRINCIPAL_MODELS or not raw_id.isdigit():
+        return None
+    model, columns = _PRINCIPAL_MODELS[prefix]
+    key = f'{prefix}:{raw_id}'
+
+    values = principal_cache.get(key)
+    if values is not None:
+        principal = model(**values)
+        make_transient_to_detached(principal)
+        return db.session.merge(principal, load=False)
+
+    principal = db.session.get(model, int(raw_id))
+    if principal is not None:
+        principal_cache.set(key, {column: getattr(principal, column) for column in columns})
+    return principal
+
+
+def find_principal_for_login(username, password):
+    """Проверка логина и пароля одним запросом по пользователям и ученикам"""
+    users = db.select(
+        db.literal(USER_PREFIX).label('prefix'), User.id, User.password_hash, db.literal(0).label('priority')
+    ).where(User.username == username)
+    students = db.select(
+        db.literal(STUDENT_PREFIX).label('prefix'), Student.id, Student.password_hash, db.literal(1).label('priority')
+    ).where(Student.login == username)
+    row = db.session.execute(
+        db.union_all(users, students).order_by(db.text('priority')).limit(1)
+    ).first()
+
+    if row is None or not check_password_hash(row.password_hash, password):
+        return None
+    return load_principal(f'{row.prefix}:{row.id}')
+
+
+def invalidate_after_commit(session, cache, key=None):
+    """Удалить ключ (или, без ключа, все записи) из кеша после успешного коммита"""
+    session.info.setdefault('cache_invalidations', set()).add((cache, key))
+
+
+def invalidate_tags_after_commit(session, *tags):
+    """Сбросить теги общего кеша (app_cache) после успешного коммита"""
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_principals(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (User, Student)) and (obj in session.deleted or session.is_modified(obj)):
+            invalidate_after_commit(session, principal_cache, obj.get_id())
+
+
+# Теги общего кеша, которые устаревают при изменении записей модели
+_CACHE_TAGS = {
+    SchoolClass: ('classes', 'ratings'),
+    Student: ('students', 'ratings'),
+    Event: ('events',),
+    Participation: ('ratings',),
+    PortfolioEntry: ('ratings',),
+    ClassPoints: ('ratings',),
+}
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_cache_tags(session, flush_context):
+    changed = list(session.new) + list(session.deleted)
+    changed += [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in changed:
+        tags = _CACHE_TAGS.get(type(obj))
+        if tags:
+            invalidate_tags_after_commit(session, *tags)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_cache_invalidations(session):
+    for cache, key in session.info.pop('cache_invalidations', ()):
+        if key is None:
+            cache.clear()
+        else:
+            cache.delete(key)
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        app_cache.invalidate(*tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_cache_invalidations(session):
+    session.info.pop('cache_invalidations', None)
+    session.info.pop('cache_tags', None)
+
+
+# ===== ТАБЛИЦЫ РЕЙТИНГОВ (ЛИДЕРБОРД) =====
+class StudentRanking(db.Model):
+    """Материализованный рейтинг учеников; position - сквозной номер для keyset-пагинации"""
+    __tablename__ = 'student_rankings'
+
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), primary_key=True)
+    class_id = db.Column(db.Integer, db.ForeignKey('school_classes.id'), nullable=False)
+    grade = db.Column(db.String(10), nullable=False, index=True)
+    rating = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False, unique=True)
+    rank = db.Column(db.Integer, nullable=False)
+    dense_rank = db.Column(db.Integer, nullable=False)
+    grade_rank = db.Column(db.Integer, nullable=False)
+
+
+class ClassRanking(db.Model):
+    """Материализованный рейтинг классов"""
+    __tablename__ = 'class_rankings'
+
+    class_id = db.Column(db.Integer, db.ForeignKey('school_classes.id'), primary_key=True)
+    grade = db.Column(db.String(10), nullable=False, index=True)
+    rating = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False, unique=True)
+    rank = db.Column(db.Integer, nullable=False)
+    dense_rank = db.Column(db.Integer, nullable=False)
+    grade_rank = db.Column(db.Integer, nullable=False)
+
+
+class LeaderboardState(db.Model):
+    """Единственная строка: устарели ли таблицы рейтингов и номер их последней сборки"""
+    __tablename__ = 'leaderboard_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stale = db.Column(db.Boolean, nullable=False, default=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+    refreshed_at = db.Column(db.DateTime)
+
+
+# Изменения этих моделей влияют на рейтинги
+_RANKING_SOURCES = (Student, SchoolClass, Participation, PortfolioEntry, ClassPoints)
+
+
+# Вызываются после коммита, пометившего рейтинги устаревшими (пересборка - не в запросе)
+_rankings_stale_hooks = []
+
+
+def on_rankings_stale(callback):
+    """Зарегистрировать callback() на коммит транзакции, пометившей рейтинги устаревшими"""
+    _rankings_stale_hooks.append(callback)
+    return callback
+
+
+def mark_rankings_stale(session=None):
+    """Пометить таблицы рейтингов устаревшими в текущей транзакции"""
+    session = session or db.session
+    session.connection().execute(LeaderboardState.__table__.update().values(stale=True))
+    session.info['rankings_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_rankings_stale(session):
+    if not session.info.pop('rankings_stale', None):
+        return
+    for callback in _rankings_stale_hooks:
+        try:
+            callback()
+        except Exception:
+            # Данные уже закоммичены; рейтинги пересоберет следующая запись или flask refresh-rankings
+            logger.exception('Не удалось запланировать пересборку рейтингов')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rankings_stale(session):
+    session.info.pop('rankings_stale', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_rankings_on_flush(session, flush_context):
+    changed = list(session.new) + list(session.deleted)
+    changed += [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in changed:
+        if isinstance(obj, _RANKING_SOURCES):
+            mark_rankings_stale(session)
+            return
+
+
+def _ranking_select(rating, key, grade):
+    return (
+        db.func.row_number().over(order_by=(rating.desc(), key)),
+        db.func.rank().over(order_by=rating.desc()),
+        db.func.dense_rank().over(order_by=rating.desc()),
+        db.func.rank().over(partition_by=grade, order_by=rating.desc()),
+    )
+
+
+def refresh_rankings():
+    """Пересобрать таблицы рейтингов оконными функциями; возвращает номер сборки"""
+    rating = db.func.coalesce(Student.personal_rating, 0)
+    students_select = db.select(
+        Student.id, Student.class_id, SchoolClass.grade, rating,
+        *_ranking_select(rating, Student.id, SchoolClass.grade)
+    ).join(SchoolClass, SchoolClass.id == Student.class_id)
+
+    class_rating = db.func.coalesce(SchoolClass.total_rating, 0)
+    classes_select = db.select(
+        SchoolClass.id, SchoolClass.grade, class_rating,
+        *_ranking_select(class_rating, SchoolClass.id, SchoolClass.grade)
+    )
+
+    rank_columns = ['position', 'rank', 'dense_rank', 'grade_rank']
+    db.session.execute(StudentRanking.__table__.delete())
+    db.session.execute(StudentRanking.__table__.insert().from_select(
+        ['student_id', 'class_id', 'grade', 'rating'] + rank_columns, students_select
+    ))
+    db.session.execute(ClassRanking.__table__.delete())
+    db.session.execute(ClassRanking.__table__.insert().from_select(
+        ['class_id', 'grade', 'rating'] + rank_columns, classes_select
+    ))
+
+    state = db.session.get(LeaderboardState, 1)
+    if state is None:
+        state = LeaderboardState(id=1, generation=0)
+        db.session.add(state)
+    state.stale = False
+    state.generation = (state.generation or 0) + 1
+    state.refreshed_at = datetime.utcnow()
+    generation = state.generation
+    db.session.commit()
+    return generation
+
+
+def leaderboard_generation():
+    """Номер последней сборки рейтингов; только чтение - пересобирает их задача refresh_rankings"""
+    generation = db.session.execute(
+        db.select(LeaderboardState.generation).where(LeaderboardState.id == 1)
+    ).scalar()
+    return generation or 0
+
+
+def student_leaderboard(after=None, limit=50, grade=None):
+    """Страница рейтинга учеников (keyset по position) с именами класса и руководителя.
+
+    Возвращает (rows, next_cursor); next_cursor = None на последней странице.
+    """
+    query = db.select(
+        StudentRanking.position, StudentRanking.rank, StudentRanking.dense_rank, StudentRanking.grade_rank,
+        StudentRanking.rating, StudentRanking.student_id, Student.full_name,
+        StudentRanking.class_id, SchoolClass.grade, SchoolClass.name.label('class_letter'),
+        User.username.label('teacher_name')
+    ).join(
+        Student, Student.id == StudentRanking.student_id
+    ).join(
+        SchoolClass, SchoolClass.id == StudentRanking.class_id
+    ).outerjoin(
+        User, User.id == SchoolClass.class_teacher_id
+    )
+    if grade is not None:
+        query = query.where(StudentRanking.grade == grade)
+    if after is not None:
+        query = query.where(StudentRanking.position > after)
+    rows = db.session.execute(query.order_by(StudentRanking.position).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].position if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def class_leaderboard(after=None, limit=100, grade=None):
+    """Страница рейтинга классов с именами руководителей; возвращает (rows, next_cursor)"""
+    query = db.select(
+        ClassRanking.position, ClassRanking.rank, ClassRanking.dense_rank, ClassRanking.grade_rank,
+        ClassRanking.rating, ClassRanking.class_id, SchoolClass.grade, SchoolClass.name.label('class_letter'),
+        User.username.label('teacher_name')
+    ).join(
+        SchoolClass, SchoolClass.id == ClassRanking.class_id
+    ).outerjoin(
+        User, User.id == SchoolClass.class_teacher_id
+    )
+    if grade is not None:
+        query = query.where(ClassRanking.grade == grade)
+    if after is not None:
+        query = query.where(ClassRanking.position > after)
+    rows = db.session.execute(query.order_by(ClassRanking.position).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].position if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# ===== СТАТИСТИКА УЧЕНИКА =====
+EVENT_LEVELS = ['school', 'city', 'republic', 'russian']
+
+
+@dataclass
+class LevelStats:
+    count: int = 0
+    points: int = 0
+
+
+@dataclass
+class StudentStatistics:
+    total_events: int
+    total_points: int
+    level_stats: dict
+    portfolio_entries: int
+
+
+statistics_cache = app_cache.region('student_statistics', ttl=300)
+
+
+def student_statistics(student):
+    """Статистика ученика: один сгруппированный запрос по уровням и один COUNT по портфолио"""
+    cached = statistics_cache.get(student.id)
+    if cached is not None:
+        return cached
+
+    rows = db.session.execute(
+        db.select(
+            Event.level,
+            db.func.count(Participation.id),
+            db.func.sum(Participation.points_sql(Participation.place))
+        ).join(Event, Event.id == Participation.event_id).where(
+            Participation.student_id == student.id,
+            Participation.approved == True
+        ).group_by(Event.level)
+    ).all()
+
+    level_stats = {level: LevelStats() for level in EVENT_LEVELS}
+    for level, count, points in rows:
+        level_stats[level] = LevelStats(count=count, points=points or 0)
+
+    portfolio_count = db.session.execute(
+        db.select(db.func.count(PortfolioEntry.id)).where(
+            PortfolioEntry.student_id == student.id,
+            PortfolioEntry.approved == True
+        )
+    ).scalar()
+
+    statistics = StudentStatistics(
+        total_events=sum(count for _, count, _ in rows),
+        total_points=student.personal_rating or 0,
+        level_stats=level_stats,
+        portfolio_entries=portfolio_count
+    )
+    statistics_cache.set(student.id, statistics)
+    return statistics
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_statistics(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Participation, PortfolioEntry)):
+            for student_id in get_history(obj, 'student_id').sum():
+                invalidate_after_commit(session, statistics_cache, student_id)
+
+
+# ===== СВОДНЫЕ ТАБЛИЦЫ СБОРА МАКУЛАТУРЫ =====
+class PaperClassDaily(db.Model):
+    """Итог класса за день сбора; entries - количество записей учеников"""
+    __tablename__ = 'paper_class_daily'
+
+    class_id = db.Column(db.Integer, db.ForeignKey('school_classes.id'), primary_key=True)
+    collection_date = db.Column(db.Date, primary_key=True)
+    kilograms = db.Column(db.Float, nullable=False, default=0)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PaperClassMonthly(db.Model):
+    """Итог класса за месяц; month в формате 'YYYY-MM'"""
+    __tablename__ = 'paper_class_monthly'
+
+    class_id = db.Column(db.Integer, db.ForeignKey('school_classes.id'), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    kilograms = db.Column(db.Float, nullable=False, default=0)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PaperStudentYearly(db.Model):
+    """Итог ученика за год в составе класса"""
+    __tablename__ = 'paper_student_yearly'
+
+    class_id = db.Column(db.Integer, db.ForeignKey('school_classes.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), primary_key=True)
+    kilograms = db.Column(db.Float, nullable=False, default=0)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+
+def dialect_insert(table):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД (SQLite или PostgreSQL)"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
+
+def lock_table_for_write(session, table):
+    """Взять блокировку записи таблицы до конца транзакции сессии.
+
+    Нужна перед чтением, по которому считаются приращения: пока блокировка
+    держится, другие транзакции не изменят прочитанные строки и не вставят новые.
+    В PostgreSQL блокируется только запись в таблицу, в SQLite - запись во всю БД.
+    """
+    if session.get_bind(clause=table.update()).dialect.name == 'postgresql':
+        session.execute(db.text(f'LOCK TABLE {table.name} IN SHARE ROW EXCLUSIVE MODE'))
+    else:
+        # Пустой UPDATE открывает пишущую транзакцию SQLite (BEGIN + RESERVED)
+        key = next(iter(table.primary_key))
+        session.execute(table.update().where(db.false()).values({key: key}))
+
+
+def _rollup_keys(class_id, student_id, collection_date):
+    return (
+        (PaperClassDaily, {'class_id': class_id, 'collection_date': collection_date}),
+        (PaperClassMonthly, {'class_id': class_id, 'month': collection_date.strftime('%Y-%m')}),
+        (PaperStudentYearly, {'class_id': class_id, 'year': collection_date.year, 'student_id': student_id}),
+    )
+
+
+def apply_paper_collection_deltas(connection, deltas):
+    """Применить изменения сбора макулатуры к сводным таблицам.
+
+    deltas - список (class_id, student_id, collection_date, kilograms, entries), где
+    kilograms и entries - приращения. Строки, у которых не осталось записей, удаляются.
+    """
+    totals = {model: {} for model in (PaperClassDaily, PaperClassMonthly, PaperStudentYearly)}
+    class_ids = set()
+    for class_id, student_id, collection_date, kilograms, entries in deltas:
+        class_ids.add(class_id)
+        for model, key in _rollup_keys(class_id, student_id, collection_date):
+            row = totals[model].setdefault(tuple(key.values()), dict(key, kilograms=0, entries=0))
+            row['kilograms'] += kilograms
+            row['entries'] += entries
+
+    for model, rows in totals.items():
+        if not rows:
+            continue
+        table = model.__table__
+        insert = dialect_insert(table)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={
+                'kilograms': table.c.kilograms + insert.excluded.kilograms,
+                'entries': table.c.entries + insert.excluded.entries
+            }
+        ), list(rows.values()))
+        connection.execute(table.delete().where(table.c.class_id.in_(class_ids), table.c.entries <= 0))
+
+
+def _month_sql(date_column):
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.to_char(date_column, 'YYYY-MM')
+    return db.func.strftime('%Y-%m', date_column)
+
+
+def rebuild_paper_rollups():
+    """Пересобрать сводные таблицы сбора макулатуры из исходных записей"""
+    source = PaperCollection.__table__.c
+    daily = PaperClassDaily.__table__
+    monthly = PaperClassMonthly.__table__
+    yearly = PaperStudentYearly.__table__
+    month = _month_sql(source.collection_date)
+    year = db.cast(db.extract('year', source.collection_date), db.Integer)
+
+    for table, keys in (
+        (daily, [source.class_id, source.collection_date]),
+        (monthly, [source.class_id, month]),
+        (yearly, [source.class_id, year, source.student_id]),
+    ):
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(
+            [column.name for column in table.primary_key] + ['kilograms', 'entries'],
+            db.select(*keys, db.func.sum(source.kilograms), db.func.count()).group_by(*keys)
+        ))
+    db.session.commit()
+    return db.session.scalar(db.select(db.func.count()).select_from(daily))
+
+
+def ensure_paper_rollups():
+    """Заполнить сводные таблицы в существующей БД, если они еще пусты"""
+    if db.session.scalar(db.select(PaperClassDaily.class_id).limit(1)) is None and \
+            db.session.scalar(db.select(PaperCollection.id).limit(1)) is not None:
+        rebuild_paper_rollups()
+
+
+# Обзор сбора за год (queries.paper_collection_overview); сбрасывается после записи
+paper_overview_cache = app_cache.region('paper_overview', ttl=30)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_paper_collections(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, PaperCollection):
+            invalidate_after_commit(session, paper_overview_cache)
+            return
+
+
+def save_paper_collections(entries, created_by):
+    """Сохранить ведомости сбора макулатуры.
+
+    entries - список (class_id, collection_date, student_id, kilograms).
+    Положительные значения записываются одним INSERT ... ON CONFLICT DO UPDATE,
+    нулевые удаляют существующую запись. Сводные таблицы обновляются в той же
+    транзакции; прежние значения читаются после блокировки таблицы на запись.
+    Возвращает {'saved', 'deleted'}.
+    """
+    # Повтор ключа в одной ведомости: действует последнее значение
+    sheet = {}
+    for class_id, collection_date, student_id, kilograms in entries:
+        sheet[(student_id, class_id, collection_date)] = kilograms
+
+    table = PaperCollection.__table__
+    # Приращения сводных считаются от прочитанных значений: читаем под блокировкой записи
+    lock_table_for_write(db.session, table)
+    keys = list(sheet)
+    existing = {}
+    for start in range(0, len(keys), SQL_CHUNK_SIZE):
+        chunk = keys[start:start + SQL_CHUNK_SIZE]
+        existing.update(
+            ((row.student_id, row.class_id, row.collection_date), row.kilograms)
+            for row in db.session.execute(
+                db.select(table.c.student_id, table.c.class_id, table.c.collection_date, table.c.kilograms)
+                .where(db.tuple_(table.c.student_id, table.c.class_id, table.c.collection_date).in_(chunk))
+            )
+        )
+
+    now = datetime.utcnow()
+    upserts = []
+    deletes = []
+    deltas = []
+    for (student_id, class_id, collection_date), kilograms in sheet.items():
+        old = existing.get((student_id, class_id, collection_date))
+        if kilograms > 0:
+            upserts.append({
+                'class_id': class_id, 'collection_date': collection_date, 'student_id': student_id,
+                'kilograms': kilograms, 'created_by': created_by, 'created_at': now
+            })
+            deltas.append((class_id, student_id, collection_date, kilograms - (old or 0), 0 if old is not None else 1))
+        elif old is not None:
+            deletes.append({'b_class_id': class_id, 'b_collection_date': collection_date, 'b_student_id': student_id})
+            deltas.append((class_id, student_id, collection_date, -old, -1))
+
+    if upserts:
+        insert = dialect_insert(table)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=['student_id', 'class_id', 'collection_date'],
+            set_={'kilograms': insert.excluded.kilograms}
+        ), upserts)
+    if deletes:
+        db.session.execute(table.delete().where(
+            table.c.class_id == db.bindparam('b_class_id'),
+            table.c.collection_date == db.bindparam('b_collection_date'),
+            table.c.student_id == db.bindparam('b_student_id')
+        ), deletes)
+    if deltas:
+        apply_paper_collection_deltas(db.session.connection(), deltas)
+
+    invalidate_after_commit(db.session, paper_overview_cache)
+    db.session.commit()
+    return {'saved': len(upserts), 'deleted': len(deletes)}
+
+
+def create_missing_indexes():
+    """Создать объявленные в моделях индексы, которых еще нет в существующей БД.
+
+    db.create_all() не добавляет индексы к уже созданным таблицам.
+    Возвращает имена созданных индексов.
+    """
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+    for table in db.metadata.tables.values():
+        if table.name not in existing_tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+
+def ensure_paper_collection_unique_index():
+    """Создать уникальный индекс сбора макулатуры в существующей БД.
+
+    Перед созданием удаляются дубликаты (остается последняя запись).
+    """
+    table = PaperCollection.__table__
+    index_names = {index['name'] for index in db.inspect(db.engine).get_indexes(table.name)}
+    if 'uq_paper_collections_student_class_date' in index_names:
+        return
+
+    latest = db.select(db.func.max(table.c.id)).group_by(
+        table.c.student_id, table.c.class_id, table.c.collection_date
+    )
+    db.session.execute(table.delete().where(table.c.id.not_in(latest)))
+    db.session.commit()
+    create_missing_indexes()
+
+
+# ===== ВЕРСИИ ТАБЛИЦ =====
+class TableVersion(db.Model):
+    """Счетчик изменений таблицы; увеличивается при коммите транзакции, изменившей таблицу"""
+    __tablename__ = 'table_versions'
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+@event.listens_for(Engine, 'before_execute')
+def _collect_changed_tables(conn, clauseelement, multiparams, params, execution_options):
+    # Сюда попадают и flush ORM, и Core-запросы (executemany, bulk_insert_mappings)
+    if isinstance(clauseelement, UpdateBase) and isinstance(clauseelement.table, Table):
+        name = clauseelement.table.name
+        if name != TableVersion.__tablename__:
+            conn.info.setdefault('changed_tables', set()).add(name)
+
+
+@event.listens_for(Engine, 'commit')
+@event.listens_for(Engine, 'rollback')
+def _forget_changed_tables(conn):
+    conn.info.pop('changed_tables', None)
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_table_versions(session):
+    session.flush()
+    statement = dialect_insert(TableVersion.__table__)
+    # Подключение, через которое шла запись (основная БД, а не только для чтения)
+    connection = session.connection(bind_arguments={'clause': statement})
+    tables = connection.info.pop('changed_tables', None)
+    if not tables:
+        return
+    now = datetime.utcnow()
+    session.execute(statement.on_conflict_do_update(
+        index_elements=['table_name'],
+        set_={'version': TableVersion.version + 1, 'updated_at': statement.excluded.updated_at}
+    ), [{'table_name': name, 'version': 1, 'updated_at': now} for name in sorted(tables)])
+
+
+def version_stamp(*tables):
+    """Версия набора таблиц одним запросом: (строка-отметка, время последнего изменения)"""
+    names = sorted(table if isinstance(table, str) else table.__tablename__ for table in tables)
+    rows = {row.table_name: row for row in db.session.execute(
+        db.select(TableVersion.table_name, TableVersion.version, TableVersion.updated_at)
+        .where(TableVersion.table_name.in_(names))
+    )}
+    stamp = '.'.join(str(rows[name].version if name in rows else 0) for name in names)
+    modified = max((row.updated_at for row in rows.values()), default=None)
+    return stamp, modified
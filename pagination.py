@@ -0,0 +1,135 @@
+# Постраничный вывод списков по ключу (keyset): страница выбирается условием
+# (ключ сортировки, id) < курсора, а не OFFSET, поэтому стоимость любой страницы
+# одинакова и записи не пропускаются и не повторяются при вставках между запросами.
+import base64
+import json
+from collections import namedtuple
+from datetime import date, datetime, time
+
+from sqlalchemy import tuple_
+
+from models import db
+
+# Размер страницы по умолчанию и верхняя граница для параметра limit
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+class ListFilters(namedtuple('ListFilters', ['class_id', 'level', 'date_from', 'date_to', 'q'],
+                             defaults=(None,) * 5)):
+    """Фильтры списка из параметров запроса; неверные значения игнорируются"""
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            class_id=args.get('class_id', type=int),
+            level=args.get('level') or None,
+            date_from=args.get('date_from', type=_parse_date),
+            date_to=args.get('date_to', type=_parse_date),
+            q=(args.get('q') or '').strip() or None,
+        )
+
+    def url_args(self):
+        """Непустые фильтры для url_for (ссылка на следующую страницу)"""
+        return {key: value.isoformat() if isinstance(value, date) else value
+                for key, value in self._asdict().items() if value is not None}
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def page_limit(args, default=PAGE_SIZE):
+    """Размер страницы из параметра limit, не больше MAX_PAGE_SIZE"""
+    return max(1, min(args.get('limit', default, type=int), MAX_PAGE_SIZE))
+
+
+def apply_filters(statement, filters, class_column=None, level_column=None, date_column=None, search_column=None):
+    """Добавить к select условия фильтров по переданным столбцам.
+
+    Фильтр, для которого столбец не указан, не применяется. Границы дат включительные.
+    """
+    if class_column is not None and filters.class_id is not None:
+        statement = statement.where(class_column == filters.class_id)
+    if level_column is not None and filters.level:
+        statement = statement.where(level_column == filters.level)
+    if date_column is not None and filters.date_from:
+        statement = statement.where(date_column >= datetime.combine(filters.date_from, time.min))
+    if date_column is not None and filters.date_to:
+        statement = statement.where(date_column <= datetime.combine(filters.date_to, time.max))
+    if search_column is not None and filters.q:
+        pattern = filters.q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        statement = statement.where(_contains_ignore_case(search_column, f'%{pattern}%'))
+    return statement
+
+
+def _contains_ignore_case(column, pattern):
+    # ILIKE в SQLite - это lower(), который не меняет регистр кириллицы; casefold - из database.py
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return db.func.casefold(column).like(pattern.casefold(), escape='\\')
+    return column.ilike(pattern, escape='\\')
+
+
+def encode_cursor(value, id):
+    """Курсор - (ключ сортировки, id) последней строки страницы в base64"""
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    raw = json.dumps([value, id], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_column):
+    """(ключ сортировки, id) из курсора или None, если курсор пустой или испорчен"""
+    if not cursor:
+        return None
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        python_type = sort_column.type.python_type
+        if value is not None and python_type is datetime:
+            value = datetime.fromisoformat(value)
+        elif value is not None and python_type is date:
+            value = date.fromisoformat(value)
+        return value, int(id)
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def keyset_page(statement, sort_column, id_column, cursor=None, limit=PAGE_SIZE, descending=False):
+    """Страница select, упорядоченного по (sort_column, id_column).
+
+    Для индексного поиска нужен индекс, начинающийся с этих столбцов. sort_column
+    должен быть NOT NULL: сравнение кортежа с NULL ложно, и после курсора с NULL
+    следующая страница оказалась бы пустой. Если в select одна сущность или один
+    столбец, items - их значения, иначе строки Row.
+    Возвращает Page(items, next_cursor); next_cursor = None на последней странице.
+    """
+    after = decode_cursor(cursor, sort_column)
+    key = tuple_(sort_column, id_column)
+    if after is not None:
+        statement = statement.where(key < after if descending else key > after)
+    if descending:
+        statement = statement.order_by(sort_column.desc(), id_column.desc())
+    else:
+        statement = statement.order_by(sort_column, id_column)
+
+    result = db.session.execute(statement.limit(limit + 1))
+    if len(statement.column_descriptions) == 1:
+        result = result.scalars()
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(_column_value(last, sort_column), _column_value(last, id_column))
+    return Page(rows, next_cursor)
+
+
+def _column_value(row, column):
+    # Значение столбца из сущности (атрибут модели) или из строки Row (по имени)
+    key = getattr(column, 'key', None) or column.name
+    if hasattr(row, '_mapping'):
+        return row._mapping[column] if column in row._mapping else getattr(row, key)
+    return getattr(row, key)
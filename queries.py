@@ -0,0 +1,387 @@
+# Запросы для страниц: связи, нужные шаблону, загружаются заранее,
+# чтобы число SQL-запросов на страницу не зависело от размера классов.
+from contextlib import contextmanager
+from datetime import date
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.orm import contains_eager, joinedload, selectinload, with_expression
+
+from cache import app_cache
+from models import db, SchoolClass, Student, Event, Participation, PortfolioEntry
+from models import PaperClassDaily, PaperClassMonthly, PaperStudentYearly
+from models import paper_overview_cache
+from pagination import PAGE_SIZE, apply_filters, keyset_page
+from instrumentation import thread_counters
+
+
+def _students_count_sql():
+    return db.select(db.func.count(Student.id)).where(
+        Student.class_id == SchoolClass.id
+    ).correlate(SchoolClass).scalar_subquery()
+
+
+class LazyResult:
+    """Результат запроса, который выполняется при первом обращении из шаблона.
+
+    Внутри {% cache %} обращения при попадании в кеш нет - запрос не выполняется.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self._call = (function, args, kwargs)
+        self._loaded = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._loaded:
+            function, args, kwargs = self._call
+            self._value = function(*args, **kwargs)
+            self._loaded = True
+        return self._value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __bool__(self):
+        return bool(self.value)
+
+
+def classes_overview():
+    """Классы с руководителем и количеством учеников (COUNT подзапросом)"""
+    return SchoolClass.query.options(
+        joinedload(SchoolClass.class_teacher),
+        with_expression(SchoolClass.students_count, _students_count_sql())
+    ).order_by(SchoolClass.id).all()
+
+
+@app_cache.memoize('classes', 'events', 'students', 'ratings', ttl=300)
+def dashboard_counters():
+    """Счетчики главной панели: рейтинг школы и количество классов, мероприятий, учеников"""
+    row = db.session.execute(db.select(
+        db.select(db.func.coalesce(db.func.sum(SchoolClass.total_rating), 0)).scalar_subquery(),
+        db.select(db.func.count()).select_from(SchoolClass).scalar_subquery(),
+        db.select(db.func.count()).select_from(Event).scalar_subquery(),
+        db.select(db.func.count()).select_from(Student).scalar_subquery(),
+    )).one()
+    return {
+        'total_school_rating': row[0],
+        'classes_count': row[1],
+        'events_count': row[2],
+        'students_count': row[3],
+    }
+
+
+def class_with_students(class_id):
+    """Класс с руководителем и списком учеников или 404"""
+    return SchoolClass.query.options(
+        joinedload(SchoolClass.class_teacher),
+        selectinload(SchoolClass.students)
+    ).filter(SchoolClass.id == class_id).first_or_404()
+
+
+def classes_for_reports():
+    """Классы для страницы отчетов с руководителями"""
+    return SchoolClass.query.options(joinedload(SchoolClass.class_teacher)).all()
+
+
+def all_events():
+    return Event.query.all()
+
+
+def student_for_portfolio(student_id):
+    """Ученик с классом или 404"""
+    return Student.query.options(joinedload(Student.school_class)).filter(Student.id == student_id).first_or_404()
+
+
+def approved_participations(student_id, filters, cursor=None, limit=PAGE_SIZE):
+    """Страница подтвержденных участий ученика с мероприятиями, новые первыми.
+
+    Фильтры: уровень мероприятия и даты участия.
+    """
+    query = db.select(Participation).join(Participation.event).options(
+        contains_eager(Participation.event)
+    ).where(
+        Participation.student_id == student_id,
+        Participation.approved == True
+    )
+    query = apply_filters(query, filters, level_column=Event.level, date_column=Participation.created_at)
+    return keyset_page(query, Participation.created_at, Participation.id,
+                       cursor=cursor, limit=limit, descending=True)
+
+
+def active_events(filters, cursor=None, limit=PAGE_SIZE):
+    """Страница активных мероприятий, новые первыми; фильтры: уровень и дата создания"""
+    query = db.select(Event).where(Event.is_active == True)
+    query = apply_filters(query, filters, level_column=Event.level, date_column=Event.created_at)
+    return keyset_page(query, Event.created_at, Event.id, cursor=cursor, limit=limit, descending=True)
+
+
+def search_students(filters, class_ids=None, cursor=None, limit=PAGE_SIZE):
+    """Страница учеников по ФИО для выбора участников.
+
+    Фильтры: класс и часть ФИО (q); class_ids ограничивает доступные классы.
+    Строки: id, full_name, class_id, grade, class_letter.
+    """
+    query = db.select(
+        Student.id, Student.full_name, Student.class_id,
+        SchoolClass.grade, SchoolClass.name.label('class_letter')
+    ).join(SchoolClass, SchoolClass.id == Student.class_id)
+    if class_ids is not None:
+        query = query.where(Student.class_id.in_(class_ids))
+    query = apply_filters(query, filters, class_column=Student.class_id, search_column=Student.full_name)
+    return keyset_page(query, Student.full_name, Student.id, cursor=cursor, limit=limit)
+
+
+def approved_portfolio_entries(student_id):
+    return PortfolioEntry.query.filter_by(student_id=student_id, approved=True).all()
+
+
+# ===== СЧЕТЧИК ЗАПРОСОВ =====
+# Бюджет SQL-запросов на страницу; при ENFORCE_QUERY_BUDGET превышение - ошибка
+QUERY_BUDGETS = {
+    'classes': 5,
+    'class_students': 5,
+    'ratings': 10,
+    'reports': 5,
+    'student_portfolio': 6,
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def install_query_counter(app):
+    """Проверка бюджета запросов страницы; считает их instrumentation (g.request_metrics)"""
+
+    @app.after_request
+    def _check_query_budget(response):
+        metrics = g.get('request_metrics')
+        if metrics is None:
+            # Инструментирование выключено (METRICS_ENABLED=0) - считать нечем
+            return response
+        count = metrics.queries
+        if app.debug or app.testing:
+            response.headers['X-Query-Count'] = str(count)
+        budget = QUERY_BUDGETS.get(request.endpoint)
+        if app.config.get('ENFORCE_QUERY_BUDGET') and budget is not None and count > budget:
+            raise QueryBudgetExceeded(f'{request.endpoint}: {count} SQL-запросов при бюджете {budget}')
+        return response
+
+
+@contextmanager
+def count_queries(budget=None):
+    """Посчитать запросы текущего потока внутри блока: with count_queries(5) as counter: ..."""
+    counter = {'count': 0}
+    counters = thread_counters()
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+    if budget is not None and counter['count'] > budget:
+        raise QueryBudgetExceeded(f'{counter["count"]} SQL-запросов при бюджете {budget}')
+
+
+@contextmanager
+def capture_statements():
+    """Собрать выполненные внутри блока SELECT-запросы: {sql: параметры первого вызова}"""
+    statements = {}
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.setdefault(statement, parameters)
+
+    event.listen(db.engine, 'before_cursor_execute', _record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _record)
+
+
+def explain_full_scans(statements):
+    """Прогнать запросы через EXPLAIN QUERY PLAN (только SQLite) и найти полные просмотры таблиц.
+
+    Возвращает список {'sql', 'detail'}; просмотр по индексу (SCAN ... USING INDEX)
+    полным просмотром таблицы не считается.
+    """
+    tables = set(db.metadata.tables)
+    connection = db.session.connection().connection.driver_connection
+    scans = []
+    for statement, parameters in statements.items():
+        for _, _, _, detail in connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters or ()):
+            words = detail.split()
+            if words[0] == 'SCAN' and 'USING' not in words and words[1] in tables:
+                scans.append({'sql': statement, 'detail': detail})
+    return scans
+
+
+# ===== ОТЧЕТ ПО КЛАССАМ =====
+def class_report_rows(class_ids=None, date_from=None, date_to=None, level=None, yield_per=500):
+    """Строки отчета одним запросом: класс, ученик и его подтвержденное участие (если есть).
+
+    Фильтры по дате и уровню применяются к участиям, ученики без участий остаются.
+    Строки читаются порциями по yield_per, упорядочены по классу и ученику.
+    """
+    participations = db.select(
+        Participation.student_id,
+        Participation.created_at,
+        Participation.points_sql(Participation.place).label('points'),
+        Event.name.label('event_name'),
+        Event.level.label('event_level')
+    ).join(Event, Event.id == Participation.event_id).where(Participation.approved == True)
+    if date_from is not None:
+        participations = participations.where(Participation.created_at >= date_from)
+    if date_to is not None:
+        participations = participations.where(Participation.created_at < date_to)
+    if level is not None:
+        participations = participations.where(Event.level == level)
+    participations = participations.subquery()
+
+    query = db.select(
+        SchoolClass.id.label('class_id'), SchoolClass.grade, SchoolClass.name.label('class_letter'),
+        SchoolClass.total_rating, Student.id.label('student_id'), Student.full_name, Student.personal_rating,
+        participations.c.event_name, participations.c.event_level, participations.c.points,
+        participations.c.created_at
+    ).outerjoin(
+        Student, Student.class_id == SchoolClass.id
+    ).outerjoin(
+        participations, participations.c.student_id == Student.id
+    )
+    if class_ids is not None:
+        query = query.where(SchoolClass.id.in_(class_ids))
+    query = query.order_by(SchoolClass.id, Student.id, participations.c.created_at)
+
+    return db.session.execute(query.execution_options(yield_per=yield_per))
+
+
+def iter_class_report(rows):
+    """Сгруппировать строки отчета: ('class', {...}) и затем ('student', {...}) по одному ученику"""
+    current_class = None
+    student = None
+    for row in rows:
+        if row.class_id != current_class:
+            if student:
+                yield 'student', student
+                student = None
+            current_class = row.class_id
+            yield 'class', {
+                'class_id': row.class_id,
+                'class_name': f'{row.grade}{row.class_letter}',
+                'total_rating': row.total_rating
+            }
+        if row.student_id is None:
+            continue
+        if student is None or student['student_id'] != row.student_id:
+            if student:
+                yield 'student', student
+            student = {
+                'class_id': row.class_id,
+                'student_id': row.student_id,
+                'name': row.full_name,
+                'personal_rating': row.personal_rating,
+                'participations': []
+            }
+        if row.event_name is not None:
+            student['participations'].append({
+                'event_name': row.event_name,
+                'level': row.event_level,
+                'points': row.points,
+                'date': row.created_at.strftime('%Y-%m-%d')
+            })
+    if student:
+        yield 'student', student
+
+
+# ===== СБОР МАКУЛАТУРЫ =====
+def paper_collection_overview(year):
+    """Итоги сбора макулатуры по всем классам одним запросом.
+
+    Возвращает {class_id: {'total_year', 'last_collection_date', 'last_collection_total'}};
+    результат кешируется на короткое время и сбрасывается при сохранении данных.
+    """
+    cached = paper_overview_cache.get(year)
+    if cached is not None:
+        return cached
+
+    daily = db.select(
+        PaperClassDaily.class_id,
+        PaperClassDaily.collection_date,
+        PaperClassDaily.kilograms.label('total'),
+        db.func.row_number().over(
+            partition_by=PaperClassDaily.class_id,
+            order_by=PaperClassDaily.collection_date.desc()
+        ).label('recency')
+    ).subquery()
+
+    in_year = db.and_(daily.c.collection_date >= date(year, 1, 1), daily.c.collection_date < date(year + 1, 1, 1))
+    rows = db.session.execute(db.select(
+        daily.c.class_id,
+        db.func.sum(db.case((in_year, daily.c.total), else_=0)).label('total_year'),
+        db.func.max(daily.c.collection_date).label('last_collection_date'),
+        db.func.max(db.case((daily.c.recency == 1, daily.c.total))).label('last_collection_total')
+    ).group_by(daily.c.class_id)).all()
+
+    overview = {
+        row.class_id: {
+            'total_year': round(row.total_year or 0, 2),
+            'last_collection_date': row.last_collection_date,
+            'last_collection_total': round(row.last_collection_total or 0, 2)
+        } for row in rows
+    }
+    paper_overview_cache.set(year, overview)
+    return overview
+
+
+def paper_collection_dates(class_id):
+    """Даты сбора класса, новые первыми"""
+    return db.session.scalars(
+        db.select(PaperClassDaily.collection_date)
+        .where(PaperClassDaily.class_id == class_id)
+        .order_by(PaperClassDaily.collection_date.desc())
+    ).all()
+
+
+def paper_class_year_stats(class_id, year, top=10):
+    """Годовая статистика класса по сводным таблицам.
+
+    Возвращает {'total_year', 'collection_days', 'monthly', 'student_totals', 'top_students'};
+    monthly - строки (month, total_kg), top_students - пары (Student, total_kg).
+    """
+    days = db.session.execute(
+        db.select(db.func.count(), db.func.sum(PaperClassDaily.kilograms)).where(
+            PaperClassDaily.class_id == class_id,
+            PaperClassDaily.collection_date >= date(year, 1, 1),
+            PaperClassDaily.collection_date < date(year + 1, 1, 1)
+        )
+    ).one()
+
+    monthly = db.session.execute(
+        db.select(PaperClassMonthly.month, PaperClassMonthly.kilograms.label('total_kg')).where(
+            PaperClassMonthly.class_id == class_id,
+            PaperClassMonthly.month.between(f'{year}-01', f'{year}-12')
+        ).order_by(PaperClassMonthly.month)
+    ).all()
+
+    student_totals = dict(db.session.execute(
+        db.select(PaperStudentYearly.student_id, PaperStudentYearly.kilograms).where(
+            PaperStudentYearly.class_id == class_id,
+            PaperStudentYearly.year == year
+        )
+    ).all())
+
+    top_ids = sorted(student_totals, key=student_totals.get, reverse=True)[:top]
+    students = {student.id: student for student in Student.query.filter(Student.id.in_(top_ids))} if top_ids else {}
+
+    return {
+        'total_year': days[1] or 0,
+        'collection_days': days[0],
+        'monthly': monthly,
+        'student_totals': student_totals,
+        'top_students': [(students[student_id], student_totals[student_id])
+                         for student_id in top_ids if student_id in students]
+    }
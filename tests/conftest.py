@@ -0,0 +1,59 @@
+# Общая настройка тестов: временная БД SQLite задается до импорта приложения,
+# фикстура database пересоздает схему и кладет минимальный набор данных.
+import os
+import sys
+import tempfile
+import warnings
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DATABASE = os.path.join(tempfile.mkdtemp(prefix='topclass-tests-'), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DATABASE}'
+os.environ['METRICS_PATH'] = ''
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import app  # noqa: E402
+from cache import app_cache  # noqa: E402
+from migrations import stamp_migrations  # noqa: E402
+from models import db, User, SchoolClass  # noqa: E402
+
+PASSWORD = 'secret123'
+
+
+def reset_database():
+    """Пустая схема со всеми миграциями и чистые кеши"""
+    with warnings.catch_warnings():
+        # drop_all: цикл внешних ключей users <-> school_classes
+        warnings.simplefilter('ignore')
+        db.drop_all()
+    db.create_all()
+    stamp_migrations()
+    # Новое хранилище: данные прошлого теста не должны попасть в кеш
+    app_cache.configure('memory://')
+
+
+@pytest.fixture
+def database():
+    """БД с администратором admin (id=1), учителем teacher (id=2) и классами 5А (id=1) и 5Б (id=2)"""
+    with app.app_context():
+        reset_database()
+        password_hash = generate_password_hash(PASSWORD)
+        db.session.add(User(id=1, username='admin', email='admin@test', password_hash=password_hash, role='admin'))
+        db.session.add(User(id=2, username='teacher', email='teacher@test', password_hash=password_hash,
+                            role='teacher'))
+        db.session.add_all([SchoolClass(id=1, name='А', grade='5', class_teacher_id=2),
+                            SchoolClass(id=2, name='Б', grade='5')])
+        db.session.commit()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def admin_client(database):
+    """Клиент, вошедший как администратор"""
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': PASSWORD})
+    return client
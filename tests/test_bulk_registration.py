@@ -0,0 +1,82 @@
+# Массовая регистрация участия (register_participations): уже зарегистрированные
+# ученики пропускаются, повторный вызов безопасен, рейтинги совпадают с пересчетом.
+import pytest
+
+from models import db, Student, Event, Participation
+from models import recompute_all, recompute_class_ratings, register_participations
+
+
+@pytest.fixture
+def school(database):
+    """Ученики 1-3 в классе 5А, 4-5 в 5Б; мероприятие 1 для учеников, 2 - с баллами классу"""
+    db.session.add_all([Student(id=number, full_name=f'Ученик {number}', class_id=1 if number <= 3 else 2,
+                                login=f'student{number}', password_hash='-') for number in range(1, 6)])
+    db.session.add_all([
+        Event(id=1, name='Олимпиада', level='school', event_type='student', created_by=1),
+        Event(id=2, name='Субботник', level='school', event_type='both', class_points=2, created_by=1),
+    ])
+    db.session.commit()
+    return db
+
+
+def _registered(event_id):
+    return sorted(db.session.scalars(db.select(Participation.student_id).where(Participation.event_id == event_id)))
+
+
+def _assert_consistent():
+    assert recompute_all(fix=False) == []
+    assert recompute_class_ratings(fix=False) == []
+
+
+def test_registers_new_students(school):
+    result = register_participations(db.session.get(Event, 1), [(1, 1), (2, None), (4, 3)], approved_by=1)
+    assert result == {'registered': 3, 'skipped': [], 'unknown': []}
+    assert _registered(1) == [1, 2, 4]
+    _assert_consistent()
+
+
+def test_skips_already_registered(school):
+    db.session.add(Participation(event_id=1, student_id=2, place=2, approved=True))
+    db.session.commit()
+
+    result = register_participations(db.session.get(Event, 1), [(1, 1), (2, 1), (3, None)], approved_by=1)
+    assert result == {'registered': 2, 'skipped': [2], 'unknown': []}
+    assert _registered(1) == [1, 2, 3]
+    # Место уже зарегистрированного ученика не меняется
+    assert db.session.scalar(db.select(Participation.place).where(Participation.student_id == 2)) == 2
+    _assert_consistent()
+
+
+def test_repeated_call_registers_nothing(school):
+    event = db.session.get(Event, 1)
+    register_participations(event, [(1, 1), (4, None)], approved_by=1)
+    result = register_participations(event, [(1, 1), (4, None)], approved_by=1)
+    assert result == {'registered': 0, 'skipped': [1, 4], 'unknown': []}
+    assert _registered(1) == [1, 4]
+    _assert_consistent()
+
+
+def test_duplicate_entries_use_first_place(school):
+    result = register_participations(db.session.get(Event, 1), [(1, 1), (1, 3)], approved_by=1)
+    assert result['registered'] == 1
+    assert db.session.scalar(db.select(Student.personal_rating).where(Student.id == 1)) == 5
+    _assert_consistent()
+
+
+def test_class_filter_and_unknown_students(school):
+    result = register_participations(db.session.get(Event, 1), [(1, None), (4, None), (99, None)],
+                                     approved_by=1, class_ids=[1])
+    assert result == {'registered': 1, 'skipped': [], 'unknown': [4, 99]}
+    assert _registered(1) == [1]
+    _assert_consistent()
+
+
+def test_class_event_updates_class_ratings(school):
+    register_participations(db.session.get(Event, 2), [(1, 1), (2, None), (5, None)], approved_by=1)
+    _assert_consistent()
+
+
+def test_unapproved_registration_gives_no_points(school):
+    register_participations(db.session.get(Event, 1), [(1, 1)], approved=False)
+    assert db.session.scalar(db.select(Student.personal_rating).where(Student.id == 1)) == 0
+    _assert_consistent()
@@ -0,0 +1,76 @@
+# Условные ответы (@conditional и /api/ratings): пока таблицы не менялись, повторный
+# запрос с If-None-Match получает 304, после записи - новый ETag и свежую страницу.
+import pytest
+
+from models import db, Student, Event, Participation, refresh_rankings
+
+
+def _get(client, path, etag=None):
+    headers = {'If-None-Match': f'"{etag}"'} if etag else {}
+    return client.get(path, headers=headers)
+
+
+@pytest.fixture
+def client(admin_client):
+    # Первый запрос забирает flash-сообщение входа: страница с ним отрисовывается без ETag
+    admin_client.get('/events')
+    return admin_client
+
+
+def test_unchanged_page_is_not_modified(client):
+    response = _get(client, '/events')
+    etag = response.get_etag()[0]
+    assert response.status_code == 200 and etag
+
+    response = _get(client, '/events', etag)
+    assert response.status_code == 304
+    assert response.get_etag()[0] == etag
+
+
+def test_write_changes_etag(client):
+    etag = _get(client, '/events').get_etag()[0]
+
+    client.post('/add_event', data={'name': 'Кросс', 'description': '', 'level': 'school',
+                                    'event_type': 'student', 'class_points': ''})
+    # Страница с сообщением "Мероприятие добавлено" отдается без ETag
+    assert _get(client, '/events').get_etag()[0] is None
+
+    response = _get(client, '/events', etag)
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+    assert 'Кросс' in response.get_data(as_text=True)
+
+
+def test_etag_depends_on_query(client):
+    assert _get(client, '/events').get_etag()[0] != _get(client, '/events?level=city').get_etag()[0]
+
+
+def test_cached_body_follows_writes(client):
+    db.session.add(Student(id=1, full_name='Иванов Иван', class_id=1, login='ivanov', password_hash='-'))
+    db.session.add(Event(id=1, name='Олимпиада', level='school', event_type='student', created_by=1))
+    db.session.commit()
+    refresh_rankings()
+
+    first = _get(client, '/ratings')
+    assert first.status_code == 200
+    # Отрисованная страница берется из кеша по тому же ETag
+    assert _get(client, '/ratings').get_data() == first.get_data()
+
+    db.session.add(Participation(event_id=1, student_id=1, place=1, approved=True))
+    db.session.commit()
+    refresh_rankings()
+
+    response = _get(client, '/ratings', first.get_etag()[0])
+    assert response.status_code == 200
+    assert response.get_etag()[0] != first.get_etag()[0]
+
+
+def test_api_ratings_etag_follows_generation(client):
+    refresh_rankings()
+    etag = _get(client, '/api/ratings/students').get_etag()[0]
+    assert _get(client, '/api/ratings/students', etag).status_code == 304
+
+    refresh_rankings()
+    response = _get(client, '/api/ratings/students', etag)
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
@@ -0,0 +1,140 @@
+# Очередь фоновых задач (jobs.py): повтор после ошибки, ключ идемпотентности,
+# возврат брошенных задач в очередь и одноразовое скачивание файла с паролями.
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app
+from jobs import HANDLERS, JOB_STALE_AFTER, QUEUED, RUNNING, DONE, FAILED, Job, claim, enqueue, run_pending
+from jobs import _requeue_stale
+from models import db, Student
+
+
+@pytest.fixture
+def flaky(database, monkeypatch):
+    """Задача test_flaky падает при первом вызове; вызовы копятся в списке"""
+    calls = []
+
+    def handler(context, value):
+        calls.append(value)
+        if len(calls) == 1:
+            raise RuntimeError('сбой')
+        return {'value': value}
+
+    monkeypatch.setitem(HANDLERS, 'test_flaky', (handler, 2))
+    return calls
+
+
+def _work():
+    """Выполнить очередь в своем контексте приложения, как рабочий процесс"""
+    with app.app_context():
+        return run_pending()
+
+
+def _job(job_id):
+    db.session.expire_all()
+    return db.session.get(Job, job_id)
+
+
+def _make_due(job_id):
+    db.session.execute(db.update(Job).where(Job.id == job_id).values(run_after=datetime.utcnow()))
+    db.session.commit()
+
+
+def test_retry_after_failure(flaky):
+    job_id = enqueue('test_flaky', {'value': 7}).id
+
+    _work()
+    queued = _job(job_id)
+    assert (queued.status, queued.attempts) == (QUEUED, 1)
+    assert 'сбой' in queued.error
+    # До конца паузы задача не берется
+    assert queued.run_after > datetime.utcnow()
+    _work()
+    assert _job(job_id).attempts == 1
+
+    _make_due(job_id)
+    _work()
+    done = _job(job_id)
+    assert (done.status, done.attempts, done.error) == (DONE, 2, None)
+    assert done.to_dict()['result'] == {'value': 7}
+    assert flaky == [7, 7]
+
+
+def test_failed_after_max_attempts(database, monkeypatch):
+    def handler(context):
+        raise ValueError('неверные данные')
+
+    monkeypatch.setitem(HANDLERS, 'test_broken', (handler, 2))
+    job_id = enqueue('test_broken').id
+    _work()
+    _make_due(job_id)
+    _work()
+
+    failed = _job(job_id)
+    assert (failed.status, failed.attempts) == (FAILED, 2)
+    assert failed.to_dict()['error'] == 'ValueError: неверные данные'
+
+
+def test_idempotency_key_returns_same_job(flaky):
+    first = enqueue('test_flaky', {'value': 1}, idempotency_key='form-1', created_by='user-1')
+    again = enqueue('test_flaky', {'value': 2}, idempotency_key='form-1', created_by='user-1')
+    other_user = enqueue('test_flaky', {'value': 3}, idempotency_key='form-1', created_by='user-2')
+    no_key = enqueue('test_flaky', {'value': 4}, created_by='user-1')
+
+    assert again.id == first.id
+    assert len({first.id, other_user.id, no_key.id}) == 3
+    assert db.session.scalar(db.select(db.func.count()).where(Job.kind == 'test_flaky')) == 3
+
+
+def test_idempotency_key_header(admin_client):
+    headers = {'Idempotency-Key': 'recompute-1'}
+    first = admin_client.post('/api/jobs/recompute_ratings', headers=headers).get_json()
+    again = admin_client.post('/api/jobs/recompute_ratings', headers=headers).get_json()
+    other = admin_client.post('/api/jobs/recompute_ratings').get_json()
+    assert first['job_id'] == again['job_id'] != other['job_id']
+
+
+@pytest.mark.parametrize('max_attempts, status', [(2, QUEUED), (1, FAILED)])
+def test_stale_job_requeued(flaky, max_attempts, status):
+    job_id = enqueue('test_flaky', {'value': 1}).id
+    db.session.execute(db.update(Job).where(Job.id == job_id).values(max_attempts=max_attempts))
+    db.session.commit()
+    assert claim('dead-worker') == job_id
+
+    # Свежая отметка: задача еще выполняется
+    _requeue_stale()
+    assert _job(job_id).status == RUNNING
+
+    stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_AFTER + 1)
+    db.session.execute(db.update(Job).where(Job.id == job_id).values(heartbeat_at=stale))
+    db.session.commit()
+    _requeue_stale()
+    requeued = _job(job_id)
+    assert (requeued.status, requeued.worker) == (status, None)
+    assert requeued.error == 'Рабочий процесс не отвечает'
+
+
+def test_credentials_file_removed_after_full_download(admin_client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'JOB_FILES_PATH', str(tmp_path))
+    db.session.add(Student(id=1, full_name='Иванов Иван', class_id=1, login='ivanov', password_hash='-'))
+    db.session.commit()
+
+    admin_client.get('/class/1/export_logins')
+    _work()
+    job_id = db.session.scalar(db.select(Job.id).where(Job.kind == 'regenerate_credentials'))
+    assert _job(job_id).status == DONE
+    url = f'/api/jobs/{job_id}/download'
+
+    # Оборванное скачивание: файл остается, его можно скачать еще раз
+    response = admin_client.get(url)
+    response.close()
+    assert os.listdir(tmp_path)
+
+    response = admin_client.get(url)
+    assert 'Иванов Иван' in response.get_data().decode('utf-8-sig')
+    response.close()
+    assert os.listdir(tmp_path) == []
+
+    assert admin_client.get(url).status_code == 404
@@ -0,0 +1,104 @@
+# Постраничный вывод по ключу (pagination.keyset_page): обход страниц по курсорам
+# дает каждую строку ровно один раз, в том числе при равных ключах сортировки
+# и на границе страниц; поиск по ФИО не зависит от регистра кириллицы.
+from datetime import datetime, timedelta
+
+import pytest
+
+import queries
+from models import db, Student, Event, Participation
+from pagination import ListFilters, decode_cursor, encode_cursor
+
+CREATED = datetime(2024, 9, 1, 12, 0)
+
+
+def _walk(fetch, limit):
+    """Все страницы подряд: (список элементов, число страниц)"""
+    items, cursor, pages = [], None, 0
+    while True:
+        page = fetch(cursor=cursor, limit=limit)
+        pages += 1
+        items.extend(page.items)
+        if page.next_cursor is None:
+            return items, pages
+        assert page.items, 'пустая страница с курсором'
+        cursor = page.next_cursor
+
+
+@pytest.fixture
+def events(database):
+    """Семь мероприятий: пять созданы в одну секунду, два - раньше"""
+    created = [CREATED] * 5 + [CREATED - timedelta(days=1), CREATED - timedelta(days=2)]
+    db.session.add_all([Event(id=number, name=f'Мероприятие {number}', level='school', event_type='student',
+                              created_by=1, created_at=moment) for number, moment in enumerate(created, 1)])
+    db.session.commit()
+    return db
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 5, 7, 10])
+def test_events_with_equal_keys(events, limit):
+    items, pages = _walk(lambda **page: queries.active_events(ListFilters(), **page), limit)
+    # Новые первыми, при равном времени - по убыванию id
+    assert [event.id for event in items] == [5, 4, 3, 2, 1, 6, 7]
+    # Последняя полная страница не порождает лишний запрос с пустым результатом
+    assert pages == max(1, -(-7 // limit))
+
+
+def test_participations_with_equal_keys(events):
+    db.session.add(Student(id=1, full_name='Иванов Иван', class_id=1, login='ivanov', password_hash='-'))
+    db.session.add_all([Participation(event_id=number, student_id=1, approved=number != 3, created_at=CREATED)
+                        for number in range(1, 8)])
+    db.session.commit()
+
+    items, _ = _walk(lambda **page: queries.approved_participations(1, ListFilters(), **page), 2)
+    assert [participation.event_id for participation in items] == [7, 6, 5, 4, 2, 1]
+
+
+def test_students_with_equal_names(database):
+    names = ['Петров Петр', 'Иванов Иван', 'Иванов Иван', 'Иванов Иван', 'Сидоров Сидор']
+    db.session.add_all([Student(id=number, full_name=name, class_id=1, login=f'student{number}',
+                                password_hash='-') for number, name in enumerate(names, 1)])
+    db.session.commit()
+
+    items, _ = _walk(lambda **page: queries.search_students(ListFilters(), **page), 2)
+    assert [row.id for row in items] == [2, 3, 4, 1, 5]
+
+
+def test_search_ignores_cyrillic_case(admin_client):
+    db.session.add_all([
+        Student(id=1, full_name='Иванов Иван', class_id=1, login='ivanov', password_hash='-'),
+        Student(id=2, full_name='Сидоров Иван', class_id=2, login='sidorov', password_hash='-'),
+        Student(id=3, full_name='Петров Петр', class_id=1, login='petrov', password_hash='-'),
+    ])
+    db.session.commit()
+
+    for query in ('ив', 'ИВ', 'Ив'):
+        response = admin_client.get('/api/students/search', query_string={'q': query})
+        assert [item['id'] for item in response.get_json()['items']] == [1, 2]
+
+    response = admin_client.get('/api/students/search', query_string={'q': 'ив', 'limit': 1})
+    page = response.get_json()
+    response = admin_client.get('/api/students/search', query_string={'q': 'ив', 'limit': 1,
+                                                                       'after': page['next_cursor']})
+    assert [item['id'] for item in page['items'] + response.get_json()['items']] == [1, 2]
+    assert response.get_json()['next_cursor'] is None
+
+
+def test_search_escapes_wildcards(database):
+    db.session.add_all([
+        Student(id=1, full_name='Иванов_Иван', class_id=1, login='ivanov', password_hash='-'),
+        Student(id=2, full_name='Иванов Иван', class_id=1, login='ivanov2', password_hash='-'),
+    ])
+    db.session.commit()
+    page = queries.search_students(ListFilters(q='в_и'))
+    assert [row.id for row in page.items] == [1]
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(CREATED, 7), Event.created_at) == (CREATED, 7)
+    assert decode_cursor(encode_cursor('Иванов Иван', 3), Student.full_name) == ('Иванов Иван', 3)
+
+
+@pytest.mark.parametrize('cursor', [None, '', 'мусор', encode_cursor('не дата', 1), 'WzEsMl0'])
+def test_broken_cursor_starts_from_first_page(cursor):
+    assert decode_cursor(cursor, Event.created_at) is None
@@ -0,0 +1,113 @@
+# Ведомости сбора макулатуры (save_paper_collections): положительное значение
+# вставляет или обновляет запись, ноль удаляет ее; сводные таблицы после любых
+# изменений совпадают с пересобранными заново (rebuild_paper_rollups).
+import random
+import threading
+from datetime import date
+
+import pytest
+
+from app import app
+from models import db, Student, PaperCollection, PaperClassDaily, PaperClassMonthly, PaperStudentYearly
+from models import rebuild_paper_rollups, save_paper_collections
+
+DAY = date(2024, 10, 1)
+
+
+@pytest.fixture
+def school(database):
+    """Ученики 1-3 в классе 5А, 4 - в 5Б"""
+    db.session.add_all([Student(id=number, full_name=f'Ученик {number}', class_id=1 if number <= 3 else 2,
+                                login=f'student{number}', password_hash='-') for number in range(1, 5)])
+    db.session.commit()
+    return db
+
+
+def _collections():
+    return {(row.class_id, row.collection_date, row.student_id): row.kilograms
+            for row in db.session.execute(db.select(PaperCollection.class_id, PaperCollection.collection_date,
+                                                    PaperCollection.student_id, PaperCollection.kilograms))}
+
+
+def test_insert_and_update(school):
+    assert save_paper_collections([(1, DAY, 1, 2.5), (1, DAY, 2, 1)], created_by=1) == {'saved': 2, 'deleted': 0}
+    assert save_paper_collections([(1, DAY, 1, 4), (1, DAY, 3, 1)], created_by=1) == {'saved': 2, 'deleted': 0}
+    assert _collections() == {(1, DAY, 1): 4, (1, DAY, 2): 1, (1, DAY, 3): 1}
+
+
+def test_zero_deletes_existing_row(school):
+    save_paper_collections([(1, DAY, 1, 2.5), (1, DAY, 2, 1)], created_by=1)
+    assert save_paper_collections([(1, DAY, 1, 0)], created_by=1) == {'saved': 0, 'deleted': 1}
+    assert _collections() == {(1, DAY, 2): 1}
+
+
+def test_zero_for_missing_row_does_nothing(school):
+    assert save_paper_collections([(1, DAY, 1, 0)], created_by=1) == {'saved': 0, 'deleted': 0}
+    assert _collections() == {}
+
+
+def test_last_value_for_repeated_key_wins(school):
+    save_paper_collections([(1, DAY, 1, 2), (1, DAY, 1, 0), (1, DAY, 1, 3)], created_by=1)
+    assert _collections() == {(1, DAY, 1): 3}
+
+
+def test_save_from_form(admin_client, school):
+    response = admin_client.post('/paper_collection/save', data={
+        'class_id': 1, 'collection_date': DAY.isoformat(), 'kilograms_1': '2', 'kilograms_2': '', 'kilograms_4': '5'
+    })
+    assert response.get_json()['success']
+    # Ученик 4 из другого класса в ведомость 5А не попадает
+    assert _collections() == {(1, DAY, 1): 2}
+
+
+def _rollups():
+    return {
+        model.__tablename__: sorted(
+            tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+            for row in db.session.execute(db.select(*model.__table__.c))
+        )
+        for model in (PaperClassDaily, PaperClassMonthly, PaperStudentYearly)
+    }
+
+
+def _assert_rollups_match_rebuild():
+    incremental = _rollups()
+    rebuild_paper_rollups()
+    assert incremental == _rollups()
+
+
+def test_rollups_match_rebuild(school):
+    days = [date(2023, 12, 20), date(2024, 1, 10), date(2024, 1, 25), date(2024, 2, 5)]
+    generator = random.Random(7)
+    for _ in range(30):
+        sheet = []
+        for _ in range(generator.randint(1, 6)):
+            student_id = generator.randint(1, 4)
+            kilograms = generator.choice([0, 0, 0.5, 1.5, 3, 10])
+            sheet.append((1 if student_id <= 3 else 2, generator.choice(days), student_id, kilograms))
+        save_paper_collections(sheet, created_by=1)
+    _assert_rollups_match_rebuild()
+
+
+def test_rollup_rows_removed_with_last_entry(school):
+    save_paper_collections([(1, DAY, 1, 2)], created_by=1)
+    save_paper_collections([(1, DAY, 1, 0)], created_by=1)
+    assert _rollups() == {'paper_class_daily': [], 'paper_class_monthly': [], 'paper_student_yearly': []}
+
+
+def test_concurrent_saves_keep_rollups_consistent(school):
+    """Параллельные ведомости с общими строками: прежние значения читаются под блокировкой"""
+
+    def save_sheets(kilograms):
+        with app.app_context():
+            for number in range(15):
+                save_paper_collections([(1, DAY, 1, kilograms + number), (1, DAY, 2, kilograms),
+                                        (1, DAY, 3, number % 2)], created_by=1)
+
+    threads = [threading.Thread(target=save_sheets, args=(kilograms,)) for kilograms in (1, 5, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.session.expire_all()
+    _assert_rollups_match_rebuild()
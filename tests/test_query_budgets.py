@@ -0,0 +1,109 @@
+# Бюджет SQL-запросов страниц (queries.QUERY_BUDGETS): число запросов не должно
+# зависеть от размера класса. Каждая страница отрисовывается на маленьком и большом
+# классе внутри count_queries(бюджет) при включенном ENFORCE_QUERY_BUDGET.
+import threading
+from datetime import date, datetime
+
+import pytest
+
+from werkzeug.security import generate_password_hash
+
+from app import app
+from conftest import PASSWORD, reset_database
+from models import db, User, SchoolClass, Student, Event, Participation, PortfolioEntry, ClassPoints
+from models import recompute_all, recompute_class_ratings, refresh_rankings
+from queries import QUERY_BUDGETS, count_queries
+
+CLASS_SIZES = (5, 40)
+CLASS_ID = 1
+STUDENT_ID = 1
+
+PAGES = {
+    'classes': '/classes',
+    'class_students': f'/class/{CLASS_ID}/students',
+    'ratings': '/ratings',
+    'reports': '/reports',
+    'student_portfolio': f'/portfolio/{STUDENT_ID}',
+}
+
+
+def _fill(size):
+    """База с одним классом из size учеников; у ученика STUDENT_ID size участий"""
+    reset_database()
+    password_hash = generate_password_hash(PASSWORD)
+    now = datetime(2024, 3, 1, 12, 0)
+
+    db.session.add(User(id=1, username='admin', email='admin@test', password_hash=password_hash, role='admin'))
+    db.session.add(User(id=2, username='teacher', email='teacher@test', password_hash=password_hash, role='teacher'))
+    db.session.add_all([SchoolClass(id=CLASS_ID, name='А', grade='5', class_teacher_id=2),
+                        SchoolClass(id=CLASS_ID + 1, name='Б', grade='5')])
+    db.session.flush()
+    db.session.add_all([Event(id=number, name=f'Мероприятие {number}', level='school', event_type='both',
+                              created_by=1, created_at=now) for number in range(1, size + 1)])
+    for number in range(1, size + 1):
+        db.session.add(Student(id=number, full_name=f'Ученик {number:03d}', class_id=CLASS_ID,
+                               login=f'student{number}', password_hash=password_hash))
+        db.session.add(Participation(event_id=number, student_id=number, participants_count=1, place=1,
+                                     approved=True, approved_by=1, created_at=now))
+        db.session.add(PortfolioEntry(student_id=number, title='Достижение', entry_type='project',
+                                      date_achieved=date(2024, 3, 1), points_earned=2, approved=True))
+        db.session.add(ClassPoints(class_id=CLASS_ID, points=1, reason='Дежурство', assigned_by=2))
+    db.session.add_all([Participation(event_id=number, student_id=STUDENT_ID, participants_count=1,
+                                      approved=True, approved_by=1, created_at=now)
+                        for number in range(2, size + 1)])
+    db.session.commit()
+    recompute_all(fix=True)
+    recompute_class_ratings(fix=True)
+    refresh_rankings()
+    db.session.remove()
+
+
+def _page_queries(size):
+    """{страница: число запросов} на чистых кешах для класса из size учеников"""
+    with app.app_context():
+        _fill(size)
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': PASSWORD})
+
+    counts = {}
+    for endpoint, path in PAGES.items():
+        with count_queries(QUERY_BUDGETS[endpoint]) as counter:
+            response = client.get(path)
+        assert response.status_code == 200, f'{path}: {response.status_code}'
+        counts[endpoint] = counter['count']
+    return counts
+
+
+@pytest.fixture(scope='module')
+def page_queries():
+    app.config.update(TESTING=True, ENFORCE_QUERY_BUDGET=True)
+    try:
+        yield {size: _page_queries(size) for size in CLASS_SIZES}
+    finally:
+        app.config.update(TESTING=False, ENFORCE_QUERY_BUDGET=False)
+
+
+@pytest.mark.parametrize('endpoint', sorted(PAGES))
+def test_page_within_budget(page_queries, endpoint):
+    for size in CLASS_SIZES:
+        assert page_queries[size][endpoint] <= QUERY_BUDGETS[endpoint]
+
+
+@pytest.mark.parametrize('endpoint', sorted(PAGES))
+def test_queries_do_not_grow_with_class_size(page_queries, endpoint):
+    small, large = (page_queries[size][endpoint] for size in CLASS_SIZES)
+    assert small == large, f'{endpoint}: {small} запросов на {CLASS_SIZES[0]} учеников, {large} на {CLASS_SIZES[1]}'
+
+
+def test_count_queries_is_per_thread():
+    """Запросы других потоков в счетчик блока не попадают"""
+
+    def query_in_thread():
+        with app.app_context():
+            db.session.execute(db.text('SELECT 1'))
+
+    with count_queries() as counter:
+        thread = threading.Thread(target=query_in_thread)
+        thread.start()
+        thread.join()
+    assert counter['count'] == 0
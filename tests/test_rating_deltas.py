@@ -0,0 +1,140 @@
+# Инкрементальный личный рейтинг: каждое изменение участия меняет personal_rating
+# на дельту баллов, и результат совпадает с полным пересчетом (recompute_all).
+from datetime import date
+
+import pytest
+
+from models import db, Student, Event, Participation, PortfolioEntry
+from models import recompute_all, recompute_class_ratings
+
+
+@pytest.fixture
+def school(database):
+    """Ученики 1, 2 в классе 5А, ученик 3 в 5Б и одно мероприятие"""
+    db.session.add_all([
+        Student(id=1, full_name='Иванов Иван', class_id=1, login='ivanov', password_hash='-'),
+        Student(id=2, full_name='Петров Петр', class_id=1, login='petrov', password_hash='-'),
+        Student(id=3, full_name='Сидоров Сидор', class_id=2, login='sidorov', password_hash='-'),
+        Event(id=1, name='Олимпиада', level='school', event_type='student', created_by=1),
+    ])
+    db.session.commit()
+    return db
+
+
+def _ratings():
+    return dict(db.session.execute(db.select(Student.id, Student.personal_rating).order_by(Student.id)).all())
+
+
+def _assert_consistent():
+    assert recompute_all(fix=False) == []
+    assert recompute_class_ratings(fix=False) == []
+
+
+def _participate(student_id, place=None, approved=True):
+    participation = Participation(event_id=1, student_id=student_id, place=place, approved=approved)
+    db.session.add(participation)
+    db.session.commit()
+    return participation
+
+
+def test_place(school):
+    _participate(1, place=1)
+    _participate(2)
+    assert _ratings() == {1: 5, 2: 1, 3: 0}
+    _assert_consistent()
+
+
+def test_replace(school):
+    participation = _participate(1, place=1)
+    participation.place = 3
+    db.session.commit()
+    assert _ratings()[1] == 3
+    participation.place = None
+    db.session.commit()
+    assert _ratings()[1] == 1
+    _assert_consistent()
+
+
+def test_approve_and_unapprove(school):
+    participation = _participate(1, place=2, approved=False)
+    assert _ratings()[1] == 0
+    participation.approved = True
+    db.session.commit()
+    assert _ratings()[1] == 4
+    participation.approved = False
+    db.session.commit()
+    assert _ratings()[1] == 0
+    _assert_consistent()
+
+
+def test_move_to_another_student(school):
+    participation = _participate(1, place=1)
+    participation.student_id = 3
+    db.session.commit()
+    assert _ratings() == {1: 0, 2: 0, 3: 5}
+    _assert_consistent()
+
+
+def test_change_place_and_student_in_one_flush(school):
+    participation = _participate(1, place=1)
+    participation.student_id = 2
+    participation.place = 4
+    db.session.commit()
+    assert _ratings() == {1: 0, 2: 2, 3: 0}
+    _assert_consistent()
+
+
+def test_delete(school):
+    participation = _participate(1, place=1)
+    _participate(2, place=2)
+    db.session.delete(participation)
+    db.session.commit()
+    assert _ratings() == {1: 0, 2: 4, 3: 0}
+    _assert_consistent()
+
+
+def test_delete_unloaded_participation(school):
+    """Удаление объекта с невыгруженными атрибутами: рейтинг пересчитывается целиком"""
+    participation_id = _participate(1, place=1).id
+    db.session.expunge_all()
+    participation = db.session.get(Participation, participation_id)
+    db.session.expire(participation)
+    db.session.delete(participation)
+    db.session.commit()
+    assert _ratings()[1] == 0
+    _assert_consistent()
+
+
+def test_portfolio_entry(school):
+    entry = PortfolioEntry(student_id=1, title='Проект', entry_type='project',
+                           date_achieved=date(2024, 3, 1), points_earned=3, approved=True)
+    db.session.add(entry)
+    db.session.commit()
+    _participate(1, place=1)
+    assert _ratings()[1] == 8
+    entry.approved = False
+    db.session.commit()
+    assert _ratings()[1] == 5
+    _assert_consistent()
+
+
+def test_student_moves_to_another_class(school):
+    _participate(1, place=1)
+    student = db.session.get(Student, 1)
+    student.class_id = 2
+    db.session.commit()
+    _assert_consistent()
+
+
+def test_several_flushes_in_one_transaction(school):
+    participation = Participation(event_id=1, student_id=1, place=1, approved=True)
+    db.session.add(participation)
+    db.session.flush()
+    participation.place = 2
+    db.session.flush()
+    participation.approved = False
+    db.session.flush()
+    participation.approved = True
+    db.session.commit()
+    assert _ratings()[1] == 4
+    _assert_consistent()
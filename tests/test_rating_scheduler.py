@@ -0,0 +1,118 @@
+# Отложенный пересчет рейтингов (RATING_RECOMPUTE_DELAY > 0): запись оставляет
+# пометки в dirty_ratings, пересчет забирает их таймером процесса или задачей
+# flush_ratings; после него рейтинги совпадают с полным пересчетом.
+import time
+from datetime import datetime
+
+import pytest
+
+from app import app
+from jobs import DONE, Job, run_pending
+from models import db, Student, Event, Participation, DirtyRating
+from models import RATING_RECOMPUTE_MAX_RETRIES, rating_scheduler, recompute_all, recompute_class_ratings
+
+
+def _stop_timer():
+    with rating_scheduler._lock:
+        if rating_scheduler._timer is not None:
+            rating_scheduler._timer.cancel()
+        rating_scheduler._timer = None
+        rating_scheduler._pending_since = None
+        rating_scheduler._failures = 0
+
+
+@pytest.fixture
+def deferred(database, monkeypatch):
+    """Отложенный пересчет с долгой паузой: таймер не сработает сам, пока его не ждут"""
+    db.session.add_all([
+        Student(id=1, full_name='Иванов Иван', class_id=1, login='ivanov', password_hash='-'),
+        Student(id=2, full_name='Петров Петр', class_id=2, login='petrov', password_hash='-'),
+        Event(id=1, name='Субботник', level='school', event_type='both', class_points=2, created_by=1),
+    ])
+    db.session.commit()
+    monkeypatch.setattr(rating_scheduler, 'app', app)
+    monkeypatch.setattr(rating_scheduler, 'delay', 60)
+    yield db
+    _stop_timer()
+
+
+def _dirty():
+    db.session.rollback()
+    return sorted(db.session.execute(db.select(DirtyRating.kind, DirtyRating.entity_id)).all())
+
+
+def _participate(student_id, place=1):
+    db.session.add(Participation(event_id=1, student_id=student_id, place=place, approved=True))
+    db.session.commit()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'не дождались'
+        time.sleep(0.02)
+
+
+def test_write_leaves_marks_until_flush(deferred):
+    _participate(1)
+    _participate(2, place=2)
+    # Личный рейтинг меняется дельтой сразу, класс помечается через ученика
+    assert _dirty() == [('class_students', 1), ('class_students', 2)]
+    assert recompute_all(fix=False) == []
+    assert recompute_class_ratings(fix=False) != []
+    assert rating_scheduler._timer is not None
+
+    assert rating_scheduler.flush(db.session) == 2
+    db.session.commit()
+    assert _dirty() == []
+    assert recompute_all(fix=False) == []
+    assert recompute_class_ratings(fix=False) == []
+
+
+def test_timer_flushes_after_quiet_period(deferred, monkeypatch):
+    monkeypatch.setattr(rating_scheduler, 'delay', 0.05)
+    _participate(1)
+    _participate(2)
+    _wait_for(lambda: _dirty() == [])
+    assert recompute_all(fix=False) == []
+    assert recompute_class_ratings(fix=False) == []
+
+
+def test_flush_ratings_job(deferred):
+    _participate(1)
+    job_id = db.session.scalar(db.select(Job.id).where(Job.kind == 'flush_ratings'))
+    assert job_id is not None
+    # Повторная запись сливается с задачей, которая еще ждет
+    _participate(2)
+    assert db.session.scalar(db.select(db.func.count()).where(Job.kind == 'flush_ratings')) == 1
+
+    db.session.execute(db.update(Job).where(Job.id == job_id).values(run_after=datetime.utcnow()))
+    db.session.commit()
+    with app.app_context():
+        run_pending()
+
+    db.session.expire_all()
+    finished = db.session.get(Job, job_id)
+    assert finished.status == DONE
+    assert finished.to_dict()['result'] == {'marks': 2}
+    assert _dirty() == []
+    assert recompute_class_ratings(fix=False) == []
+
+
+def test_failed_flush_retries_are_capped(deferred, monkeypatch):
+    _participate(1)
+    _stop_timer()
+    calls = []
+
+    def broken_flush(session):
+        calls.append(True)
+        raise RuntimeError('база недоступна')
+
+    monkeypatch.setattr(rating_scheduler, 'flush', broken_flush)
+    monkeypatch.setattr(rating_scheduler, 'delay', 0.01)
+    rating_scheduler.flush_pending()
+    _wait_for(lambda: len(calls) >= RATING_RECOMPUTE_MAX_RETRIES and rating_scheduler._timer is None)
+    time.sleep(0.1)
+    assert len(calls) == RATING_RECOMPUTE_MAX_RETRIES
+    # Пометки остаются для следующего пересчета
+    assert _dirty() != []